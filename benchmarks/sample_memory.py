@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# -----------------------------------------------------------------------------
+# Copyright (c) 2016--, The Plate Mapper Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+"""Memory used by instantiated Sample objects
+
+Compares the memory taken by Sample objects, which use __slots__, with the
+same objects keeping their attributes in a __dict__, as they used to. The
+objects are created as from_ids does after validating their ids, so no
+database access is needed.
+"""
+import gc
+import tracemalloc
+
+import click
+
+from platemap.lib.sample import Sample
+
+
+class DictSample(object):
+    """Sample keeping its attributes in a __dict__"""
+    def __init__(self, id_):
+        self._id = id_
+        self._row = None
+        self._row_epoch = None
+        self._related = None
+
+
+def slots_sample(id_):
+    obj = Sample.__new__(Sample)
+    obj._id = id_
+    return obj
+
+
+def measure(factory, n):
+    """Returns the bytes allocated to keep n objects created by factory"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        objects = [factory(i) for i in range(n)]
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del objects
+    return size
+
+
+@click.command()
+@click.option('-n', '--number', default=100000, show_default=True,
+              help='Number of samples to instantiate')
+def main(number):
+    dict_size = measure(DictSample, number)
+    slots_size = measure(slots_sample, number)
+    click.echo('%d samples' % number)
+    click.echo('  __dict__:  %8.2f MiB  (%d bytes each)'
+               % (dict_size / 2 ** 20, dict_size // number))
+    click.echo('  __slots__: %8.2f MiB  (%d bytes each)'
+               % (slots_size / 2 ** 20, slots_size // number))
+    click.echo('  saved:     %8.2f MiB  (%.0f%%)'
+               % ((dict_size - slots_size) / 2 ** 20,
+                  100 * (dict_size - slots_size) / dict_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,13 +13,16 @@ import platemap.lib.plate as plate
 import platemap.lib.sample as sample
 import platemap.lib.protocol as protocol
 import platemap.lib.project as project
+import platemap.lib.query_log as query_log
 import platemap.lib.run as run
 import platemap.lib.util as util
 import platemap.lib.sql_connection as sql
 import platemap.lib.web_helpers as webhelp
 import platemap.handlers as handlers
+from platemap.lib.base import prefetch
 
 __version__ = "0.1.0-dev"
 
 __all__ = ['base', 'environment', 'exceptions', 'person', 'plate', 'sample',
-           'util', 'sql', 'protocol', 'webhelp', 'project', 'run', 'handlers']
+           'util', 'sql', 'protocol', 'webhelp', 'project', 'run', 'handlers',
+           'query_log', 'prefetch']
@@ -0,0 +1,17 @@
+-- Upgrades databases created before the plate version and the index of free
+-- barcodes were added. New databases created from platemapper.sql do not
+-- need it.
+--
+-- Apply with: psql -d <database> -f platemap/db/patches/1.sql
+
+BEGIN;
+
+CREATE INDEX idx_barcode_free ON barcodes.barcode ( barcode ) WHERE assigned_on IS NULL;
+
+CREATE SEQUENCE barcodes.plate_version_seq;
+
+ALTER TABLE barcodes.plate ADD COLUMN version bigint NOT NULL DEFAULT nextval('barcodes.plate_version_seq');
+
+COMMENT ON COLUMN barcodes.plate.version IS 'Changed every time the wells or the finalized status of the plate change. Taken from a sequence so it is never reused';
+
+COMMIT;
@@ -16,6 +16,8 @@ CREATE TABLE barcodes.barcode (
   CONSTRAINT barcode_pkey PRIMARY KEY ( barcode )
  );
 
+CREATE INDEX idx_barcode_free ON barcodes.barcode ( barcode ) WHERE assigned_on IS NULL;
+
 COMMENT ON COLUMN barcodes.barcode.assigned_on IS 'date barcode assigned to a project';
 
 COMMENT ON COLUMN barcodes.barcode.create_timestamp IS 'Date barcode created on the system';
@@ -38,6 +40,8 @@ CREATE TABLE barcodes.person (
   CONSTRAINT pk_people PRIMARY KEY ( person_id )
  );
 
+CREATE SEQUENCE barcodes.plate_version_seq;
+
 CREATE TABLE barcodes.plate ( 
   plate_id             varchar  NOT NULL,
   plate                varchar(100)  NOT NULL,
@@ -46,6 +50,7 @@ CREATE TABLE barcodes.plate (
   person_id            bigint  NOT NULL,
   "rows"               smallint  NOT NULL,
   cols                 smallint  NOT NULL,
+  version              bigint DEFAULT nextval('barcodes.plate_version_seq') NOT NULL,
   CONSTRAINT idx_plates UNIQUE ( plate_id ) ,
   CONSTRAINT pk_plates PRIMARY KEY ( plate_id ),
   CONSTRAINT fk_plates FOREIGN KEY ( plate_id ) REFERENCES barcodes.barcode( barcode )    ,
@@ -64,6 +69,8 @@ COMMENT ON COLUMN barcodes.plate."rows" IS 'Number of rows on plate';
 
 COMMENT ON COLUMN barcodes.plate.cols IS 'Number of columns on plate';
 
+COMMENT ON COLUMN barcodes.plate.version IS 'Changed every time the wells or the finalized status of the plate change. Taken from a sequence so it is never reused';
+
 CREATE TABLE barcodes.pool ( 
   pool_id              bigserial  NOT NULL,
   pool                 varchar(100)  NOT NULL,
@@ -15,6 +15,35 @@ import platemap as pm
 
 
 class BaseHandler(RequestHandler):
+    # Maximum number of queries a request is expected to execute, in total and
+    # for a single statement. Requests over budget are logged as warnings
+    query_budget = None
+    query_repeat_budget = None
+    query_counter = None
+    identity_scope = None
+
+    def prepare(self):
+        """Starts counting the queries executed by the request and shares
+        the objects validated across its transactions"""
+        self.identity_scope = pm.sql.TRN.identity_scope()
+        self.identity_scope.__enter__()
+        self.query_counter = pm.query_log.QueryCounter(
+            self.query_budget, self.query_repeat_budget)
+        self.query_counter.start()
+
+    def on_finish(self):
+        """Reports the queries executed by the request"""
+        if self.identity_scope is not None:
+            self.identity_scope.__exit__(None, None, None)
+            self.identity_scope = None
+        counter = self.query_counter
+        if counter is None:
+            return
+        counter.stop()
+        level = logging.WARNING if counter.exceeded() else logging.DEBUG
+        logging.log(level, "%s %s\n%s", self.request.method,
+                    self.request.uri, counter.report())
+
     def get_current_user(self):
         """Overrides default method of returning user currently connected"""
         username = self.get_secure_cookie('user')
@@ -5,6 +5,7 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
+from tornado.escape import json_decode
 from tornado.web import authenticated, HTTPError
 
 from platemap.handlers.base import BaseHandler
@@ -57,7 +58,7 @@ class PlateEditableRenderHandler(BaseHandler):
         else:
             sets, types, locations = [], [], []
         plate = pm.plate.Plate(plate_id)
-        self.render('render_plate.html', platemap=plate.platemap,
+        self.render('render_plate.html', layout=plate.layout,
                     plate_id=plate_id, plate_name=plate.name,
                     finalized=plate.finalized, sets=sets, types=types,
                     locations=locations, override=override)
@@ -66,10 +67,19 @@ class PlateEditableRenderHandler(BaseHandler):
 class PlateStaticRenderHandler(BaseHandler):
     @authenticated
     def get(self, plate_id):
-        if plate_id:
-            self.write(pm.plate.Plate(plate_id).to_html())
-        else:
+        if not plate_id:
             self.write('')
+            return
+
+        plate = pm.plate.Plate(plate_id)
+        # Finalized plates can not change until they are reverted, which
+        # changes their version, so clients can keep them
+        if plate.finalized:
+            self.set_header('Etag', '"%s-%d"' % (plate.id, plate.version))
+            if self.check_etag_header():
+                self.set_status(304)
+                return
+        self.write(plate.to_html())
 
 
 class PlateUpdateHandler(BaseHandler):
@@ -108,6 +118,74 @@ class PlateUpdateHandler(BaseHandler):
             raise HTTPError(400, 'Unknown action %s' % action)
 
 
+class PlateBatchUpdateHandler(BaseHandler):
+    @authenticated
+    def post(self):
+        """Updates many wells of a plate at once
+
+        The body is a JSON object with the `plate_id` and a `wells` list of
+        updates, each with the well `rowcol`, the `sample` name, empty to
+        remove the sample from the well, and optionally its `sample_set`.
+        The response lists the result of each update, in order, with an
+        empty `msg` if the well was updated and the `sample_sets` to choose
+        from if the sample name is ambiguous.
+        """
+        try:
+            data = json_decode(self.request.body)
+            plate_id = data['plate_id']
+            updates = list(data['wells'])
+        except (ValueError, KeyError, TypeError):
+            raise HTTPError(400, 'Malformed well updates')
+
+        plate = pm.plate.Plate(plate_id)
+        rows, cols = plate.shape
+        names = [u.get('sample') for u in updates if u.get('sample')]
+        samples = pm.sample.Sample.from_names(names)
+        pm.prefetch([s for found in samples.values() for s in found],
+                    'sample_set')
+
+        results = []
+        wells = {}
+        for update in updates:
+            rowcol = update.get('rowcol')
+            name = update.get('sample')
+            sample_set = update.get('sample_set')
+            result = {'rowcol': rowcol, 'msg': ''}
+            results.append(result)
+            try:
+                row, col = map(int, rowcol.split('-', 1))
+            except (AttributeError, ValueError):
+                result['msg'] = 'Unknown well "%s"' % rowcol
+                continue
+            if row < 0 or row >= rows or col < 0 or col >= cols:
+                result['msg'] = 'Position %d, %d not on plate' % (row, col)
+                continue
+            if not name:
+                wells[row, col] = None
+                continue
+
+            found = [s for s in samples.get(name, [])
+                     if sample_set is None or s.sample_set == sample_set]
+            if not found:
+                result['msg'] = 'Could not find sample "%s"' % name
+            elif len(found) > 1:
+                result['msg'] = ('Multiple samples with that name. Please '
+                                 'select which you want to add.')
+                result['sample_sets'] = [s.sample_set for s in found]
+            else:
+                wells[row, col] = found[0]
+
+        if wells:
+            try:
+                plate.assign(wells)
+            except pm.exceptions.PlateMapperError as e:
+                # Nothing was written, so all the wells to update failed
+                for result in results:
+                    if not result['msg']:
+                        result['msg'] = str(e)
+        self.write({'wells': results})
+
+
 class PlateRevertHandler(BaseHandler):
     @authenticated
     def get(self):
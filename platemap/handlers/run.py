@@ -81,6 +81,7 @@ class RenderRunHandler(BaseHandler):
     @authenticated
     def get(self, run_id):
         run = pm.run.Run(int(run_id))
+        pm.prefetch([run], 'pools')
         self.render('render_run.html', run=run)
 
 
@@ -140,4 +141,5 @@ class RenderPoolHandler(BaseHandler):
     @authenticated
     def get(self, pool_id):
         pool = pm.run.Pool(int(pool_id))
+        pm.prefetch([pool], 'protocols.plate', 'protocols.primer_set')
         self.render('render_pool.html', pool=pool)
@@ -6,6 +6,7 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 from io import StringIO
+from tornado.escape import xhtml_escape
 from tornado.web import authenticated
 
 from platemap.handlers.base import BaseHandler
@@ -31,16 +32,21 @@ class SampleCreateHandler(BaseHandler):
         if len(self.request.files) != 0:
             fileinfo = self.request.files['file'][0]
             file = StringIO(fileinfo['body'].decode('utf-8'))
+            errors = []
             try:
                 count = pm.sample.Sample.from_file(
                     file, sample_type, sample_location, sample_set,
-                    self.current_user.person, None)
+                    self.current_user.person, None, errors=errors)
             except Exception as e:
                 # Catch any error and show to user
                 msg = str(e)
             else:
                 msg = 'Created %d samples from %s' % (count,
                                                       fileinfo['filename'])
+                # List the samples skipped so they can be fixed and uploaded
+                for line_num, name, error in errors:
+                    msg += '<br/>Line %d, sample %s: %s' % (
+                        line_num, xhtml_escape(name), xhtml_escape(error))
         else:
             name = self.get_argument('sample')
             barcode = self.get_argument('barcode', None)
@@ -86,11 +92,12 @@ class SampleEditHandler(BaseHandler):
         msg = 'Updated successfully'
 
         try:
-            sample.sample_type = sample_type
-            sample.location = sample_location
-            sample.biomass_remaining = remaining
-            if barcode:
-                sample.barcode = barcode
+            with pm.sql.TRN.atomic():
+                sample.update(sample_type=sample_type,
+                              location=sample_location,
+                              biomass_remaining=remaining)
+                if barcode:
+                    sample.barcode = barcode
         except Exception as e:
             # Show any error to the user
             msg = 'ERROR: ' + str(e)
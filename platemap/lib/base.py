@@ -5,10 +5,29 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
+from collections import OrderedDict, defaultdict, namedtuple
+
 from .exceptions import DeveloperError, UnknownIDError
 from .sql_connection import TRN
 
 
+Relation = namedtuple('Relation', ['sql', 'target', 'many'])
+Relation.__doc__ = """A relation of a PMObject subclass that can be prefetched
+
+Attributes
+----------
+sql : str
+    Query returning the pairs of (object id, related value) of the objects
+    whose ids are in the array passed as its only argument
+target : callable or None
+    Returns the PMObject subclass of the related objects, whose ids are the
+    related values. None if the related values are returned as they are
+many : bool
+    Whether the objects have a list of related values or a single one, None
+    if there is none
+"""
+
+
 class PMObject(object):
     r"""Base class for any plate mapper object
 
@@ -26,8 +45,12 @@ class PMObject(object):
     create
     delete
     exists
+    from_ids
+    update
+    refresh
     _check_subclass
     _check_id
+    _check_ids
     __eq__
     __neq__
 
@@ -37,7 +60,20 @@ class PMObject(object):
         If trying to instantiate the base class directly
     """
 
+    # Objects are created in large numbers, so they do not have a __dict__.
+    # Subclasses must define __slots__ too, with any attribute they add.
+    # _row is the snapshot of the row of the object and _row_epoch the
+    # identity map epoch it was read in, and _related has the values of the
+    # relations loaded, as {name: (epoch, value)}
+    __slots__ = ('_id', '_row', '_row_epoch', '_related')
+
     _table = None
+    # Type of the ids of the table, the ids given are converted to it
+    _id_type = int
+    # Properties that can be changed with update, mapped to their columns
+    _editable = {}
+    # Relations that can be prefetched, by name
+    _relations = {}
 
     @classmethod
     def create(cls):
@@ -91,6 +127,31 @@ class PMObject(object):
             raise DeveloperError(
                 "Could not instantiate an object of the base class")
 
+    @classmethod
+    def _convert_id(cls, id_):
+        r"""Converts an ID to the type of the IDs of the table
+
+        Parameters
+        ----------
+        id_ : int or str
+            The ID, e.g. ``'5'`` for the numerical ID 5
+
+        Returns
+        -------
+        int or str
+            The ID as stored in the database, so it can be compared with the
+            IDs read from it
+
+        Raises
+        ------
+        UnknownIDError
+            If the ID can not be converted, so no object can have it
+        """
+        try:
+            return cls._id_type(id_)
+        except ValueError:
+            raise UnknownIDError(id_, cls._table)
+
     def _check_id(self, id_):
         r"""Check that the provided ID actually exists on the database
 
@@ -113,6 +174,171 @@ class PMObject(object):
             TRN.add(sql, [id_])
             return TRN.execute_fetchlast()
 
+    @classmethod
+    def _check_ids(cls, ids):
+        r"""Check which of the provided IDs actually exist on the database
+
+        Parameters
+        ----------
+        ids : list of object
+            The IDs to test, already converted with `_convert_id`
+
+        Returns
+        -------
+        dict of {object: dict}
+            The rows of the IDs that exist, keyed by ID
+
+        Notes
+        -----
+        Subclasses overriding `_check_id` should override this too.
+        """
+        with TRN:
+            sql = """SELECT * FROM barcodes.{0}
+                     WHERE {0}_id = ANY(%s)""".format(cls._table)
+            TRN.add(sql, [list(ids)])
+            column = '%s_id' % cls._table
+            return {row[column]: dict(row)
+                    for row in TRN.execute_fetchindex(cursor_mode='dict')}
+
+    @classmethod
+    def from_ids(cls, ids):
+        r"""Instantiates the objects of several IDs with a single query
+
+        Parameters
+        ----------
+        ids : iterable of int or str
+            The object identifiers
+
+        Returns
+        -------
+        list of PMObject
+            The objects, in the same order as `ids`
+
+        Raises
+        ------
+        TypeError
+            If any of the IDs is not a numerical or text type
+        UnknownIDError
+            If any of the IDs does not correspond to any object, listing all
+            of the missing IDs
+
+        Notes
+        -----
+        The IDs are converted to the type of the IDs of the table, so ``'5'``
+        and ``5`` give the same object. Only the IDs not already in the
+        identity map of the transaction are checked on the database, and the
+        rows read to check them are kept as the snapshots of the new objects.
+        """
+        ids = list(ids)
+        for id_ in ids:
+            if not isinstance(id_, (int, str)):
+                raise TypeError("id_ must be a numerical or text type (not "
+                                "%s) when instantiating %s"
+                                % (id_.__class__.__name__, cls.__name__))
+
+        with TRN:
+            cls._check_subclass()
+            invalid = []
+            converted = []
+            for id_ in ids:
+                try:
+                    converted.append(cls._convert_id(id_))
+                except UnknownIDError:
+                    invalid.append(id_)
+            if invalid:
+                raise UnknownIDError(sorted(set(invalid)), cls._table)
+            ids = converted
+
+            objects = {}
+            for id_ in ids:
+                obj = TRN.get_object(cls, id_)
+                if obj is not None:
+                    objects[id_] = obj
+            to_check = [id_ for id_ in set(ids) if id_ not in objects]
+            if to_check:
+                existing = cls._check_ids(to_check)
+                missing = sorted(id_ for id_ in to_check
+                                 if id_ not in existing)
+                if missing:
+                    raise UnknownIDError(missing, cls._table)
+                objects.update(zip(to_check, cls._from_rows(
+                    existing[id_] for id_ in to_check)))
+        return [objects[id_] for id_ in ids]
+
+    @classmethod
+    def _from_rows(cls, rows):
+        r"""Instantiates the objects of rows already read from the database
+
+        Parameters
+        ----------
+        rows : iterable of dict
+            Whole rows of the table of the class, as returned by `_check_ids`
+
+        Returns
+        -------
+        list of PMObject
+            The objects, in the same order as `rows`
+
+        Notes
+        -----
+        The rows are kept as the snapshots of the new objects. The objects
+        already in the identity map of the transaction are returned as they
+        are.
+        """
+        column = '%s_id' % cls._table
+        objects = []
+        with TRN:
+            epoch = TRN.identity_epoch
+            for row in rows:
+                obj = TRN.get_object(cls, row[column])
+                if obj is None:
+                    obj = cls.__new__(cls)
+                    obj._id = row[column]
+                    obj._set_row(row, epoch)
+                    TRN.add_object(obj)
+                objects.append(obj)
+        return objects
+
+    @classmethod
+    def _load_rows(cls, objects):
+        r"""Reads the rows of the objects without a current snapshot
+
+        Parameters
+        ----------
+        objects : list of PMObject
+            Objects of this class
+        """
+        with TRN:
+            epoch = TRN.identity_epoch
+            objects = [o for o in objects
+                       if o._row is None or o._row_epoch != epoch]
+            if objects:
+                rows = cls._check_ids(set(o.id for o in objects))
+                for obj in objects:
+                    obj._set_row(rows[obj.id], epoch)
+
+    def __new__(cls, id_=None):
+        r"""Returns the object already validated in the current transaction,
+        if any, or a new one
+
+        Parameters
+        ----------
+        id_: int, str
+            the object identifier
+        """
+        if isinstance(id_, (int, str)) and cls._table is not None:
+            try:
+                obj = TRN.get_object(cls, cls._convert_id(id_))
+            except UnknownIDError:
+                # Reported by __init__
+                obj = None
+            if obj is not None:
+                return obj
+        obj = super(PMObject, cls).__new__(cls)
+        # Nothing has been read for the object yet
+        obj.refresh()
+        return obj
+
     def __init__(self, id_):
         r"""Initializes the object
 
@@ -125,7 +351,18 @@ class PMObject(object):
         ------
         UnknownIDError
             If `id_` does not correspond to any object
+
+        Notes
+        -----
+        Objects are kept in the identity map of the transaction, so creating
+        the same object again in the transaction returns the same instance
+        without checking its id on the database. The id is converted to the
+        type of the ids of the table, see `_convert_id`.
         """
+        if getattr(self, '_id', None) is not None:
+            # Instance taken from the identity map, already validated
+            return
+
         # Most IDs in the database are numerical, but some (e.g., IDs used for
         # the User object) are strings. Moreover, some integer IDs are passed
         # as strings (e.g., '5'). Therefore, explicit type-checking is needed
@@ -138,10 +375,12 @@ class PMObject(object):
 
         with TRN:
             self._check_subclass()
+            id_ = self._convert_id(id_)
             if not self._check_id(id_):
                 raise UnknownIDError(id_, self._table)
 
-        self._id = id_
+            self._id = id_
+            TRN.add_object(self)
 
     def __eq__(self, other):
         r"""Self and other are equal based on type and database id"""
@@ -159,12 +398,69 @@ class PMObject(object):
         r"""The hash of an object is based on the id"""
         return hash(str(self.id))
 
+    def _get_row(self):
+        r"""Returns the row of the object, read once per transaction
+
+        Returns
+        -------
+        dict of {str: object}
+            The columns of the object on its table
+
+        Notes
+        -----
+        The row is kept as long as the identity map of the transaction is,
+        so it is read again after a commit outside of an identity scope or
+        after a rollback, and the properties read in a transaction are
+        consistent with it.
+        """
+        sql = "SELECT * FROM barcodes.{0} WHERE {0}_id = %s".format(
+            self._table)
+        with TRN:
+            epoch = TRN.identity_epoch
+            if self._row is None or self._row_epoch != epoch:
+                TRN.add(sql, [self.id])
+                self._row = dict(TRN.execute_fetchindex(cursor_mode='dict')[0])
+                self._row_epoch = epoch
+            return self._row
+
+    def _set_row(self, row, epoch):
+        r"""Keeps a row read from the database as the snapshot of the object
+
+        Parameters
+        ----------
+        row : dict of {str: object}
+            The row, as returned by `_check_ids`
+        epoch : int
+            The identity map epoch it was read in
+        """
+        self._row = row
+        self._row_epoch = epoch
+
     def _get_property(self, column):
-        sql = "SELECT {0} FROM barcodes.{1} WHERE {1}_id = %s".format(
-            column, self._table)
+        return self._get_row()[column]
+
+    def _get_relation(self, name):
+        r"""Returns the value of a relation, loading it if needed
+
+        Parameters
+        ----------
+        name : str
+            The relation, one of `_relations`
+
+        Returns
+        -------
+        object or list of object
+            The related objects or values
+
+        Notes
+        -----
+        Relations are kept like the row of the object, so the ones loaded
+        with `prefetch` are not read again.
+        """
         with TRN:
-            TRN.add(sql, [self.id])
-            return TRN.execute_fetchlast()
+            _prefetch_relation([self], name)
+            value = self._related[name][1]
+        return list(value) if isinstance(value, list) else value
 
     def _set_property(self, column, value):
         sql = """UPDATE barcodes.{0}
@@ -172,8 +468,180 @@ class PMObject(object):
                  WHERE {0}_id = %s""".format(self._table, column)
         with TRN:
             TRN.add(sql, [value, self.id])
+            self.refresh()
+
+    def update(self, **fields):
+        r"""Changes several properties of the object with a single query
+
+        Parameters
+        ----------
+        fields : dict of {str: object}
+            The new values, keyed by property name
+
+        Raises
+        ------
+        DeveloperError
+            If any of the properties can not be changed with update
+
+        Notes
+        -----
+        The row of the object is refreshed with the values written.
+
+        Examples
+        --------
+        Changing the type and location of a sample with a single query::
+
+            sample.update(sample_type='stool', location='freezer')
+        """
+        unknown = sorted(set(fields) - set(self._editable))
+        if unknown:
+            raise DeveloperError(
+                "Can not update %s of %s" % (', '.join(unknown),
+                                             self.__class__.__name__))
+        if not fields:
+            return
+
+        names = sorted(fields)
+        sql = """UPDATE barcodes.{0}
+                 SET {1}
+                 WHERE {0}_id = %s
+                 RETURNING *""".format(
+            self._table, ', '.join('%s = %%s' % self._editable[n]
+                                   for n in names))
+        with TRN:
+            TRN.add(sql, [fields[n] for n in names] + [self.id])
+            self._row = dict(TRN.execute_fetchindex(cursor_mode='dict')[0])
+            self._row_epoch = TRN.identity_epoch
+
+    def refresh(self):
+        r"""Discards the data read from the database for the object
+
+        The properties and relations accessed afterwards read the object
+        again. Methods changing the object do this already, it is only needed
+        when the object is changed by other means in the same transaction.
+        """
+        self._row = None
+        self._related = None
 
     @property
     def id(self):
         r"""The object id on the storage system"""
         return self._id
+
+
+def _prefetch_relation(objects, name):
+    """Loads a relation of several objects, one query per class
+
+    Parameters
+    ----------
+    objects : list of PMObject
+        The objects to load the relation of
+    name : str
+        The relation
+
+    Returns
+    -------
+    list of PMObject
+        The distinct objects related to `objects`, in order of appearance
+
+    Raises
+    ------
+    DeveloperError
+        If the relation is not defined for the class of any of the objects
+    """
+    epoch = TRN.identity_epoch
+    by_class = OrderedDict()
+    for obj in objects:
+        by_class.setdefault(type(obj), []).append(obj)
+
+    related = OrderedDict()
+    for cls, objs in by_class.items():
+        relation = cls._relations.get(name)
+        if relation is None:
+            raise DeveloperError("Can not prefetch %s of %s"
+                                 % (name, cls.__name__))
+        missing = [o for o in objs if o._related is None or
+                   o._related.get(name, (None,))[0] != epoch]
+        if missing:
+            # The ids were converted to the type of the table ids when the
+            # objects were created, so they match the ids read
+            TRN.add(relation.sql, [list(set(o.id for o in missing))])
+            values = defaultdict(list)
+            for id_, value in TRN.execute_fetchindex(cursor_mode='tuple'):
+                values[id_].append(value)
+            if relation.target is not None:
+                ids = list(OrderedDict.fromkeys(
+                    v for vs in values.values() for v in vs if v is not None))
+                targets = dict(zip(ids, relation.target().from_ids(ids)))
+                targets[None] = None
+                values = {k: [targets[v] for v in vs]
+                          for k, vs in values.items()}
+            for obj in missing:
+                value = values.get(obj.id, [])
+                if not relation.many:
+                    value = value[0] if value else None
+                if obj._related is None:
+                    obj._related = {}
+                obj._related[name] = (epoch, value)
+
+        if relation.target is not None:
+            for obj in objs:
+                value = obj._related[name][1]
+                for rel in value if relation.many else [value]:
+                    if rel is not None:
+                        related[id(rel)] = rel
+    return list(related.values())
+
+
+def prefetch(objects, *paths):
+    """Loads relations of a collection of objects with one query per hop
+
+    Parameters
+    ----------
+    objects : iterable of PMObject
+        The objects. None values are ignored
+    paths : str
+        The relations to load, with the relations of the related objects
+        separated by dots, e.g. ``'protocols.plate'``
+
+    Returns
+    -------
+    list of PMObject
+        The objects
+
+    Raises
+    ------
+    DeveloperError
+        If any of the relations is not defined for the objects reached
+
+    Notes
+    -----
+    The rows of all the objects reached are read too, so their properties
+    can be accessed without further queries. The values loaded are kept
+    like the rows of the objects, see `PMObject.refresh`.
+
+    Examples
+    --------
+    Loading the plates and creators of the protocols of a pool, with one
+    query for each relation::
+
+        prefetch(pool.protocols, 'plate', 'created_by')
+    """
+    objects = [o for o in objects if o is not None]
+    with TRN:
+        _load_rows(objects)
+        for path in paths:
+            level = objects
+            for name in path.split('.'):
+                level = _prefetch_relation(level, name)
+                _load_rows(level)
+    return objects
+
+
+def _load_rows(objects):
+    """Reads the rows of objects of any class without a current snapshot"""
+    by_class = OrderedDict()
+    for obj in objects:
+        by_class.setdefault(type(obj), []).append(obj)
+    for cls, objs in by_class.items():
+        cls._load_rows(objs)
@@ -53,6 +53,20 @@ class ConfigurationManager(object):
         The host where the database lives
     port : int
         The port used to connect to the postgres database in the previous host
+    pool_min_size : int
+        The number of database connections kept open even when idle
+    pool_max_size : int
+        The maximum number of database connections open at the same time
+    pool_idle_timeout : float
+        Seconds an idle database connection is kept open before closing it
+    statement_cache_size : int
+        The number of prepared statements kept in each database connection
+    slow_query_threshold : float or None
+        Seconds after which a query is written to the slow query log, None
+        if there is no slow query log
+    lookup_cache_ttl : float
+        Seconds the rows of small lookup tables are cached in memory, 0 if
+        they are not cached
     smtp_host
         The host where the SMTP server lives
     smtp_ssl
@@ -129,12 +143,16 @@ class ConfigurationManager(object):
 
     def _get_postgres(self, config):
         """Get the configuration of the postgres section"""
-        expected_options = {'user', 'password', 'database', 'host', 'port'}
+        expected_options = {'user', 'password', 'database', 'host', 'port',
+                            'pool_min_size', 'pool_max_size',
+                            'pool_idle_timeout', 'statement_cache_size',
+                            'slow_query_threshold', 'lookup_cache_ttl'}
         _warn_on_extra(set(config.options('postgres')) - expected_options,
                        'postgres section option(s)')
 
         get = partial(config.get, 'postgres')
         getint = partial(config.getint, 'postgres')
+        getfloat = partial(config.getfloat, 'postgres')
 
         self.user = get('USER')
         try:
@@ -147,6 +165,14 @@ class ConfigurationManager(object):
         self.database = get('DATABASE')
         self.host = get('HOST')
         self.port = getint('PORT')
+        self.pool_min_size = getint('POOL_MIN_SIZE', fallback=1)
+        self.pool_max_size = getint('POOL_MAX_SIZE', fallback=10)
+        self.pool_idle_timeout = getfloat('POOL_IDLE_TIMEOUT', fallback=300)
+        self.statement_cache_size = getint('STATEMENT_CACHE_SIZE',
+                                           fallback=100)
+        self.slow_query_threshold = getfloat('SLOW_QUERY_THRESHOLD',
+                                             fallback=None)
+        self.lookup_cache_ttl = getfloat('LOOKUP_CACHE_TTL', fallback=300)
 
     def _get_email(self, config):
         get = partial(config.get, 'email')
@@ -21,8 +21,13 @@ class UnknownIDError(PlateMapperError):
     """Exception for error when an object does not exists in the DB"""
     def __init__(self, missing_id, table):
         super(UnknownIDError, self).__init__()
-        self.args = ("The object with ID '%s' does not exist in table '%s'"
-                     % (missing_id, table),)
+        if isinstance(missing_id, (list, tuple)):
+            self.args = ("The objects with IDs %s do not exist in table '%s'"
+                         % (', '.join("'%s'" % i for i in missing_id),
+                            table),)
+        else:
+            self.args = ("The object with ID '%s' does not exist in table "
+                         "'%s'" % (missing_id, table),)
 
 
 class DuplicateError(PlateMapperError):
@@ -44,3 +49,10 @@ class EditError(PlateMapperError):
         super(EditError, self).__init__()
         self.args = ("The object with ID '%s' is finalized and can not be "
                      "edited" % str(id_),)
+
+
+class QueryBudgetError(PlateMapperError, AssertionError):
+    """Exception for error when more queries than budgeted are executed"""
+    def __init__(self, report):
+        super(QueryBudgetError, self).__init__()
+        self.args = ("Query budget exceeded: %s" % report,)
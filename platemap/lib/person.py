@@ -11,7 +11,10 @@ import platemap as pm
 
 
 class Person(pm.base.PMObject):
+    __slots__ = ()
     _table = 'person'
+    _editable = {'name': 'name', 'email': 'email', 'address': 'address',
+                 'affiliation': 'affiliation', 'phone': 'phone'}
 
     @classmethod
     def create(cls, name, email, address=None, affiliation=None, phone=None):
@@ -127,7 +130,9 @@ class Person(pm.base.PMObject):
 
 
 class User(pm.base.PMObject):
+    __slots__ = ()
     _table = 'user'
+    _id_type = str
 
     @classmethod
     def create(cls, username, password, name, email, address=None,
@@ -334,6 +339,7 @@ class User(pm.base.PMObject):
             add = [a for a in actions if not self.check_access(a)]
             if add:
                 pm.sql.TRN.add(sql, [tuple(add), self.id])
+                self.refresh()
 
     def remove_access(self, actions):
         """Removes ability for user to do action
@@ -354,3 +360,4 @@ class User(pm.base.PMObject):
             remove = [a for a in actions if self.check_access(a)]
             if remove:
                 pm.sql.TRN.add(sql, [tuple(remove), self.id])
+                self.refresh()
@@ -5,11 +5,48 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+import numpy as np
+
 import platemap as pm
 
 
+PlateLayout = namedtuple('PlateLayout', ['ids', 'names', 'barcodes'])
+PlateLayout.__doc__ = """The samples in the wells of a plate
+
+Each attribute is an array with the shape of the plate, indexed as
+``[row, col]``.
+
+Attributes
+----------
+ids : np.ndarray of int
+    The id of the sample in each well, -1 if the well is empty
+names : np.ndarray of object
+    The name of the sample in each well, None if the well is empty
+barcodes : np.ndarray of object
+    The barcode of the sample in each well, None if the well is empty or the
+    sample has no barcode
+"""
+
+# Rendered HTML of the plates, keyed by (plate id, plate version)
+_HTML_CACHE = OrderedDict()
+_HTML_CACHE_SIZE = 1000
+_HTML_CACHE_LOCK = Lock()
+
+
 class Plate(pm.base.PMObject):
+    __slots__ = ()
     _table = 'plate'
+    _id_type = str
+    _relations = {
+        'samples': pm.base.Relation(
+            """SELECT plate_id, sample_id
+               FROM barcodes.plates_samples
+               WHERE plate_id = ANY(%s)
+               ORDER BY plate_row, plate_col""",
+            lambda: pm.sample.Sample, True)}
 
     @classmethod
     def plates(cls, finalized=False):
@@ -31,7 +68,7 @@ class Plate(pm.base.PMObject):
         sql += " ORDER BY created_on DESC"
         with pm.sql.TRN:
             pm.sql.TRN.add(sql)
-            return [cls(p) for p in pm.sql.TRN.execute_fetchflatten()]
+            return cls.from_ids(pm.sql.TRN.execute_fetchflatten())
 
     @classmethod
     def create(cls, barcode, name, person, rows, cols):
@@ -123,19 +160,44 @@ class Plate(pm.base.PMObject):
         if self.finalized:
             raise pm.exceptions.EditError(self.id)
 
+    @staticmethod
+    def _is_well(pos):
+        """Whether a position is a single (row, col) well"""
+        return isinstance(pos, tuple) and len(pos) == 2 and \
+            all(isinstance(p, (int, np.integer)) for p in pos)
+
+    def _wells(self, pos):
+        """Positions of the wells selected by a NumPy index
+
+        Parameters
+        ----------
+        pos : object
+            Any index valid for an array with the shape of the plate
+
+        Returns
+        -------
+        np.ndarray of int, np.ndarray of int
+            The rows and the columns of the wells selected, with the shape of
+            the selection
+        """
+        rows, cols = np.indices(self.shape)
+        return rows[pos], cols[pos]
+
     def __getitem__(self, pos):
         """
-        Returns the sample at a given position on the plate
+        Returns the samples at a given position or region of the plate
 
         Parameters
         ----------
-        pos : tuple of int
-            The plate well to get sample for
+        pos : tuple of int or NumPy index
+            The plate well to get the sample for, or any index valid for an
+            array with the shape of the plate, such as slices or boolean masks
 
         Returns
         -------
-        Sample object or None
-            Sample at the positon, or None if no sample.
+        Sample object or None, or np.ndarray of object
+            Sample at the positon, or None if no sample. For regions, an array
+            with the samples of the wells selected
 
         Raises
         ------
@@ -144,72 +206,182 @@ class Plate(pm.base.PMObject):
 
         Notes
         -----
-        Passed a tuple, so called as sample = plate[row, col]
+        Passed a tuple, so called as sample = plate[row, col] or
+        samples = plate[:, 3]. Either way, the samples are read in a single
+        query. The ids of a region can be read with ``plate.layout.ids[pos]``
         """
-        sql = """SELECT sample_id
-                 FROM barcodes.plates_samples
-                 WHERE plate_id = %s AND plate_row = %s and plate_col = %s
-              """
-        with pm.sql.TRN:
-            row, col = pos[0], pos[1]
-            rows, cols = self.shape
-            if row < 0 or row >= rows or col < 0 or col >= cols:
-                raise IndexError('Position %d, %d not on plate' % (row, col))
+        # The shape of the plate is read with the samples, so the position
+        # can be checked without another query
+        well_sql = """SELECT "rows", cols, sample.*
+                      FROM barcodes.plate p
+                      LEFT JOIN barcodes.plates_samples ps
+                          ON ps.plate_id = p.plate_id AND plate_row = %s
+                              AND plate_col = %s
+                      LEFT JOIN barcodes.sample USING (sample_id)
+                      WHERE p.plate_id = %s
+                   """
+        plate_sql = """SELECT "rows", cols, plate_row, plate_col, sample.*
+                       FROM barcodes.plate
+                       LEFT JOIN barcodes.plates_samples USING (plate_id)
+                       LEFT JOIN barcodes.sample USING (sample_id)
+                       WHERE plate_id = %s
+                    """
+        if self._is_well(pos):
+            # NumPy integers can not be passed to the database
+            row, col = int(pos[0]), int(pos[1])
+            with pm.sql.TRN:
+                pm.sql.TRN.add(well_sql, [row, col, self.id])
+                found = dict(
+                    pm.sql.TRN.execute_fetchindex(cursor_mode='dict')[0])
+                rows, cols = found.pop('rows'), found.pop('cols')
+                if row < 0 or row >= rows or col < 0 or col >= cols:
+                    raise IndexError(
+                        'Position %d, %d not on plate' % (row, col))
+                if found['sample_id'] is None:
+                    return None
+                return pm.sample.Sample._from_rows([found])[0]
 
-            pm.sql.TRN.add(sql, [self.id, row, col])
-            sid = pm.sql.TRN.execute_fetchlast()
-            return None if sid is None else pm.sample.Sample(sid)
+        with pm.sql.TRN:
+            pm.sql.TRN.add(plate_sql, [self.id])
+            wells = [dict(w) for w in
+                     pm.sql.TRN.execute_fetchindex(cursor_mode='dict')]
+            samples = np.full((wells[0]['rows'], wells[0]['cols']), None,
+                              dtype=object)
+            # The plate is returned once with no well if it is empty
+            wells = [w for w in wells if w['sample_id'] is not None]
+            positions = [(w.pop('plate_row'), w.pop('plate_col'))
+                         for w in wells]
+            for w in wells:
+                del w['rows'], w['cols']
+            for position, sample in zip(
+                    positions, pm.sample.Sample._from_rows(wells)):
+                samples[position] = sample
+        return samples[pos]
 
     def __setitem__(self, pos, value):
         """
-        Adds the sample at a given position on the plate
+        Adds the samples at a given position or region of the plate
 
         Parameters
         ----------
-        pos : tuple of int
-            The plate well to add sample at
-        value : Sample object or None
-            The sample to add, or None to remove sample from position
+        pos : tuple of int or NumPy index
+            The plate well to add sample at, or any index valid for an array
+            with the shape of the plate, such as slices or boolean masks
+        value : Sample object or None, or array_like of them
+            The sample to add, or None to remove sample from position. For
+            regions, the samples of the wells selected, or a single one for
+            all of them
 
         Raises
         ------
         IndexError
             Position given is outside of plate
+        ValueError
+            The samples given do not match the shape of the region
 
         Notes
         -----
-        Passed a tuple, so called as plate[row, col] = Sample()
+        Passed a tuple, so called as plate[row, col] = Sample() or
+        plate[:, 3] = [Sample(), ...]
         """
-        # Need to get around postgres not having upsert in postgres < 9.5
-        # So do this slightly hacky workaround
-        # http://www.the-art-of-web.com/sql/upsert/
-        upsert_sql = """WITH upsert AS (
-                            UPDATE barcodes.plates_samples
-                            SET sample_id = %s
-                            WHERE plate_id = %s AND plate_row = %s
-                                AND plate_col = %s
-                            RETURNING *)
-                        INSERT INTO barcodes.plates_samples
-                        (sample_id, plate_id, plate_row, plate_col)
-                        SELECT %s, %s, %s, %s WHERE NOT EXISTS (
-                            SELECT * FROM upsert)
-              """
-        delete_sql = """DELETE FROM barcodes.plates_samples
-                        WHERE plate_id = %s AND plate_row = %s
-                            AND plate_col = %s"""
+        if self._is_well(pos):
+            self.assign({(int(pos[0]), int(pos[1])): value})
+            return
+
+        rows, cols = self._wells(pos)
+        values = np.empty(rows.shape, dtype=object)
+        values[...] = value
+        self.assign(dict(zip(zip(rows.ravel().tolist(),
+                                 cols.ravel().tolist()), values.ravel())))
 
+    def assign(self, wells):
+        """Adds or removes the samples of many wells at once
+
+        Parameters
+        ----------
+        wells : dict of {tuple of int: Sample object or None}
+            The sample to add at each (row, col) well, or None to remove the
+            sample from the well
+
+        Raises
+        ------
+        IndexError
+            Any of the positions given is outside of plate
+        EditError
+            The plate is finalized
+
+        Notes
+        -----
+        All the samples are added in a single upsert and all the removals
+        are done in a single delete, whatever the number of wells. Both
+        statements also change the version of the plate.
+        """
+        bump_sql = """WITH bumped AS (
+                         UPDATE barcodes.plate
+                         SET version = nextval('barcodes.plate_version_seq')
+                         WHERE plate_id = %s)
+                   """
+        # Both statements return the samples taken out of the wells
+        upsert_sql = bump_sql + """,
+                        wells AS (
+                            SELECT * FROM unnest(%s::smallint[],
+                                                 %s::smallint[],
+                                                 %s::bigint[])
+                                AS w (plate_row, plate_col, sample_id)),
+                        replaced AS (
+                            SELECT ps.sample_id
+                            FROM barcodes.plates_samples ps
+                            JOIN wells USING (plate_row, plate_col)
+                            WHERE ps.plate_id = %s),
+                        upserted AS (
+                            INSERT INTO barcodes.plates_samples
+                            (plate_id, plate_row, plate_col, sample_id)
+                            SELECT %s, * FROM wells
+                            ON CONFLICT (plate_id, plate_row, plate_col)
+                            DO UPDATE SET sample_id = EXCLUDED.sample_id)
+                        SELECT sample_id FROM replaced
+                     """
+        delete_sql = bump_sql + """DELETE FROM barcodes.plates_samples
+                        WHERE plate_id = %s
+                            AND (plate_row, plate_col) IN (
+                                SELECT * FROM unnest(%s::smallint[],
+                                                     %s::smallint[]))
+                        RETURNING sample_id
+                     """
+        # NumPy integers can not be passed to the database
+        wells = {(int(row), int(col)): value
+                 for (row, col), value in wells.items()}
         with pm.sql.TRN:
             self._check_finalized()
-            row, col = pos[0], pos[1]
             rows, cols = self.shape
-            if row < 0 or row >= rows or col < 0 or col >= cols:
-                raise IndexError('Position %d, %d not on plate' % (row, col))
-
-            if value is not None:
-                pm.sql.TRN.add(upsert_sql, [value.id, self.id, row, col,
-                                            value.id, self.id, row, col])
-            else:
-                pm.sql.TRN.add(delete_sql, [self.id, row, col])
+            for row, col in wells:
+                if row < 0 or row >= rows or col < 0 or col >= cols:
+                    raise IndexError(
+                        'Position %d, %d not on plate' % (row, col))
+
+            added = [(row, col, value.id)
+                     for (row, col), value in wells.items()
+                     if value is not None]
+            removed = [pos for pos, value in wells.items() if value is None]
+            taken_out = set()
+            if added:
+                pm.sql.TRN.add(upsert_sql, [self.id] +
+                               [list(column) for column in zip(*added)] +
+                               [self.id, self.id])
+                taken_out.update(pm.sql.TRN.execute_fetchflatten())
+            if removed:
+                pm.sql.TRN.add(delete_sql, [self.id, self.id] +
+                               [list(column) for column in zip(*removed)])
+                taken_out.update(pm.sql.TRN.execute_fetchflatten())
+            # The samples taken out of the wells not loaded in the transaction
+            # have nothing to refresh
+            samples = [pm.sql.TRN.get_object(pm.sample.Sample, sid)
+                       for sid in taken_out]
+            samples.extend(wells.values())
+            for sample in samples:
+                if sample is not None:
+                    sample.refresh()
+            self.refresh()
 
     @property
     def name(self):
@@ -233,6 +405,18 @@ class Plate(pm.base.PMObject):
         """
         return self._get_property('finalized')
 
+    @property
+    def version(self):
+        """Version of the plate, changed every time the plate is edited
+
+        Returns
+        -------
+        int
+            Version of the plate. It changes when samples are added or removed
+            and when the plate is finalized or reverted, and is never reused
+        """
+        return self._get_property('version')
+
     @property
     def shape(self):
         """Shaple of the plate
@@ -242,10 +426,7 @@ class Plate(pm.base.PMObject):
         tuple of int
             Plate dimensions in the form (rows, cols)
         """
-        sql = "SELECT rows, cols FROM barcodes.plate WHERE plate_id = %s"
-        with pm.sql.TRN:
-            pm.sql.TRN.add(sql, [self.id])
-            return tuple(pm.sql.TRN.execute_fetchindex()[0])
+        return self._get_property('rows'), self._get_property('cols')
 
     @property
     def samples(self):
@@ -257,15 +438,41 @@ class Plate(pm.base.PMObject):
             Samples on the plate, ordered by row.
             Sample at [0, 0], followed by [0, 1], [0, 2], etc.
         """
-        sql = """SELECT sample_id
-                 FROM barcodes.plates_samples
+        return self._get_relation('samples')
+
+    @property
+    def layout(self):
+        """The samples in the wells of the plate, read in a single query
+
+        Returns
+        -------
+        PlateLayout
+            Arrays with the ids, names and barcodes of the samples in each
+            well of the plate
+        """
+        sql = """SELECT "rows", cols, plate_row, plate_col, sample_id, sample,
+                     barcode
+                 FROM barcodes.plate
+                 LEFT JOIN barcodes.plates_samples USING (plate_id)
+                 LEFT JOIN barcodes.sample USING (sample_id)
                  WHERE plate_id = %s
-                 ORDER BY plate_row, plate_col
               """
         with pm.sql.TRN:
             pm.sql.TRN.add(sql, [self.id])
-            return [pm.sample.Sample(s) for s in
-                    pm.sql.TRN.execute_fetchflatten()]
+            wells = pm.sql.TRN.execute_fetchindex(cursor_mode='tuple')
+        shape = tuple(wells[0][:2])
+        ids = np.full(shape, -1, dtype=np.int64)
+        names = np.full(shape, None, dtype=object)
+        barcodes = np.full(shape, None, dtype=object)
+        # The plate is returned once with no well if it is empty
+        filled = [w[2:] for w in wells if w[4] is not None]
+        if filled:
+            rows, cols, sample_ids, sample_names, sample_barcodes = zip(
+                *filled)
+            ids[rows, cols] = sample_ids
+            names[rows, cols] = sample_names
+            barcodes[rows, cols] = sample_barcodes
+        return PlateLayout(ids, names, barcodes)
 
     @property
     def platemap(self):
@@ -276,26 +483,11 @@ class Plate(pm.base.PMObject):
         list of list of Sample objects or None
             Samples on the plate, with None if no sample at the position
         """
-        sql = """SELECT plate_row::varchar || plate_col::varchar, sample_id
-                 FROM barcodes.plates_samples
-                 WHERE plate_id = %s
-                 ORDER BY plate_row, plate_col
-              """
-        with pm.sql.TRN:
-            rows, cols = self.shape
-            pm.sql.TRN.add(sql, [self.id])
-            # Turn the returned rows into a dict keyed to the combined
-            # rowcol created by the sql query
-            samples = dict(pm.sql.TRN.execute_fetchindex())
-            ret = []
-            # Loop over each sample and add None of no sample in position
-            for r in range(rows):
-                ret.append([])
-                for c in range(cols):
-                    samp = samples.get('%d%d' % (r, c), None)
-                    ret[r].append(pm.sample.Sample(samp)
-                                  if samp is not None else None)
-            return ret
+        ids = self.layout.ids.tolist()
+        sample_ids = sorted({sid for row in ids for sid in row if sid >= 0})
+        samples = dict(zip(sample_ids,
+                           pm.sample.Sample.from_ids(sample_ids)))
+        return [[samples.get(sid) for sid in row] for row in ids]
 
     # -------- functions ----------------
     def to_html(self):
@@ -308,11 +500,19 @@ class Plate(pm.base.PMObject):
 
         Notes
         -----
-        The class `plate` is added to the table for css styling.
+        The class `plate` is added to the table for css styling. The HTML is
+        cached by plate version, so it is only built again after the plate
+        is edited.
         """
-
-        samples = self.platemap
-        rows, cols = self.shape
+        key = (self.id, self.version)
+        with _HTML_CACHE_LOCK:
+            html = _HTML_CACHE.get(key)
+            if html is not None:
+                _HTML_CACHE.move_to_end(key)
+                return html
+
+        names = self.layout.names
+        rows, cols = names.shape
         table = ['<table class="plate"><tr><th></th>']
         # Add column header
         for col in range(1, cols + 1):
@@ -320,19 +520,27 @@ class Plate(pm.base.PMObject):
         table.append('</tr>')
         for row in range(rows):
             table.append('<tr><th>%s</th>' % chr(65 + row))
-            for col in range(cols):
-                samp = samples[row][col]
+            for name in names[row]:
                 table.append('<td>%s</td>' %
-                             samp.name if samp is not None else '<td></td>')
+                             name if name is not None else '<td></td>')
             table.append('</tr>')
         table.append('</table>')
-        return ''.join(table)
+        html = ''.join(table)
+        with _HTML_CACHE_LOCK:
+            _HTML_CACHE[key] = html
+            if len(_HTML_CACHE) > _HTML_CACHE_SIZE:
+                _HTML_CACHE.popitem(last=False)
+        return html
 
     def finalize(self):
         """Finalizes plate by flagging it in the DB"""
-        sql = "UPDATE barcodes.plate SET finalized = 'T' WHERE plate_id = %s"
+        sql = """UPDATE barcodes.plate
+                 SET finalized = 'T',
+                     version = nextval('barcodes.plate_version_seq')
+                 WHERE plate_id = %s"""
         with pm.sql.TRN:
             pm.sql.TRN.add(sql, [self.id])
+            self.refresh()
 
     def revert(self, user):
         """Reverts the plate from finalized to editable
@@ -351,6 +559,10 @@ class Plate(pm.base.PMObject):
         if not user.check_access('Admin'):
             raise pm.exceptions.AssignError('User %s is not admin!' % user)
 
-        sql = "UPDATE barcodes.plate SET finalized = 'F' WHERE plate_id = %s"
+        sql = """UPDATE barcodes.plate
+                 SET finalized = 'F',
+                     version = nextval('barcodes.plate_version_seq')
+                 WHERE plate_id = %s"""
         with pm.sql.TRN:
             pm.sql.TRN.add(sql, [self.id])
+            self.refresh()
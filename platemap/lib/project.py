@@ -9,7 +9,9 @@ import platemap as pm
 
 
 class Project(pm.base.PMObject):
+    __slots__ = ()
     _table = 'project'
+    _editable = {'pi': 'pi', 'contact': 'contact_person'}
 
     @classmethod
     def projects(cls):
@@ -23,7 +25,7 @@ class Project(pm.base.PMObject):
         sql = "SELECT project_id FROM barcodes.project ORDER BY project"
         with pm.sql.TRN:
             pm.sql.TRN.add(sql)
-            return [cls(p) for p in pm.sql.TRN.execute_fetchflatten()]
+            return cls.from_ids(pm.sql.TRN.execute_fetchflatten())
 
     @staticmethod
     def all_sample_sets():
@@ -40,7 +42,31 @@ class Project(pm.base.PMObject):
             return pm.sql.TRN.execute_fetchflatten()
 
     @staticmethod
-    def assign_barcodes(sample_set, num_barcodes):
+    def _assign_barcodes(sample_set_id, num_barcodes):
+        """Claims unassigned barcodes and assigns them to a sample set
+
+        Parameters
+        ----------
+        sample_set_id : int
+            The id of the sample set to assign barcodes to
+        num_barcodes : int
+            Number of barcodes to assign
+
+        Returns
+        -------
+        int
+            Number of barcodes assigned
+
+        Raises
+        ------
+        ValueError
+            Number of barcodes requested excededs number of unassigned
+            barcodes
+        """
+        return len(pm.util.allocate_barcodes(num_barcodes, sample_set_id))
+
+    @classmethod
+    def assign_barcodes(cls, sample_set, num_barcodes):
         """Assigns barcodes to a sample set
 
         Parameters
@@ -49,16 +75,21 @@ class Project(pm.base.PMObject):
             The sample set in the project to assign barcodes to.
         num_barcodes : int
             Number of barcodes to assign to the project
+
+        Returns
+        -------
+        int
+            Number of barcodes assigned
+
+        Raises
+        ------
+        ValueError
+            Number of barcodes requested excededs number of unassigned
+            barcodes
         """
-        sql = """INSERT INTO barcodes.sample_set_barcodes
-                 (sample_set_id, barcode)
-                 VALUES (%s, %s)
-              """
         with pm.sql.TRN:
             sample_set_id = pm.util.convert_to_id(sample_set, 'sample_set')
-            pm.sql.TRN.add(sql, [(sample_set_id, b) for b in
-                                 pm.util.get_barcodes(num_barcodes)],
-                           many=True)
+            return cls._assign_barcodes(sample_set_id, num_barcodes)
 
     @classmethod
     def create(cls, project, description, person, pi, contact_person,
@@ -91,21 +122,17 @@ class Project(pm.base.PMObject):
         ------
         DuplicateError
             Project with same name already exists
+        ValueError
+            Number of barcodes requested excededs number of unassigned
+            barcodes
         """
         if cls.exists(project):
             raise pm.exceptions.DuplicateError(project, 'project')
-        if num_barcodes is not None:
-            barcodes = pm.util.get_barcodes(num_barcodes)
-
         project_sql = """INSERT INTO barcodes.project
                          (project, pi, description, contact_person)
                          VALUES (%s, %s, %s, %s)
                          RETURNING project_id
                       """
-        project_bc_sql = """INSERT INTO barcodes.sample_set_barcodes
-                            (sample_set_id, barcode)
-                            values (%s, %s)
-                         """
         sample_set_sql = """INSERT INTO barcodes.sample_set
                             (sample_set, created_by)
                             VALUES (%s, %s)
@@ -115,18 +142,18 @@ class Project(pm.base.PMObject):
                                  (project_id, sample_set_id)
                                  VALUES (%s, %s)
                               """
-        with pm.sql.TRN:
+        with pm.sql.TRN.atomic():
             pm.sql.TRN.add(project_sql, [project, pi, description,
                                          contact_person])
             project_id = pm.sql.TRN.execute_fetchlast()
             pm.sql.TRN.add(sample_set_sql, [sample_set, person.id])
             sample_set_id = pm.sql.TRN.execute_fetchlast()
             pm.sql.TRN.add(proj_sample_set_sql, [project_id, sample_set_id])
+            pm.util.invalidate_lookup('project')
+            pm.util.invalidate_lookup('sample_set')
 
             if num_barcodes is not None:
-                pm.sql.TRN.add(project_bc_sql,
-                               [(sample_set_id, b) for b in barcodes],
-                               many=True)
+                cls._assign_barcodes(sample_set_id, num_barcodes)
 
         return cls(project_id)
 
@@ -191,11 +218,12 @@ class Project(pm.base.PMObject):
               """
         with pm.sql.TRN:
             pm.sql.TRN.add(sql, [self.id, self.id, self.id])
-            ret = {}
-            for row in pm.sql.TRN.execute_fetchindex():
-                ret[row['sample_set']] = [pm.sample.Sample(s)
-                                          for s in row['samps']]
-            return ret
+            sets = pm.sql.TRN.execute_fetchindex(cursor_mode='tuple')
+            # Instantiate the samples of all the sets at once
+            samples = iter(pm.sample.Sample.from_ids(
+                [s for _, samps in sets for s in samps]))
+            return {sample_set: [next(samples) for _ in samps]
+                    for sample_set, samps in sets}
 
     @property
     def sample_sets(self):
@@ -281,6 +309,7 @@ class Project(pm.base.PMObject):
             pm.sql.TRN.add(sql1, [sample_set, person.id])
             sample_set_id = pm.sql.TRN.execute_fetchlast()
             pm.sql.TRN.add(sql2, [self.id, sample_set_id])
+            pm.util.invalidate_lookup('sample_set')
 
     def remove_sample_set(self, sample_set):
         """Remove a sample set to the project
@@ -317,13 +346,28 @@ class Project(pm.base.PMObject):
 
     def clear_barcodes(self):
         """Clears all remaining unused barcodes from the project's sample sets
+
+        Returns
+        -------
+        int
+            Number of barcodes cleared
         """
-        sql = """DELETE FROM barcodes.sample_set_barcodes ssb
-                 USING barcodes.project_sample_sets pss
-                 WHERE pss.sample_set_id = ssb.sample_set_id
-                 AND barcode NOT IN (
-                     SELECT barcode FROM barcodes.sample
-                     WHERE barcode IS NOT NULL)
-                 AND pss.project_id = %s"""
+        # The barcodes cleared are released so they can be allocated again
+        sql = """WITH cleared AS (
+                     DELETE FROM barcodes.sample_set_barcodes ssb
+                     USING barcodes.project_sample_sets pss
+                     WHERE pss.sample_set_id = ssb.sample_set_id
+                     AND barcode NOT IN (
+                         SELECT barcode FROM barcodes.sample
+                         WHERE barcode IS NOT NULL)
+                     AND pss.project_id = %s
+                     RETURNING barcode),
+                 released AS (
+                     UPDATE barcodes.barcode
+                     SET assigned_on = NULL
+                     WHERE barcode IN (SELECT barcode FROM cleared)
+                     AND barcode NOT IN (SELECT plate_id FROM barcodes.plate))
+                 SELECT count(*) FROM cleared"""
         with pm.sql.TRN:
             pm.sql.TRN.add(sql, [self.id])
+            return pm.sql.TRN.execute_fetchlast()
@@ -9,8 +9,27 @@ import platemap as pm
 
 
 class ProtocolBase(pm.base.PMObject):
+    # The snapshot of the subtable row, kept like the row of the object
+    __slots__ = ('_subrow', '_subrow_epoch')
+
     _table = 'protocol_settings'
     _subtable = None
+    _relations = {
+        'sample': pm.base.Relation(
+            """SELECT protocol_settings_id, sample_id
+               FROM barcodes.protocol_settings
+               WHERE protocol_settings_id = ANY(%s)""",
+            lambda: pm.sample.Sample, False),
+        'plate': pm.base.Relation(
+            """SELECT protocol_settings_id, plate_id
+               FROM barcodes.protocol_settings
+               WHERE protocol_settings_id = ANY(%s)""",
+            lambda: pm.plate.Plate, False),
+        'created_by': pm.base.Relation(
+            """SELECT protocol_settings_id, created_by
+               FROM barcodes.protocol_settings
+               WHERE protocol_settings_id = ANY(%s)""",
+            lambda: pm.person.Person, False)}
 
     @classmethod
     def protocols(cls):
@@ -25,7 +44,31 @@ class ProtocolBase(pm.base.PMObject):
             cls._subtable)
         with pm.sql.TRN:
             pm.sql.TRN.add(sql)
-            return [cls(p) for p in pm.sql.TRN.execute_fetchflatten()]
+            return cls.from_ids(pm.sql.TRN.execute_fetchflatten())
+
+    @classmethod
+    def _check_ids(cls, ids):
+        r"""Check which of the provided IDs actually exist on the subtable
+
+        Parameters
+        ----------
+        ids : list of object
+            The IDs to test
+
+        Returns
+        -------
+        dict of {object: dict}
+            The rows of the IDs that exist, joined with the subtable, keyed
+            by ID
+        """
+        sql = """SELECT *
+                 FROM barcodes.protocol_settings
+                 JOIN barcodes.{0} USING (protocol_settings_id)
+                 WHERE protocol_settings_id = ANY(%s)""".format(cls._subtable)
+        with pm.sql.TRN:
+            pm.sql.TRN.add(sql, [list(ids)])
+            return {row['protocol_settings_id']: dict(row) for row in
+                    pm.sql.TRN.execute_fetchindex(cursor_mode='dict')}
 
     @staticmethod
     def _create_protocol(person, sample=None, plate=None):
@@ -80,23 +123,39 @@ class ProtocolBase(pm.base.PMObject):
         if self._subtable is None:
             raise pm.exceptions.DeveloperError('No subtable given!')
 
-        sql = """Select {0}
-                 FROM barcodes.{1}
-                 WHERE protocol_settings_id = %s""".format(
-            column, self._subtable)
+        # The subtable row is kept like the row of the object, see _get_row
+        sql = """SELECT *
+                 FROM barcodes.{0}
+                 WHERE protocol_settings_id = %s""".format(self._subtable)
         with pm.sql.TRN:
-            pm.sql.TRN.add(sql, [self.id])
-            return pm.sql.TRN.execute_fetchlast()
+            epoch = pm.sql.TRN.identity_epoch
+            if self._subrow is None or self._subrow_epoch != epoch:
+                pm.sql.TRN.add(sql, [self.id])
+                self._subrow = dict(
+                    pm.sql.TRN.execute_fetchindex(cursor_mode='dict')[0])
+                self._subrow_epoch = epoch
+            return self._subrow[column]
+
+    def _set_row(self, row, epoch):
+        """See parent class for docstring"""
+        super(ProtocolBase, self)._set_row(row, epoch)
+        # Rows read by the subclasses include the subtable
+        if self._subtable is not None:
+            self._subrow = row
+            self._subrow_epoch = epoch
+
+    def refresh(self):
+        """See parent class for docstring"""
+        super(ProtocolBase, self).refresh()
+        self._subrow = None
 
     @property
     def sample(self):
-        sid = self._get_property('sample_id')
-        return pm.sample.Sample(sid) if sid is not None else None
+        return self._get_relation('sample')
 
     @property
     def plate(self):
-        pid = self._get_property('plate_id')
-        return pm.plate.Plate(pid) if pid is not None else None
+        return self._get_relation('plate')
 
     @property
     def created_on(self):
@@ -104,7 +163,7 @@ class ProtocolBase(pm.base.PMObject):
 
     @property
     def created_by(self):
-        return pm.person.Person(self._get_property('created_by'))
+        return self._get_relation('created_by')
 
     def summary(self):
         """Returns dict of settings for object
@@ -129,7 +188,7 @@ class ProtocolBase(pm.base.PMObject):
               """.format(self._subtable)
         with pm.sql.TRN:
             pm.sql.TRN.add(sql, [self.id])
-            info = dict(pm.sql.TRN.execute_fetchindex()[0])
+            info = dict(pm.sql.TRN.execute_fetchindex(cursor_mode='dict')[0])
 
             # Clean person, plate, and sample ids to their objects
             info['created_by'] = pm.person.Person(info['created_by'])
@@ -147,6 +206,7 @@ class ProtocolBase(pm.base.PMObject):
 
 
 class ExtractionProtocol(ProtocolBase):
+    __slots__ = ()
     _subtable = 'extraction_settings'
 
     def _check_id(self, id_):
@@ -214,7 +274,21 @@ class ExtractionProtocol(ProtocolBase):
 
 
 class PCRProtocol(ProtocolBase):
+    __slots__ = ()
     _subtable = 'pcr_settings'
+    _relations = dict(ProtocolBase._relations, **{
+        'extraction_protocol': pm.base.Relation(
+            """SELECT protocol_settings_id, extraction_protocol_settings_id
+               FROM barcodes.pcr_settings
+               WHERE protocol_settings_id = ANY(%s)""",
+            lambda: ExtractionProtocol, False),
+        'primer_set': pm.base.Relation(
+            """SELECT protocol_settings_id, primer_set
+               FROM barcodes.pcr_settings
+               JOIN barcodes.primer_set_lots USING (primer_lot)
+               JOIN barcodes.primer_set USING (primer_set_id)
+               WHERE protocol_settings_id = ANY(%s)""",
+            None, False)})
 
     def _check_id(self, id_):
         r"""Check that the provided ID actually exists on the subtable
@@ -253,8 +327,7 @@ class PCRProtocol(ProtocolBase):
 
     @property
     def extraction_protocol(self):
-        return ExtractionProtocol(
-            self._get_subproperty('extraction_protocol_settings_id'))
+        return self._get_relation('extraction_protocol')
 
     @property
     def primer_lot(self):
@@ -262,15 +335,7 @@ class PCRProtocol(ProtocolBase):
 
     @property
     def primer_set(self):
-        sql = """SELECT primer_set
-                 FROM barcodes.pcr_settings
-                 JOIN barcodes.primer_set_lots USING (primer_lot)
-                 JOIN barcodes.primer_set USING (primer_set_id)
-                 WHERE protocol_settings_id = %s
-              """
-        with pm.sql.TRN:
-            pm.sql.TRN.add(sql, [self.id])
-            return pm.sql.TRN.execute_fetchlast()
+        return self._get_relation('primer_set')
 
     @property
     def mastermix_lot(self):
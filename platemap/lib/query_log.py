@@ -0,0 +1,381 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2016--, The Plate Mapper Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+import logging
+import re
+from collections import Counter, deque, namedtuple
+from contextvars import ContextVar
+from functools import lru_cache
+from threading import Lock
+from time import time
+
+from platemap.lib.config_manager import pm_config
+from platemap.lib.exceptions import QueryBudgetError
+
+
+QueryRecord = namedtuple('QueryRecord', ['sql', 'duration', 'rows',
+                                         'executions', 'timestamp'])
+QueryRecord.__doc__ = """A statement executed by a transaction
+
+Attributes
+----------
+sql : str
+    The normalized SQL of the statement
+duration : float
+    Wall time, in seconds, spent executing the statement
+rows : int
+    Number of rows retrieved or affected by the statement, -1 if unknown
+executions : int
+    Number of times the statement was executed, more than one for batches
+timestamp : float
+    Time at which the statement finished executing
+"""
+
+QueryStats = namedtuple('QueryStats', ['executions', 'total_time', 'max_time',
+                                       'rows'])
+QueryStats.__doc__ = """Aggregated statistics of a normalized statement
+
+Attributes
+----------
+executions : int
+    Number of times the statement has been executed
+total_time : float
+    Total wall time, in seconds, spent executing the statement
+max_time : float
+    Maximum wall time, in seconds, spent in a single execution or batch
+rows : int
+    Total number of rows retrieved or affected by the statement, not counting
+    the executions where it is unknown
+"""
+
+_LITERALS_RE = re.compile(
+    r"'(?:[^']|'')*'"                 # quoted strings
+    r"|%\([^)]+\)s|%s"                # query arguments
+    r"|\b\d+(?:\.\d+)?\b")            # numbers
+_IN_LISTS_RE = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)',
+                          re.IGNORECASE)
+_SPACES_RE = re.compile(r'\s+')
+
+# Query counters active in the current context, so each request only counts
+# its own statements, as a tuple so the contexts copied from it are not
+# changed
+_counters = ContextVar('platemap_query_counters', default=())
+# Query counters active in the whole process
+_process_counters = []
+
+
+@lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    """Normalizes a SQL query so equivalent queries can be aggregated
+
+    Parameters
+    ----------
+    sql : str
+        The SQL query
+
+    Returns
+    -------
+    str
+        The query in a single line, with literals and arguments replaced by
+        ``?`` and IN lists of them collapsed into ``IN (?)``
+    """
+    sql = _LITERALS_RE.sub('?', sql)
+    sql = _IN_LISTS_RE.sub('IN (?)', sql)
+    return _SPACES_RE.sub(' ', sql).strip()
+
+
+def redact_args(sql_args):
+    """Describes the arguments of a query without revealing their values
+
+    Parameters
+    ----------
+    sql_args : list, tuple or dict of objects
+        The arguments to the sql query
+
+    Returns
+    -------
+    str
+        The arguments with each value replaced by its type
+    """
+    if sql_args is None:
+        return 'None'
+    if isinstance(sql_args, dict):
+        return '{%s}' % ', '.join('%r: <%s>' % (k, type(v).__name__)
+                                  for k, v in sorted(sql_args.items()))
+    return '[%s]' % ', '.join('<%s>' % type(v).__name__ for v in sql_args)
+
+
+class RingBufferSink(object):
+    """Query sink keeping the most recent statements in memory
+
+    Parameters
+    ----------
+    size : int, optional
+        Number of statements kept. Default 1000
+    """
+    def __init__(self, size=1000):
+        self._records = deque(maxlen=size)
+
+    def __call__(self, record):
+        self._records.append(record)
+
+    def records(self):
+        """Returns the statements kept, oldest first
+
+        Returns
+        -------
+        list of QueryRecord
+        """
+        return list(self._records)
+
+    def clear(self):
+        """Removes all the statements kept"""
+        self._records.clear()
+
+
+class LoggerSink(object):
+    """Query sink writing every statement to a logger
+
+    Parameters
+    ----------
+    logger : logging.Logger, optional
+        The logger to write to. Defaults to the ``platemap.sql`` logger
+    level : int, optional
+        The level the statements are logged with. Default logging.DEBUG
+    """
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger if logger is not None else \
+            logging.getLogger('platemap.sql')
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(self.level, '%.2f ms, %d rows, %d executions: %s',
+                        record.duration * 1000, record.rows,
+                        record.executions, record.sql)
+
+
+class QueryLog(object):
+    """Collects the timings of the statements executed by the transactions
+
+    Parameters
+    ----------
+    slow_threshold : float, optional
+        Seconds after which a statement is written to the slow query log. If
+        None, the default, there is no slow query log
+    slow_logger : logging.Logger, optional
+        The slow query log. Defaults to the ``platemap.sql.slow`` logger
+
+    Notes
+    -----
+    Sinks are callables that receive a `QueryRecord` for each statement
+    executed, so any function can be used as a callback sink. Aggregated
+    statistics for each normalized statement are always collected, and can be
+    retrieved with `snapshot`.
+    """
+    def __init__(self, slow_threshold=None, slow_logger=None):
+        self.slow_threshold = slow_threshold
+        self.slow_logger = slow_logger if slow_logger is not None else \
+            logging.getLogger('platemap.sql.slow')
+        self._sinks = []
+        self._stats = {}
+        self._lock = Lock()
+
+    def add_sink(self, sink):
+        """Adds a sink receiving every statement executed
+
+        Parameters
+        ----------
+        sink : callable
+            Called with the `QueryRecord` of each statement
+        """
+        self._sinks = self._sinks + [sink]
+
+    def remove_sink(self, sink):
+        """Stops sending the statements executed to a sink
+
+        Parameters
+        ----------
+        sink : callable
+            A sink previously added with `add_sink`
+        """
+        self._sinks = [s for s in self._sinks if s != sink]
+
+    def record(self, sql, sql_args, duration, rows, executions=1):
+        """Records a statement executed
+
+        Parameters
+        ----------
+        sql : str
+            The sql query executed
+        sql_args : list, tuple or dict of objects
+            The arguments of the query, or of the first query of a batch
+        duration : float
+            Wall time, in seconds, spent executing the statement
+        rows : int
+            Number of rows retrieved or affected by the statement, -1 if
+            unknown
+        executions : int, optional
+            Number of times the statement was executed. Default 1
+        """
+        record = QueryRecord(normalize_sql(sql), duration, rows, executions,
+                             time())
+        with self._lock:
+            stats = self._stats.get(record.sql)
+            if stats is None:
+                stats = QueryStats(0, 0.0, 0.0, 0)
+            self._stats[record.sql] = QueryStats(
+                stats.executions + executions, stats.total_time + duration,
+                max(stats.max_time, duration), stats.rows + max(rows, 0))
+
+        if self.slow_threshold is not None and \
+                duration >= self.slow_threshold:
+            self.slow_logger.warning(
+                'Slow query: %.2f ms, %d rows, %d executions\n'
+                'Query: %s\nArguments: %s', duration * 1000, rows, executions,
+                record.sql, redact_args(sql_args))
+
+        for sink in self._sinks:
+            sink(record)
+        for counter in _counters.get():
+            counter._add(record)
+        for counter in _process_counters:
+            counter._add(record)
+
+    def snapshot(self):
+        """Returns the aggregated statistics of the statements executed
+
+        Returns
+        -------
+        dict of {str: QueryStats}
+            The statistics of each normalized statement
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def reset(self):
+        """Discards the aggregated statistics collected so far"""
+        with self._lock:
+            self._stats = {}
+
+
+class QueryCounter(object):
+    """Counts the statements executed while it is active
+
+    Parameters
+    ----------
+    budget : int, optional
+        Maximum number of statements expected. Default no limit
+    repeat_budget : int, optional
+        Maximum number of times a single normalized statement is expected to
+        be executed. Default no limit
+    process_wide : bool, optional
+        Whether to count the statements executed anywhere in the process
+        instead of only the ones of the current context. Default False
+
+    Attributes
+    ----------
+    statements : collections.Counter of {str: int}
+        Number of times each normalized statement has been executed
+
+    Notes
+    -----
+    The counter can be used as a context manager, which raises a
+    `QueryBudgetError` on exit if a budget was exceeded, or be started and
+    stopped explicitly. The statements executed while it is active by the
+    thread or asyncio task that started it, and by the tasks it spawns, are
+    counted, and a batch of statements counts as one. Process wide counters
+    are meant for tests, which make one request at a time.
+    """
+    def __init__(self, budget=None, repeat_budget=None, process_wide=False):
+        self.budget = budget
+        self.repeat_budget = repeat_budget
+        self.process_wide = process_wide
+        self.statements = Counter()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        if exc_type is None:
+            self.check()
+
+    def _add(self, record):
+        self.statements[record.sql] += 1
+
+    def start(self):
+        """Starts counting the statements executed"""
+        if self.process_wide:
+            _process_counters.append(self)
+        else:
+            _counters.set(_counters.get() + (self,))
+
+    def stop(self):
+        """Stops counting the statements executed"""
+        if self in _process_counters:
+            _process_counters.remove(self)
+        _counters.set(tuple(c for c in _counters.get() if c is not self))
+
+    @property
+    def count(self):
+        """Number of statements executed"""
+        return sum(self.statements.values())
+
+    @property
+    def repeated(self):
+        """Normalized statements executed more than once
+
+        Returns
+        -------
+        dict of {str: int}
+            Number of times each of the statements has been executed
+        """
+        return {sql: n for sql, n in self.statements.items() if n > 1}
+
+    def exceeded(self):
+        """Whether any of the budgets has been exceeded
+
+        Returns
+        -------
+        bool
+        """
+        if self.budget is not None and self.count > self.budget:
+            return True
+        return self.repeat_budget is not None and \
+            any(n > self.repeat_budget for n in self.statements.values())
+
+    def check(self):
+        """Checks that the statements executed are within the budgets
+
+        Raises
+        ------
+        QueryBudgetError
+            If any of the budgets has been exceeded
+        """
+        if self.exceeded():
+            raise QueryBudgetError(self.report())
+
+    def report(self):
+        """Summarizes the statements executed
+
+        Returns
+        -------
+        str
+            The number of statements executed, against the budgets, followed
+            by the repeated statements, most repeated first
+        """
+        lines = ['%d queries (budget %s), %d distinct (repeat budget %s)'
+                 % (self.count, self.budget, len(self.statements),
+                    self.repeat_budget)]
+        lines.extend('%6dx %s' % (n, sql) for sql, n in
+                     sorted(self.repeated.items(),
+                            key=lambda x: (-x[1], x[0])))
+        return '\n'.join(lines)
+
+
+QUERY_LOG = QueryLog(pm_config.slow_query_threshold)
@@ -9,7 +9,14 @@ import platemap as pm
 
 
 class Run(pm.base.PMObject):
+    __slots__ = ()
     _table = 'run'
+    _relations = {
+        'pools': pm.base.Relation(
+            """SELECT run_id, pool_id
+               FROM barcodes.run_pools
+               WHERE run_id = ANY(%s)""",
+            lambda: Pool, True)}
 
     @classmethod
     def runs(cls, finalized=False):
@@ -31,7 +38,7 @@ class Run(pm.base.PMObject):
         sql += " ORDER BY run"
         with pm.sql.TRN:
             pm.sql.TRN.add(sql)
-            return [cls(r) for r in pm.sql.TRN.execute_fetchflatten()]
+            return cls.from_ids(pm.sql.TRN.execute_fetchflatten())
 
     @classmethod
     def create(cls, name, person, instrument):
@@ -113,14 +120,11 @@ class Run(pm.base.PMObject):
                  WHERE run_id = %s"""
         with pm.sql.TRN:
             pm.sql.TRN.add(sql, [self.id])
-            return dict(pm.sql.TRN.execute_fetchindex()[0])
+            return dict(pm.sql.TRN.execute_fetchindex(cursor_mode='dict')[0])
 
     @property
     def pools(self):
-        sql = "SELECT pool_id FROM barcodes.run_pools WHERE run_id = %s"
-        with pm.sql.TRN:
-            pm.sql.TRN.add(sql, [self.id])
-            return [Pool(p) for p in pm.sql.TRN.execute_fetchflatten()]
+        return self._get_relation('pools')
 
     @property
     def finalized(self):
@@ -140,6 +144,7 @@ class Run(pm.base.PMObject):
               """
         with pm.sql.TRN:
             pm.sql.TRN.add(sql, [person.id, self.id])
+            self.refresh()
 
     def add_pool(self, pool):
         """Adds a pool to the run
@@ -163,6 +168,8 @@ class Run(pm.base.PMObject):
                  VALUES (%s, %s)"""
         with pm.sql.TRN:
             pm.sql.TRN.add(sql, [self.id, pool.id])
+            self.refresh()
+            pool.refresh()
 
     def remove_pool(self, pool):
         """Removes a pool from the run
@@ -177,6 +184,8 @@ class Run(pm.base.PMObject):
               """
         with pm.sql.TRN:
             pm.sql.TRN.add(sql, [self.id, pool.id])
+            self.refresh()
+            pool.refresh()
 
     def generate_prep_metadata(self):
         """Creates the prep metadata file for the run
@@ -224,8 +233,8 @@ class Run(pm.base.PMObject):
         primer_lots_barcodes = {}
         with pm.sql.TRN:
             pm.sql.TRN.add(protocols_sql, [self.id])
-            for pid in pm.sql.TRN.execute_fetchflatten():
-                protocol = pm.protocol.PCRProtocol(pid)
+            for protocol in pm.protocol.PCRProtocol.from_ids(
+                    pm.sql.TRN.execute_fetchflatten()):
                 protocol_meta = protocol.metadata_summary()
                 meta_keys = set(protocol_meta.keys())
 
@@ -267,7 +276,8 @@ class Run(pm.base.PMObject):
                 primer_lot = meta['primer_lot']
                 if primer_lot not in primer_lots_info:
                     pm.sql.TRN.add(primer_lot_sql, [primer_lot])
-                    info = dict(pm.sql.TRN.execute_fetchindex()[0])
+                    info = dict(pm.sql.TRN.execute_fetchindex(
+                        cursor_mode='dict')[0])
                     primer_lots_barcodes[primer_lot] = info['barcodes']
                     del info['barcodes']
                     primer_lots_info[primer_lot] = info
@@ -299,7 +309,19 @@ class Run(pm.base.PMObject):
 
 
 class Pool(pm.base.PMObject):
+    __slots__ = ()
     _table = 'pool'
+    _relations = {
+        'runs': pm.base.Relation(
+            """SELECT pool_id, run_id
+               FROM barcodes.run_pools
+               WHERE pool_id = ANY(%s)""",
+            lambda: Run, True),
+        'protocols': pm.base.Relation(
+            """SELECT pool_id, protocol_settings_id
+               FROM barcodes.pool_samples
+               WHERE pool_id = ANY(%s)""",
+            lambda: pm.protocol.PCRProtocol, True)}
 
     @classmethod
     def pools(cls, finalized=False):
@@ -320,7 +342,7 @@ class Pool(pm.base.PMObject):
             sql += " WHERE finalized = 'T'"
         with pm.sql.TRN:
             pm.sql.TRN.add(sql)
-            return [cls(p) for p in pm.sql.TRN.execute_fetchflatten()]
+            return cls.from_ids(pm.sql.TRN.execute_fetchflatten())
 
     @classmethod
     def create(cls, name, run, person):
@@ -363,6 +385,7 @@ class Pool(pm.base.PMObject):
             pm.sql.TRN.add(pool_sql, [name, person.id])
             pool_id = pm.sql.TRN.execute_fetchlast()
             pm.sql.TRN.add(run_sql, [run.id, pool_id])
+            run.refresh()
 
     @staticmethod
     def exists(name, run):
@@ -407,20 +430,11 @@ class Pool(pm.base.PMObject):
 
     @property
     def runs(self):
-        sql = "SELECT run_id FROM barcodes.run_pools WHERE pool_id = %s"
-        with pm.sql.TRN:
-            pm.sql.TRN.add(sql, [self.id])
-            return [Run(r) for r in pm.sql.TRN.execute_fetchflatten()]
+        return self._get_relation('runs')
 
     @property
     def protocols(self):
-        sql = """SELECT protocol_settings_id
-                 FROM barcodes.pool_samples
-                 WHERE pool_id = %s"""
-        with pm.sql.TRN:
-            pm.sql.TRN.add(sql, [self.id])
-            return [pm.protocol.PCRProtocol(p) for p in
-                    pm.sql.TRN.execute_fetchflatten()]
+        return self._get_relation('protocols')
 
     @property
     def finalized(self):
@@ -444,6 +458,7 @@ class Pool(pm.base.PMObject):
               """
         with pm.sql.TRN:
             pm.sql.TRN.add(sql, [person.id, self.id])
+            self.refresh()
 
     def add_protocol(self, pcr_protocol):
         """Adds a PCR protocol run to the pool
@@ -484,6 +499,7 @@ class Pool(pm.base.PMObject):
                 raise ValueError('Primer set "%s" already represented in this '
                                  'pool' % pcr_protocol.primer_set)
             pm.sql.TRN.add(insert_sql, [self.id, pcr_protocol.id])
+            self.refresh()
 
     def remove_protocol(self, pcr_protocol):
         """Adds a PCR protocol run to the pool
@@ -507,3 +523,4 @@ class Pool(pm.base.PMObject):
               """
         with pm.sql.TRN:
             pm.sql.TRN.add(sql, [self.id, pcr_protocol.id])
+            self.refresh()
@@ -9,7 +9,27 @@ import platemap as pm
 
 
 class Sample(pm.base.PMObject):
+    __slots__ = ()
     _table = 'sample'
+    _editable = {'sample_type': 'sample_type', 'location': 'sample_location',
+                 'biomass_remaining': 'biomass_remaining'}
+    _relations = {
+        'sample_set': pm.base.Relation(
+            """SELECT sample_id, sample_set
+               FROM barcodes.sample
+               JOIN barcodes.sample_set USING (sample_set_id)
+               WHERE sample_id = ANY(%s)""",
+            None, False),
+        'created_by': pm.base.Relation(
+            """SELECT sample_id, created_by
+               FROM barcodes.sample
+               WHERE sample_id = ANY(%s)""",
+            lambda: pm.person.Person, False),
+        'plates': pm.base.Relation(
+            """SELECT sample_id, plate_id
+               FROM barcodes.plates_samples
+               WHERE sample_id = ANY(%s)""",
+            lambda: pm.plate.Plate, True)}
 
     @staticmethod
     def types():
@@ -45,7 +65,7 @@ class Sample(pm.base.PMObject):
 
     @classmethod
     def from_file(cls, file, sample_type, sample_location, sample_set, person,
-                  projects=None, sep='\t'):
+                  projects=None, sep='\t', errors=None):
         """Loads sample name and barcode from file, suplementing with info
 
         Parameters
@@ -64,6 +84,10 @@ class Sample(pm.base.PMObject):
             What projects the samples are part of. Default None
         sep : str, optional
             Seperator used between the name and barcodes. Default tab
+        errors : list, optional
+            If given, the samples that can not be created are skipped and
+            appended to it as tuples of (line number, sample name, error
+            message). Default None, no sample is created if any of them fails
 
         Returns
         -------
@@ -87,12 +111,29 @@ class Sample(pm.base.PMObject):
         # This just wraps create for each sample so we get all the checks
         # from create but can add multiple samples at a time
         count = 0
-        for line in file:
-            line = line.strip()
-            info = line.split(sep) if barcodes else [line, None]
-            cls.create(info[0], sample_type, sample_location, sample_set,
-                       person, projects=None, barcode=info[barcode_pos])
-            count += 1
+        with pm.sql.TRN.atomic():
+            for line_num, line in enumerate(file, 2):
+                line = line.strip()
+                info = line.split(sep) if barcodes else [line, None]
+                if errors is None:
+                    cls.create(info[0], sample_type, sample_location,
+                               sample_set, person, projects=None,
+                               barcode=info[barcode_pos])
+                    count += 1
+                    continue
+
+                # Each sample is created in its own savepoint, so a failed
+                # sample is rolled back without losing the rest
+                try:
+                    with pm.sql.TRN.savepoint():
+                        cls.create(info[0], sample_type, sample_location,
+                                   sample_set, person, projects=None,
+                                   barcode=info[barcode_pos])
+                except (pm.exceptions.PlateMapperError, ValueError,
+                        LookupError) as e:
+                    errors.append((line_num, info[0], str(e)))
+                else:
+                    count += 1
         return count
 
     @classmethod
@@ -173,8 +214,35 @@ class Sample(pm.base.PMObject):
             sql_where = ' AND '.join(wheres)
             full_sql = '%s %s WHERE %s' % (sql, sql_join, sql_where)
             pm.sql.TRN.add(full_sql, sql_args)
-            return [cls(s) for s in
-                    pm.sql.TRN.execute_fetchflatten()]
+            return cls.from_ids(pm.sql.TRN.execute_fetchflatten())
+
+    @classmethod
+    def from_names(cls, names):
+        """Finds the samples with any of several names with a single query
+
+        Parameters
+        ----------
+        names : iterable of str
+            Sample names to look for
+
+        Returns
+        -------
+        dict of {str: list of Sample objects}
+            The samples with each of the names, ordered by id. Names without
+            any sample are left out
+        """
+        sql = """SELECT sample, array_agg(sample_id ORDER BY sample_id)
+                 FROM barcodes.sample
+                 WHERE sample = ANY(%s)
+                 GROUP BY sample
+              """
+        with pm.sql.TRN:
+            pm.sql.TRN.add(sql, [list(set(names))])
+            found = dict(pm.sql.TRN.execute_fetchindex(cursor_mode='tuple'))
+            samples = iter(cls.from_ids(
+                [sid for ids in found.values() for sid in ids]))
+            return {name: [next(samples) for _ in ids]
+                    for name, ids in found.items()}
 
     @classmethod
     def create(cls, name, sample_type, sample_location, sample_set,
@@ -212,10 +280,6 @@ class Sample(pm.base.PMObject):
             If a barcode is given without pre-assignment, but is already
             used elsewhere
         """
-        test_barcode_sql = """SELECT barcode, sample_set_id
-                              FROM barcodes.sample_set_barcodes
-                              WHERE barcode = %s
-                           """
         rem_barcode_sql = """DELETE FROM barcodes.sample_set_barcodes
                              WHERE barcode = %s AND sample_set_id = %s
                           """
@@ -238,12 +302,13 @@ class Sample(pm.base.PMObject):
 
             sample_set_id = pm.util.convert_to_id(sample_set, 'sample_set')
             if barcode is not None:
-                pm.sql.TRN.add(test_barcode_sql, [barcode])
-                res = pm.sql.TRN.execute_fetchindex()
-                if res:
+                status = pm.util.check_barcodes([barcode])[barcode]
+                if status.status == 'unknown':
+                    raise ValueError(
+                        'Barcode %s does not exist in the DB' % barcode)
+                elif status.status == 'sample_set':
                     # Make sure barcode matches the pre-assigned sample set
-                    barcode, db_sample_set = res[0]
-                    if sample_set_id != db_sample_set:
+                    if sample_set != status.sample_set:
                         raise ValueError('Barcode does not match pre-assigned '
                                          'sample set!')
                     else:
@@ -251,7 +316,7 @@ class Sample(pm.base.PMObject):
                         # attached to a sample
                         pm.sql.TRN.add(rem_barcode_sql,
                                        [barcode, sample_set_id])
-                elif pm.util.check_barcode_assigned(barcode):
+                elif status.status != 'free':
                     raise pm.exceptions.AssignError(
                         'Barcode %s already assigned!' % barcode)
                 pm.sql.TRN.add(barcode_sql, [barcode])
@@ -339,6 +404,7 @@ class Sample(pm.base.PMObject):
             pm.sql.TRN.add(sample_sql, [barcode, self.id])
             pm.sql.TRN.add(barcode_sql, [barcode])
             pm.sql.TRN.execute()
+            self.refresh()
 
     @property
     def sample_set(self):
@@ -349,14 +415,7 @@ class Sample(pm.base.PMObject):
            str
                Sample set the sample belongs to.
         """
-        sql = """SELECT sample_set
-                 FROM barcodes.sample
-                 JOIN barcodes.sample_set USING (sample_set_id)
-                 WHERE sample_id = %s
-              """
-        with pm.sql.TRN:
-            pm.sql.TRN.add(sql, [self.id])
-            return pm.sql.TRN.execute_fetchlast()
+        return self._get_relation('sample_set')
 
     @property
     def projects(self):
@@ -394,11 +453,7 @@ class Sample(pm.base.PMObject):
         location : str
             New location of sample
         """
-        sql = """UPDATE barcodes.sample
-                 SET sample_type = %s
-                 WHERE sample_id = %s"""
-        with pm.sql.TRN:
-            pm.sql.TRN.add(sql, [sample_type, self.id])
+        self._set_property('sample_type', sample_type)
 
     @property
     def location(self):
@@ -411,11 +466,7 @@ class Sample(pm.base.PMObject):
         location : str
             New location of sample
         """
-        sql = """UPDATE barcodes.sample
-                 SET sample_location = %s
-                 WHERE sample_id = %s"""
-        with pm.sql.TRN:
-            pm.sql.TRN.add(sql, [location, self.id])
+        self._set_property('sample_location', location)
 
     @property
     def biomass_remaining(self):
@@ -428,11 +479,7 @@ class Sample(pm.base.PMObject):
         remaining : bool
             Whether biomass remains or not
         """
-        sql = """UPDATE barcodes.sample
-                 SET biomass_remaining = %s
-                 WHERE sample_id = %s"""
-        with pm.sql.TRN:
-            pm.sql.TRN.add(sql, [remaining, self.id])
+        self._set_property('biomass_remaining', remaining)
 
     @property
     def created_on(self):
@@ -440,14 +487,7 @@ class Sample(pm.base.PMObject):
 
     @property
     def created_by(self):
-        sql = """SELECT person_id
-                 FROM barcodes.sample S
-                 JOIN barcodes.person P ON (S.created_by = P.person_id)
-                 WHERE sample_id = %s
-              """
-        with pm.sql.TRN:
-            pm.sql.TRN.add(sql, [self.id])
-            return pm.person.Person(pm.sql.TRN.execute_fetchlast())
+        return self._get_relation('created_by')
 
     @property
     def last_scanned(self):
@@ -466,14 +506,7 @@ class Sample(pm.base.PMObject):
 
     @property
     def plates(self):
-        sql = """SELECT plate_id
-                 FROM barcodes.plates_samples
-                 WHERE sample_id = %s
-              """
-        with pm.sql.TRN:
-            pm.sql.TRN.add(sql, [self.id])
-            return [pm.plate.Plate(p) for p in
-                    pm.sql.TRN.execute_fetchflatten()]
+        return self._get_relation('plates')
 
     @property
     def protocols(self):
@@ -5,16 +5,24 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
+import re
+from asyncio import current_task
 from contextlib import contextmanager
-from itertools import chain
+from contextvars import ContextVar
+from collections import OrderedDict
+from itertools import chain, count, groupby
 from functools import wraps
+from operator import itemgetter
+from threading import Condition, get_ident
+from time import perf_counter, time
 
-from psycopg2 import (connect, ProgrammingError, Error as PostgresError,
-                      OperationalError)
-from psycopg2.extras import DictCursor
-from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2 import connect, Error as PostgresError, OperationalError
+from psycopg2.extras import (DictCursor, NamedTupleCursor, execute_batch,
+                             execute_values)
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, connection, cursor
 
 from platemap.lib.config_manager import pm_config
+from platemap.lib.query_log import QUERY_LOG
 
 
 def _checker(func):
@@ -29,45 +37,421 @@ def _checker(func):
     return wrapper
 
 
-class Transaction(object):
-    """A context manager that encapsulates a DB transaction
+# Unique suffixes for the names of the server-side cursors and savepoints
+_cursor_ids = count()
+
+# Epochs of the identity maps, unique across all the transactions
+_identity_epochs = count()
+
+# Cursor classes for each of the types of rows the results can be returned as
+CURSOR_MODES = {'tuple': cursor,
+                'namedtuple': NamedTupleCursor,
+                'dict': DictCursor}
 
-    A transaction is defined by a series of consecutive queries that need to
-    be applied to the database as a single block.
+
+def _check_cursor_mode(cursor_mode):
+    """Checks that a cursor mode is known
 
     Raises
     ------
-    RuntimeError
-        If the transaction methods are invoked outside a context.
+    ValueError
+        If `cursor_mode` is not one of the keys of `CURSOR_MODES`
+    """
+    if cursor_mode not in CURSOR_MODES:
+        raise ValueError("Unknown cursor mode %s. Should be one of %s"
+                         % (cursor_mode, ', '.join(sorted(CURSOR_MODES))))
+
+# Number of queries sent to the server in each round trip of a batch
+_BATCH_PAGE_SIZE = 1000
+
+_INSERT_VALUES_RE = re.compile(r'^\s*INSERT\s+INTO\s.*?\bVALUES\s*\(',
+                               re.IGNORECASE | re.DOTALL)
+_RETURNING_RE = re.compile(r'\bRETURNING\b', re.IGNORECASE)
+_ON_CONFLICT_RE = re.compile(r'\bON\s+CONFLICT\b', re.IGNORECASE)
+
+
+def _split_values(sql):
+    """Splits a single-row INSERT query around its VALUES row
+
+    Parameters
+    ----------
+    sql : str
+        The sql query
+
+    Returns
+    -------
+    tuple of (str, str, str) or None
+        The query before the VALUES row, the VALUES row and the query after
+        it, or None if the query cannot be executed as a multi-row INSERT
 
     Notes
     -----
-    When the execution leaves the context manager, any remaining queries in
-    the transaction will be executed and committed.
+    Upserts are not split, as a multi-row upsert cannot affect the same row
+    twice and its RETURNING clause does not return a row for each VALUES row.
     """
-    def __init__(self):
-        self._queries = []
-        self._results = []
-        self._contexts_entered = 0
-        self._connection = None
-        self._post_commit_funcs = []
-        self._post_rollback_funcs = []
+    match = _INSERT_VALUES_RE.match(sql)
+    if match is None or _ON_CONFLICT_RE.search(sql):
+        return None
 
-    def _open_connection(self):
-        # If the connection already exists and is not closed, don't do anything
-        if self._connection is not None and self._connection.closed == 0:
-            return
+    # Find the parenthesis closing the VALUES row, skipping quoted strings
+    start = match.end() - 1
+    depth = 0
+    quote = None
+    for pos in range(start, len(sql)):
+        char = sql[pos]
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                break
+    else:
+        return None
+
+    prefix, template, suffix = sql[:start], sql[start:pos + 1], sql[pos + 1:]
+    # All the arguments should go in the VALUES row, which should be the only
+    # one in the query
+    if '%' in prefix or '%' in suffix or suffix.lstrip().startswith(','):
+        return None
+    return prefix, template, suffix
+
+
+# Number of times a query has to be executed in a connection before it is
+# prepared
+_PREPARE_THRESHOLD = 2
+
+_PARAM_RE = re.compile(r'%(?:\(([^)]+)\))?s|%%')
+# Statements that can be prepared
+_PREPARABLE_RE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|VALUES|WITH)\b',
+                            re.IGNORECASE)
+
+
+def _param_type(value):
+    """Returns the type an argument is declared with in a prepared statement
+
+    Parameters
+    ----------
+    value : object
+        The query argument
+
+    Returns
+    -------
+    str or None
+        The postgres type, or None if queries with the argument should not be
+        prepared
+
+    Notes
+    -----
+    Arguments are declared with the type postgres gives to the literals
+    psycopg2 substitutes them with, so a prepared statement returns the same
+    values as the query it replaces.
+    """
+    if value is None or isinstance(value, str):
+        # Quoted literals are typed by postgres from their context
+        return 'unknown'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        if -2 ** 31 <= value < 2 ** 31:
+            return 'integer'
+        if -2 ** 63 <= value < 2 ** 63:
+            return 'bigint'
+    return None
+
+
+class StatementCache(object):
+    """LRU cache of the statements prepared in a postgres connection
+
+    Parameters
+    ----------
+    size : int
+        Maximum number of statements kept prepared in the connection. If 0,
+        no statement is prepared
+
+    Attributes
+    ----------
+    hits : int
+        Number of queries executed through an already prepared statement
+    misses : int
+        Number of queries executed without an already prepared statement
+
+    Notes
+    -----
+    Queries are prepared the second time they are executed in the connection
+    with arguments of the same types. Only queries whose arguments are all
+    strings, integers, booleans or None are prepared.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # Maps each query, with the types of its arguments, to the name of its
+        # prepared statement and the query executing it, least recently used
+        # first. Queries that can not be prepared map to None
+        self._prepared = OrderedDict()
+        # Number of executions of the queries not prepared yet
+        self._seen = OrderedDict()
+        self._names = count()
+
+    def __len__(self):
+        return sum(1 for prepared in self._prepared.values()
+                   if prepared is not None)
+
+    def statement(self, cur, sql, sql_args):
+        """Returns the query to execute in place of `sql`
+
+        Parameters
+        ----------
+        cur : psycopg2.cursor
+            A cursor of the connection, used to prepare the statement
+        sql : str
+            The sql query
+        sql_args : list, tuple or dict of objects
+            The arguments to the sql query
+
+        Returns
+        -------
+        str
+            An EXECUTE of the statement prepared for the query, to be executed
+            with the same arguments, or `sql` if the query is not prepared
+        """
+        key = self._key(sql, sql_args)
+        if key is None:
+            self.misses += 1
+            return sql
+
+        if key in self._prepared:
+            self._prepared.move_to_end(key)
+            prepared = self._prepared[key]
+            if prepared is None:
+                self.misses += 1
+                return sql
+            self.hits += 1
+            return prepared[1]
+
+        self.misses += 1
+        seen = self._seen.pop(key, 0) + 1
+        if seen < _PREPARE_THRESHOLD:
+            self._seen[key] = seen
+            if len(self._seen) > self.size:
+                self._seen.popitem(last=False)
+            return sql
+
+        prepared = self._prepare(cur, key, sql, sql_args)
+        return sql if prepared is None else prepared[1]
+
+    def _key(self, sql, sql_args):
+        """Returns the cache key of a query, None if it can not be prepared"""
+        if self.size <= 0:
+            return None
+        if isinstance(sql_args, dict):
+            types = tuple((k, _param_type(v))
+                          for k, v in sorted(sql_args.items()))
+            if any(t is None for _, t in types):
+                return None
+        elif sql_args is None or isinstance(sql_args, (list, tuple)):
+            types = None if sql_args is None else \
+                tuple(_param_type(v) for v in sql_args)
+            if types is not None and None in types:
+                return None
+        else:
+            return None
+        return sql, types
+
+    def _prepare(self, cur, key, sql, sql_args):
+        """Prepares the statement for a query in the connection
+
+        Returns
+        -------
+        tuple of (str, str) or None
+            The name of the prepared statement and the query executing it, or
+            None if the query could not be prepared
+        """
+        name = 'pm_stmt_%d' % next(self._names)
+        if _PREPARABLE_RE.match(sql) is None or \
+                ';' in sql.rstrip().rstrip(';'):
+            # Only single SELECT, INSERT, UPDATE or DELETE statements can be
+            # prepared
+            body, params = None, []
+        elif sql_args is None:
+            # psycopg2 does not format queries executed without arguments
+            body, params = sql, []
+        else:
+            params = []
+            positions = {}
+
+            def to_param(match):
+                if match.group(0) == '%%':
+                    return '%'
+                if match.group(1) is None:
+                    params.append(('%s', _param_type(sql_args[len(params)])))
+                    return '$%d' % len(params)
+                arg = match.group(1)
+                if arg not in positions:
+                    params.append(('%%(%s)s' % arg,
+                                   _param_type(sql_args[arg])))
+                    positions[arg] = len(params)
+                return '$%d' % positions[arg]
+
+            try:
+                body = _PARAM_RE.sub(to_param, sql)
+            except (IndexError, KeyError, TypeError):
+                # The arguments do not match the query, leave it to psycopg2
+                # to report the error
+                body = None
+
+        # Make room for the new statement, deallocating the least recently
+        # used ones in the same round trip
+        evicted = []
+        while len(self._prepared) >= self.size:
+            _, old = self._prepared.popitem(last=False)
+            if old is not None:
+                evicted.append(old[0])
+
+        prepared = None
+        if body is not None:
+            types = ', '.join(t for _, t in params)
+            stmt = 'EXECUTE %s' % name
+            if params:
+                stmt += ' (%s)' % ', '.join(p for p, _ in params)
+            prepare = 'PREPARE %s%s AS %s' % (
+                name, ' (%s)' % types if types else '', body)
+            # A failed PREPARE or DEALLOCATE would abort the transaction, so
+            # they are isolated in a savepoint, which is only released once
+            # all of them succeed
+            cur.execute('SAVEPOINT pm_prepare')
+            try:
+                cur.execute('%s\n; %sRELEASE SAVEPOINT pm_prepare'
+                            % (prepare, ''.join('DEALLOCATE %s; ' % old
+                                                for old in evicted)))
+                evicted = []
+                prepared = (name, stmt)
+            except PostgresError:
+                cur.execute('ROLLBACK TO SAVEPOINT pm_prepare; '
+                            'RELEASE SAVEPOINT pm_prepare')
+                # Prepared statements are not transactional, so the statement
+                # is kept if it was a DEALLOCATE that failed
+                cur.execute('SELECT EXISTS(SELECT 1 '
+                            'FROM pg_prepared_statements WHERE name = %s)',
+                            [name])
+                if cur.fetchone()[0]:
+                    prepared = (name, stmt)
+        self._prepared[key] = prepared
+
+        # The statements deallocated before a failure are already gone, and
+        # deallocating them again fails harmlessly
+        for old in evicted:
+            _deallocate(cur, old)
+        return prepared
+
+
+def _deallocate(cur, name):
+    """Deallocates a prepared statement, ignoring the errors
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        A cursor of the connection the statement was prepared in
+    name : str
+        The name of the prepared statement
+    """
+    cur.execute('SAVEPOINT pm_prepare')
+    try:
+        cur.execute('DEALLOCATE %s; RELEASE SAVEPOINT pm_prepare' % name)
+    except PostgresError:
+        cur.execute('ROLLBACK TO SAVEPOINT pm_prepare; '
+                    'RELEASE SAVEPOINT pm_prepare')
+
+
+class _Connection(connection):
+    """A postgres connection that keeps track of its prepared statements
+
+    Attributes
+    ----------
+    statements : StatementCache
+        The statements prepared in the connection
+    """
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of postgres connections
+
+    Parameters
+    ----------
+    min_size : int
+        Number of connections that are kept open even when idle
+    max_size : int
+        Maximum number of connections open at the same time
+    idle_timeout : float
+        Seconds an idle connection is kept open before it is closed, as long
+        as more than `min_size` connections are open
+    checkout_timeout : float, optional
+        Seconds to wait for a connection to be returned when all `max_size`
+        connections are in use. Default 30
+    statement_cache_size : int, optional
+        Number of prepared statements kept in each connection. Default 0, no
+        statements are prepared
+
+    Raises
+    ------
+    ValueError
+        If the sizes given do not describe a valid pool
+
+    Notes
+    -----
+    Connections are opened lazily, the first time they are needed. A
+    connection that has been closed or broken while checked out is discarded
+    when returned to the pool instead of being handed out again.
+    """
+    def __init__(self, min_size, max_size, idle_timeout, checkout_timeout=30,
+                 statement_cache_size=0):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError("Invalid pool sizes: min %s, max %s"
+                             % (min_size, max_size))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.statement_cache_size = statement_cache_size
+        self._cond = Condition()
+        # Idle connections are stored with the time they were returned, the
+        # most recently returned connection at the end of the list
+        self._idle = []
+        self._in_use = set()
+        # Number of connections open or being opened by the pool
+        self._size = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        # Prepared statement usage of the connections already closed
+        self._statement_hits = 0
+        self._statement_misses = 0
 
+    def _connect(self):
+        """Opens a new postgres connection
+
+        Raises
+        ------
+        RuntimeError
+            If the connection can not be established
+        """
         try:
-            self._connection = connect(user=pm_config.user,
-                                       password=pm_config.password,
-                                       database=pm_config.database,
-                                       host=pm_config.host,
-                                       port=pm_config.port)
+            conn = connect(user=pm_config.user,
+                           password=pm_config.password,
+                           database=pm_config.database,
+                           host=pm_config.host,
+                           port=pm_config.port,
+                           connection_factory=_Connection)
         except OperationalError as e:
             # catch three known common exceptions and raise runtime errors
             try:
-                etype = e.message.split(':')[1].split()[0]
+                etype = str(e).split(':')[1].split()[0]
             except IndexError:
                 # we recieved a really unanticipated error without a colon
                 etype = ''
@@ -90,16 +474,270 @@ class Transaction(object):
             ebase = ('An OperationalError with the following message occured'
                      '\n\n\t%s\n%s For more information, review `INSTALL.md`'
                      ' in the Qiita installation base directory.')
-            raise RuntimeError(ebase % (e.message, etext))
+            raise RuntimeError(ebase % (str(e), etext))
+        conn.statements = StatementCache(self.statement_cache_size)
+        return conn
+
+    def _discard(self, conn):
+        """Closes a connection and frees its slot in the pool"""
+        self._size -= 1
+        self._statement_hits += conn.statements.hits
+        self._statement_misses += conn.statements.misses
+        try:
+            conn.close()
+        except PostgresError:
+            pass
+
+    def _reap(self):
+        """Closes the connections that have been idle for too long"""
+        limit = time() - self.idle_timeout
+        # The oldest idle connections are at the start of the list
+        while self._idle and self._size > self.min_size and \
+                self._idle[0][1] < limit:
+            conn, _ = self._idle.pop(0)
+            self._discard(conn)
+
+    def getconn(self):
+        """Checks a connection out of the pool
+
+        Returns
+        -------
+        psycopg2.connection
+            An open connection, reserved until it is given back with `putconn`
+
+        Raises
+        ------
+        RuntimeError
+            If no connection becomes available within `checkout_timeout`
+            seconds, or the connection can not be established
+        """
+        start = time()
+        conn = None
+        waited = False
+        with self._cond:
+            while True:
+                self._reap()
+                while self._idle:
+                    conn, _ = self._idle.pop()
+                    if conn.closed == 0:
+                        break
+                    # The connection was dropped while idle
+                    self._discard(conn)
+                    conn = None
+                if conn is not None or self._size < self.max_size:
+                    break
+                remaining = self.checkout_timeout - (time() - start)
+                if remaining <= 0:
+                    raise RuntimeError(
+                        "Timed out after %s seconds waiting for one of the %d "
+                        "database connections to be free"
+                        % (self.checkout_timeout, self.max_size))
+                waited = True
+                self._cond.wait(remaining)
+            if conn is None:
+                # Reserve the slot now, but open the connection outside the
+                # lock so other threads are not blocked by it
+                self._size += 1
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+
+        elapsed = time() - start
+        with self._cond:
+            self._in_use.add(conn)
+            self._checkouts += 1
+            if waited:
+                self._waits += 1
+            self._total_wait += elapsed
+            self._max_wait = max(self._max_wait, elapsed)
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Returns a connection to the pool
+
+        Parameters
+        ----------
+        conn : psycopg2.connection
+            The connection, as returned by `getconn`
+        close : bool, optional
+            Whether to close the connection instead of keeping it for reuse.
+            Default False
+
+        Notes
+        -----
+        Any transaction left open in the connection is rolled back, so the next
+        user of the connection always starts from a clean state.
+        """
+        if conn.closed == 0 and not close:
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except PostgresError:
+                close = True
+
+        with self._cond:
+            self._in_use.discard(conn)
+            if close or conn.closed != 0:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time()))
+            self._reap()
+            self._cond.notify()
+
+    def closeall(self):
+        """Closes all the idle connections in the pool
+
+        Connections checked out are closed once they are returned
+        """
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._discard(conn)
+
+    def stats(self):
+        """Returns usage statistics of the pool
+
+        Returns
+        -------
+        dict of {str: number}
+            The number of open connections (`size`), connections checked out
+            (`in_use`) and waiting in the pool (`idle`), the pool limits
+            (`min_size` and `max_size`), the number of checkouts made
+            (`checkouts`), how many of them had to wait for a connection to
+            be returned (`waits`) and the total and maximum time, in seconds,
+            spent in checkouts (`total_wait` and `max_wait`). It also
+            includes the number of statements prepared in the open connections
+            (`prepared_statements`) and the number of queries executed with
+            (`statement_hits`) and without (`statement_misses`) an already
+            prepared statement
+        """
+        with self._cond:
+            conns = [conn for conn, _ in self._idle] + list(self._in_use)
+            return {'size': self._size,
+                    'in_use': len(self._in_use),
+                    'idle': len(self._idle),
+                    'min_size': self.min_size,
+                    'max_size': self.max_size,
+                    'checkouts': self._checkouts,
+                    'waits': self._waits,
+                    'total_wait': self._total_wait,
+                    'max_wait': self._max_wait,
+                    'prepared_statements': sum(len(conn.statements)
+                                               for conn in conns),
+                    'statement_hits': self._statement_hits + sum(
+                        conn.statements.hits for conn in conns),
+                    'statement_misses': self._statement_misses + sum(
+                        conn.statements.misses for conn in conns)}
+
+
+class Transaction(object):
+    """A context manager that encapsulates a DB transaction
+
+    A transaction is defined by a series of consecutive queries that need to
+    be applied to the database as a single block.
+
+    Parameters
+    ----------
+    pool : ConnectionPool, optional
+        The pool the connections are checked out from. Defaults to the pool
+        configured for the system
+    query_log : QueryLog, optional
+        Where the statements executed are recorded. Defaults to the query log
+        of the system
+    cursor_mode : {'dict', 'namedtuple', 'tuple'}, optional
+        The type of the rows of the results. Default 'dict'
+
+    Attributes
+    ----------
+    cursor_mode : {'dict', 'namedtuple', 'tuple'}
+        The type of the rows of the results, for the execute methods invoked
+        without a cursor mode
+
+    Raises
+    ------
+    RuntimeError
+        If the transaction methods are invoked outside a context.
+
+    Notes
+    -----
+    When the execution leaves the context manager, any remaining queries in
+    the transaction will be executed and committed.
+
+    A connection is checked out of the pool when entering the outermost
+    context and returned to it on commit, rollback or when leaving the
+    outermost context, so idle transactions do not hold connections.
+    """
+    def __init__(self, pool=None, query_log=None, cursor_mode='dict'):
+        self._pool = pool if pool is not None else POOL
+        self._query_log = query_log if query_log is not None else QUERY_LOG
+        self.cursor_mode = cursor_mode
+        self._queries = []
+        self._results = []
+        self._rowcounts = []
+        # The savepoints currently set, the innermost last
+        self._savepoints = []
+        self._contexts_entered = 0
+        self._connection = None
+        self._post_commit_funcs = []
+        self._post_rollback_funcs = []
+        # Objects already validated in the transaction, by class and id
+        self._identity_map = {}
+        self._identity_epoch = next(_identity_epochs)
+        self._identity_scopes = 0
+
+    def _open_connection(self):
+        # If the connection already exists and is not closed, don't do anything
+        if self._connection is not None and self._connection.closed == 0:
+            return
+
+        # A connection that was dropped under us is handed back so the pool
+        # can discard it, and a fresh one is checked out in its place
+        self._release_connection()
+        self._connection = self._pool.getconn()
+
+    def _release_connection(self):
+        """Returns the connection in use, if any, to the connection pool"""
+        if self._connection is not None:
+            self._pool.putconn(self._connection)
+            self._connection = None
 
     def close(self):
         if self._connection is not None:
-            self._connection.close()
+            self._pool.putconn(self._connection, close=True)
+            self._connection = None
+
+    @property
+    def cursor_mode(self):
+        return self._cursor_mode
+
+    @cursor_mode.setter
+    def cursor_mode(self, cursor_mode):
+        _check_cursor_mode(cursor_mode)
+        self._cursor_mode = cursor_mode
+
+    def _cursor_factory(self, cursor_mode):
+        """Returns the cursor class for a cursor mode, None for the default"""
+        if cursor_mode is None:
+            return CURSOR_MODES[self._cursor_mode]
+        _check_cursor_mode(cursor_mode)
+        return CURSOR_MODES[cursor_mode]
 
     @contextmanager
-    def _get_cursor(self):
+    def _get_cursor(self, cursor_mode=None):
         """Returns a postgres cursor
 
+        Parameters
+        ----------
+        cursor_mode : {'dict', 'namedtuple', 'tuple'}, optional
+            The type of the rows retrieved. Defaults to the cursor mode of the
+            transaction
+
         Returns
         -------
         psycopg2.cursor
@@ -113,7 +751,8 @@ class Transaction(object):
         self._open_connection()
 
         try:
-            with self._connection.cursor(cursor_factory=DictCursor) as cur:
+            with self._connection.cursor(
+                    cursor_factory=self._cursor_factory(cursor_mode)) as cur:
                 yield cur
         except PostgresError as e:
             raise RuntimeError("Cannot get postgres cursor: %s" % e)
@@ -134,7 +773,8 @@ class Transaction(object):
             # wrapped in a try/except and rollbacks in case of failure
             self.execute()
             self.commit()
-        elif self._connection.get_transaction_status() != \
+        elif self._connection is not None and \
+                self._connection.get_transaction_status() != \
                 TRANSACTION_STATUS_IDLE:
             # There are no queries to be executed, however, the transaction
             # is still not committed. Commit it so the changes are not lost
@@ -150,6 +790,7 @@ class Transaction(object):
                 self._clean_up(exc_type)
             finally:
                 self._contexts_entered -= 1
+                self._release_connection()
         else:
             self._contexts_entered -= 1
 
@@ -162,7 +803,7 @@ class Transaction(object):
         ------
         ValueError
         """
-        self.rollback()
+        self._rollback_after_error()
         raise ValueError(
             "Error running SQL query:\n"
             "Query: %s\nArguments: %s\nError: %s\n"
@@ -207,39 +848,127 @@ class Transaction(object):
                                     " Found %s" % type(args))
             self._queries.append((sql, args))
 
-    def _execute(self):
+    def _execute_single(self, cur, sql, sql_args):
+        """Executes a single query and returns its results
+
+        Returns
+        -------
+        list of rows or None
+            The rows retrieved by the query, or None if the query does not
+            retrieve any value
+        int
+            The number of rows retrieved or affected by the query
+        """
+        # Execute the current SQL command, through its prepared statement if
+        # it has been executed before in the connection
+        stmt = self._connection.statements.statement(cur, sql, sql_args)
+        start = perf_counter()
+        try:
+            cur.execute(stmt, sql_args)
+            # Only the queries that retrieve values (e.g. an INSERT with a
+            # RETURNING clause) have a description of their results
+            res = cur.fetchall() if cur.description is not None else None
+        except Exception as e:
+            # We catch any exception as we want to make sure that we
+            # rollback every time that something went wrong
+            self._raise_execution_error(sql, sql_args, e)
+
+        self._query_log.record(sql, sql_args, perf_counter() - start,
+                               cur.rowcount)
+        return res, cur.rowcount
+
+    def _execute_many(self, cur, sql, args_list, batch=True):
+        """Executes the same query once for each element of `args_list`
+
+        Parameters
+        ----------
+        batch : bool, optional
+            Whether queries not retrieving values can be sent in pages, which
+            leaves their row counts unknown. Default True
+
+        Returns
+        -------
+        list
+            The results of each one of the queries, in order
+        list of int
+            The number of rows retrieved or affected by each one of the
+            queries, -1 if unknown
+
+        Notes
+        -----
+        Single-row ``INSERT ... VALUES`` queries are folded into multi-row
+        VALUES statements. Any other query is executed once on its own to find
+        out if it retrieves values; if it does not, and `batch` is True, the
+        rest of the queries are sent to the server in pages instead of one at
+        a time, and only the total number of rows they affect is known.
+        """
+        values = _split_values(sql)
+        if values is not None and all(args_list):
+            prefix, template, suffix = values
+            returning = _RETURNING_RE.search(suffix) is not None
+            start = perf_counter()
+            try:
+                rows = execute_values(cur, prefix + '%s' + suffix, args_list,
+                                      template=template,
+                                      page_size=_BATCH_PAGE_SIZE,
+                                      fetch=returning)
+            except Exception as e:
+                self._raise_execution_error(sql, args_list, e)
+            # Each one of the queries inserts a single row
+            self._query_log.record(sql, args_list[0], perf_counter() - start,
+                                   len(args_list), len(args_list))
+            rowcounts = [1] * len(args_list)
+            if returning:
+                # Each of the inserted rows is returned in insertion order
+                return [[row] for row in rows], rowcounts
+            return [None] * len(args_list), rowcounts
+
+        res, rowcount = self._execute_single(cur, sql, args_list[0])
+        results, rowcounts = [res], [rowcount]
+        if cur.description is not None or not batch:
+            # The query retrieves values, so each query needs its own results,
+            # or the row count of each query is needed
+            for args in args_list[1:]:
+                res, rowcount = self._execute_single(cur, sql, args)
+                results.append(res)
+                rowcounts.append(rowcount)
+            return results, rowcounts
+
+        start = perf_counter()
+        try:
+            execute_batch(cur, sql, args_list[1:], page_size=_BATCH_PAGE_SIZE)
+        except Exception as e:
+            self._raise_execution_error(sql, args_list[1:], e)
+        # The row count is only known for the last query of the batch
+        self._query_log.record(sql, args_list[1], perf_counter() - start, -1,
+                               len(args_list) - 1)
+        return (results + [None] * (len(args_list) - 1),
+                rowcounts + [-1] * (len(args_list) - 1))
+
+    def _execute(self, cursor_mode=None, batch=True):
         """Internal function that actually executes the transaction
         The `execute` function exposed in the API wraps this one to make sure
         that we catch any exception that happens in here and we rollback the
         transaction
+
+        Consecutive executions of the same SQL query, as the ones added with
+        `many`, are sent to the database as a batch, unless `batch` is False
+        and the row count of each one is needed.
         """
-        with self._get_cursor() as cur:
-            for sql, sql_args in self._queries:
-                # Execute the current SQL command
-                try:
-                    cur.execute(sql, sql_args)
-                except Exception as e:
-                    # We catch any exception as we want to make sure that we
-                    # rollback every time that something went wrong
-                    self._raise_execution_error(sql, sql_args, e)
-
-                try:
-                    res = cur.fetchall()
-                except ProgrammingError as e:
-                    # At this execution point, we don't know if the sql query
-                    # that we executed should retrieve values from the database
-                    # If the query was not supposed to retrieve any value
-                    # (e.g. an INSERT without a RETURNING clause), it will
-                    # raise a ProgrammingError. Otherwise it will just return
-                    # an empty list
-                    res = None
-                except PostgresError as e:
-                    # Some other error happened during the execution of the
-                    # query, so we need to rollback
-                    self._raise_execution_error(sql, sql_args, e)
-
-                # Store the results of the current query
-                self._results.append(res)
+        with self._get_cursor(cursor_mode) as cur:
+            for sql, group in groupby(self._queries, key=itemgetter(0)):
+                args_list = [args for _, args in group]
+                # Store the results of the current queries
+                if len(args_list) == 1:
+                    res, rowcount = self._execute_single(cur, sql,
+                                                         args_list[0])
+                    self._results.append(res)
+                    self._rowcounts.append(rowcount)
+                else:
+                    results, rowcounts = self._execute_many(cur, sql,
+                                                            args_list, batch)
+                    self._results.extend(results)
+                    self._rowcounts.extend(rowcounts)
 
         # wipe out the already executed queries
         self._queries = []
@@ -247,12 +976,18 @@ class Transaction(object):
         return self._results
 
     @_checker
-    def execute(self):
+    def execute(self, cursor_mode=None):
         """Executes the transaction
 
+        Parameters
+        ----------
+        cursor_mode : {'dict', 'namedtuple', 'tuple'}, optional
+            The type of the rows retrieved by the queries executed. Defaults
+            to the cursor mode of the transaction
+
         Returns
         -------
-        list of DictCursor
+        list of list of rows
             The results of all the SQL queries in the transaction
 
         Raises
@@ -273,19 +1008,27 @@ class Transaction(object):
         execute_fetchindex
         execute_fetchflatten
         """
+        if cursor_mode is not None:
+            _check_cursor_mode(cursor_mode)
         try:
-            return self._execute()
+            return self._execute(cursor_mode)
         except Exception:
-            self.rollback()
+            self._rollback_after_error()
             raise
 
     @_checker
-    def execute_fetchlast(self):
+    def execute_fetchlast(self, cursor_mode='tuple'):
         """Executes the transaction and returns the last result
 
         This is a convenient function that is equivalent to
         `self.execute()[-1][0][0]`
 
+        Parameters
+        ----------
+        cursor_mode : {'tuple', 'namedtuple', 'dict'}, optional
+            The type of the rows retrieved by the queries executed. Default
+            'tuple', the cheapest one
+
         Returns
         -------
         object or None
@@ -298,12 +1041,12 @@ class Transaction(object):
         execute_fetchflatten
         """
         try:
-            return self.execute()[-1][0][0]
+            return self.execute(cursor_mode)[-1][0][0]
         except IndexError:
             return None
 
     @_checker
-    def execute_fetchindex(self, idx=-1):
+    def execute_fetchindex(self, idx=-1, cursor_mode=None):
         """Executes the transaction and returns the results of the `idx` query
 
         This is a convenient function that is equivalent to
@@ -314,10 +1057,13 @@ class Transaction(object):
         idx : int, optional
             The index of the query to return the result. It defaults to -1, the
             last query.
+        cursor_mode : {'dict', 'namedtuple', 'tuple'}, optional
+            The type of the rows retrieved by the queries executed. Defaults
+            to the cursor mode of the transaction
 
         Returns
         -------
-        DictCursor
+        list of rows
             The results of the `idx` query in the transaction
 
         See Also
@@ -326,10 +1072,10 @@ class Transaction(object):
         execute_fetchlast
         execute_fetchflatten
         """
-        return self.execute()[idx]
+        return self.execute(cursor_mode)[idx]
 
     @_checker
-    def execute_fetchflatten(self, idx=-1):
+    def execute_fetchflatten(self, idx=-1, cursor_mode='tuple'):
         """Executes the transaction and returns the flattened results of the
         `idx` query
 
@@ -341,6 +1087,9 @@ class Transaction(object):
         idx : int, optional
             The index of the query to return the result. It defaults to -1, the
             last query.
+        cursor_mode : {'tuple', 'namedtuple', 'dict'}, optional
+            The type of the rows retrieved by the queries executed. Default
+            'tuple', the cheapest one
 
         Returns
         -------
@@ -353,7 +1102,252 @@ class Transaction(object):
         execute_fetchlast
         execute_fetchindex
         """
-        return list(chain.from_iterable(self.execute()[idx]))
+        return list(chain.from_iterable(self.execute(cursor_mode)[idx]))
+
+    @_checker
+    def execute_rowcounts(self):
+        """Executes the transaction and returns the number of rows retrieved
+        or affected by each query
+
+        Returns
+        -------
+        list of int
+            The row counts of all the SQL queries in the transaction, -1 for
+            the queries whose row count is unknown
+
+        Raises
+        ------
+        RuntimeError
+            If invoked outside a context
+
+        Notes
+        -----
+        The queries pending are executed one at a time, instead of batching
+        the UPDATE or DELETE queries added with `many`, so all their row
+        counts are known. The row count of a query is unknown if it has been
+        executed before, by `execute`, as part of such a batch, other than
+        its first query.
+
+        See Also
+        --------
+        execute
+        """
+        try:
+            self._execute(batch=False)
+        except Exception:
+            self._rollback_after_error()
+            raise
+        return list(self._rowcounts)
+
+    @_checker
+    def iter_query(self, sql, sql_args=None, chunk_size=1000,
+                   cursor_mode=None):
+        """Executes an sql query and iterates over its results
+
+        The rows are read through a server-side cursor, `chunk_size` rows at a
+        time, so the memory used does not depend on the size of the result.
+
+        Parameters
+        ----------
+        sql : str
+            The sql query
+        sql_args : list, tuple or dict of objects, optional
+            The arguments to the sql query
+        chunk_size : int, optional
+            Number of rows fetched from the server at a time. Default 1000
+        cursor_mode : {'dict', 'namedtuple', 'tuple'}, optional
+            The type of the rows returned. Defaults to the cursor mode of the
+            transaction
+
+        Yields
+        ------
+        row
+            The rows returned by the query
+
+        Raises
+        ------
+        TypeError
+            If `sql_args` is provided and is not a list, tuple or dict
+        RuntimeError
+            If invoked outside a context
+        ValueError
+            If the query fails. The transaction is rolled back
+
+        Notes
+        -----
+        Any query already added to the transaction is executed before the
+        iteration starts. The server-side cursor lives inside the transaction,
+        so the iteration must be done before the transaction is committed or
+        rolled back.
+        """
+        if sql_args and not isinstance(sql_args, (list, tuple, dict)):
+            raise TypeError("sql_args should be a list, tuple or dict. Found "
+                            "%s" % type(sql_args))
+        cursor_factory = self._cursor_factory(cursor_mode)
+        if self._queries:
+            self.execute()
+
+        self._open_connection()
+        name = 'pm_iter_%d' % next(_cursor_ids)
+        # Only the time spent in the database is recorded, not the time spent
+        # by the caller between rows
+        duration = 0.0
+        count = 0
+        try:
+            with self._connection.cursor(
+                    name, cursor_factory=cursor_factory) as cur:
+                cur.itersize = chunk_size
+                start = perf_counter()
+                cur.execute(sql, sql_args)
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    duration += perf_counter() - start
+                    if not rows:
+                        break
+                    count += len(rows)
+                    for row in rows:
+                        yield row
+                    start = perf_counter()
+        except PostgresError as e:
+            self._raise_execution_error(sql, sql_args, e)
+        self._query_log.record(sql, sql_args, duration, count)
+
+    def _rollback_after_error(self):
+        """Rollbacks the changes made since the innermost savepoint, or the
+        whole transaction if there is no savepoint"""
+        if self._savepoints:
+            self._rollback_to_savepoint(self._savepoints[-1])
+        else:
+            self.rollback()
+
+    def _rollback_to_savepoint(self, savepoint):
+        """Rollbacks the changes made since a savepoint was set
+
+        Parameters
+        ----------
+        savepoint : tuple
+            The savepoint, as stored in `_savepoints`
+
+        Notes
+        -----
+        The queries still pending, and the results and post commit functions
+        added after the savepoint are discarded, as well as the identity map.
+        The post rollback functions added after the savepoint are executed.
+        """
+        name, n_results, n_commit_funcs, n_rollback_funcs = savepoint
+        self._queries = []
+        self.clear_identity_map()
+        del self._results[n_results:]
+        del self._rowcounts[n_results:]
+        try:
+            with self._get_cursor() as cur:
+                cur.execute('ROLLBACK TO SAVEPOINT %s' % name)
+        except Exception:
+            # The savepoint can not be restored, so nothing in the
+            # transaction can be kept
+            self.rollback()
+            raise
+
+        funcs = self._post_rollback_funcs[n_rollback_funcs:]
+        del self._post_commit_funcs[n_commit_funcs:]
+        del self._post_rollback_funcs[n_rollback_funcs:]
+        error_msg = []
+        for f, args, kwargs in funcs:
+            try:
+                f(*args, **kwargs)
+            except Exception as e:
+                error_msg.append(str(e))
+        if error_msg:
+            raise RuntimeError(
+                "An error occurred during the post rollback commands:\n%s"
+                % "\n".join(error_msg))
+
+    @_checker
+    @contextmanager
+    def savepoint(self):
+        """Context whose changes can be rolled back without rolling back the
+        rest of the transaction
+
+        If an exception is raised inside the context, the changes made in it
+        are rolled back and the exception is propagated, but the transaction
+        can still be used and committed.
+
+        Raises
+        ------
+        RuntimeError
+            If invoked outside a context
+
+        Notes
+        -----
+        Queries added before entering the context are executed first, so they
+        are not rolled back with the savepoint. Queries still pending when the
+        context is left are executed, so their errors are rolled back with the
+        savepoint too. Savepoints can be nested.
+
+        Examples
+        --------
+        Inserting several names, keeping the ones that fail apart instead of
+        rolling back the whole transaction::
+
+            with TRN:
+                for name in names:
+                    try:
+                        with TRN.savepoint():
+                            TRN.add(sql, [name])
+                    except ValueError:
+                        failed.append(name)
+        """
+        if self._queries:
+            self.execute()
+        savepoint = ('pm_savepoint_%d' % next(_cursor_ids),
+                     len(self._results), len(self._post_commit_funcs),
+                     len(self._post_rollback_funcs))
+        with self._get_cursor() as cur:
+            cur.execute('SAVEPOINT %s' % savepoint[0])
+        self._savepoints.append(savepoint)
+        self._contexts_entered += 1
+        try:
+            yield self
+            if self._queries:
+                self.execute()
+        except BaseException:
+            # The savepoint is gone if the transaction has been committed or
+            # rolled back in the context, but the queries still pending were
+            # added in it and must not be executed
+            if savepoint in self._savepoints:
+                self._rollback_to_savepoint(savepoint)
+            else:
+                self._queries = []
+            raise
+        else:
+            if savepoint in self._savepoints:
+                with self._get_cursor() as cur:
+                    cur.execute('RELEASE SAVEPOINT %s' % savepoint[0])
+        finally:
+            self._contexts_entered -= 1
+            if savepoint in self._savepoints:
+                del self._savepoints[self._savepoints.index(savepoint):]
+
+    @contextmanager
+    def atomic(self):
+        """Context whose changes are kept or rolled back as a whole
+
+        Enters the transaction and a savepoint, so if an exception is raised
+        inside the context only its changes are rolled back, even when it is
+        part of a larger transaction that goes on after handling the error.
+
+        Examples
+        --------
+        Creating a row and its children, leaving none of them if any fails::
+
+            with TRN.atomic():
+                TRN.add(parent_sql, args)
+                parent_id = TRN.execute_fetchlast()
+                TRN.add(children_sql, [[parent_id, c] for c in children],
+                        many=True)
+        """
+        with self, self.savepoint():
+            yield self
 
     def _funcs_executor(self, funcs, func_str):
         error_msg = []
@@ -383,11 +1377,17 @@ class Transaction(object):
         # Reset the queries, the results and the index
         self._queries = []
         self._results = []
+        self._rowcounts = []
+        self._savepoints = []
+        if not self._identity_scopes:
+            self.clear_identity_map()
         try:
-            self._connection.commit()
+            if self._connection is not None:
+                self._connection.commit()
         except Exception:
-            self._connection.close()
+            self.close()
             raise
+        self._release_connection()
         # Execute the post commit functions
         self._funcs_executor(self._post_commit_funcs, "commit")
 
@@ -403,14 +1403,102 @@ class Transaction(object):
         # Reset the queries, the results and the index
         self._queries = []
         self._results = []
+        self._rowcounts = []
+        self._savepoints = []
+        # The objects may not exist anymore
+        self.clear_identity_map()
         try:
-            self._connection.rollback()
+            if self._connection is not None:
+                self._connection.rollback()
         except Exception:
-            self._connection.close()
+            self.close()
             raise
+        self._release_connection()
         # Execute the post rollback functions
         self._funcs_executor(self._post_rollback_funcs, "rollback")
 
+    def get_object(self, cls, id_):
+        """Returns the object already validated in the transaction
+
+        Parameters
+        ----------
+        cls : type
+            The class of the object
+        id_ : int or str
+            The object identifier
+
+        Returns
+        -------
+        object or None
+            The object, or None if it is not in the identity map or there is
+            no transaction context nor identity scope open
+        """
+        if not self._contexts_entered and not self._identity_scopes:
+            return None
+        return self._identity_map.get((cls, id_))
+
+    def add_object(self, obj):
+        """Adds a validated object to the identity map
+
+        Parameters
+        ----------
+        obj : object
+            The object, whose class and `id` identify it
+
+        Notes
+        -----
+        The object is not added if there is no transaction context nor
+        identity scope open.
+        """
+        if self._contexts_entered or self._identity_scopes:
+            self._identity_map[(type(obj), obj.id)] = obj
+
+    def clear_identity_map(self):
+        """Removes all the objects from the identity map"""
+        self._identity_map = {}
+        self._identity_epoch = next(_identity_epochs)
+
+    @property
+    def identity_epoch(self):
+        """Identifies the current contents of the identity map
+
+        It changes every time the identity map is cleared, so data read with
+        the same epoch belongs to the same transaction or identity scope and
+        has not been rolled back since.
+        """
+        return self._identity_epoch
+
+    @contextmanager
+    def identity_scope(self):
+        """Context keeping the identity map across commits
+
+        The identity map is cleared on every rollback and, outside of an
+        identity scope, on every commit. Inside the scope the objects
+        validated in a transaction are reused by the following ones, which
+        is useful to span the map over a whole web request or script.
+
+        Notes
+        -----
+        Scopes can be nested. The identity map is cleared when the outermost
+        one is left, unless a transaction context is still open.
+
+        Examples
+        --------
+        Reading the names of several samples, validating each one of them
+        only once across the transactions::
+
+            with TRN.identity_scope():
+                for sample_id in sample_ids:
+                    Sample(sample_id).name
+        """
+        self._identity_scopes += 1
+        try:
+            yield self
+        finally:
+            self._identity_scopes -= 1
+            if not self._identity_scopes and not self._contexts_entered:
+                self.clear_identity_map()
+
     @property
     def index(self):
         return len(self._queries) + len(self._results)
@@ -455,5 +1543,91 @@ class Transaction(object):
         """
         self._post_rollback_funcs.append((func, args, kwargs))
 
-# Singleton pattern, create the transaction for the entire system
-TRN = Transaction()
+
+# The transaction of the unit of work running in the current context, stored
+# together with the unit of work that created it
+_local_transaction = ContextVar('platemap_transaction', default=None)
+# The transaction the work spawned from the current context joins, set with
+# LocalTransaction.shared
+_shared_transaction = ContextVar('platemap_shared_transaction', default=None)
+
+
+def _unit_of_work():
+    """Returns a key identifying the thread and asyncio task being run"""
+    try:
+        task = current_task()
+    except RuntimeError:
+        # There is no event loop running in this thread
+        task = None
+    return get_ident(), id(task)
+
+
+class LocalTransaction(object):
+    """A context manager giving each unit of work its own Transaction
+
+    Every thread and every asyncio task gets an independent Transaction, with
+    its own queued queries, results and connection, so concurrent requests
+    never mix their queries. Attribute access and the context manager
+    protocol are forwarded to the Transaction of the current unit of work,
+    so it can be used exactly as a Transaction.
+
+    Notes
+    -----
+    A task spawned while a transaction is open in its parent still gets its
+    own Transaction, unless the parent explicitly shares it with `shared`.
+    """
+    def _current(self):
+        owner = _unit_of_work()
+        current = _local_transaction.get()
+        if current is not None and current[0] == owner:
+            return current[1]
+        trn = _shared_transaction.get()
+        if trn is not None:
+            return trn
+        trn = Transaction()
+        _local_transaction.set((owner, trn))
+        return trn
+
+    @contextmanager
+    def shared(self):
+        """Makes the work spawned in the context use the current Transaction
+
+        The tasks spawned inside the context, and the ones they spawn, take
+        part in the Transaction of the unit of work entering it instead of
+        getting their own. This is meant for tests that need the handlers
+        they call to run in a transaction they roll back.
+
+        Examples
+        --------
+        Running a handler in the transaction of a test::
+
+            with TRN, TRN.shared():
+                loop.run_until_complete(handler())
+        """
+        token = _shared_transaction.set(self._current())
+        try:
+            yield
+        finally:
+            _shared_transaction.reset(token)
+
+    def __getattr__(self, name):
+        return getattr(self._current(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._current(), name, value)
+
+    def __enter__(self):
+        return self._current().__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._current().__exit__(exc_type, exc_value, traceback)
+
+
+# Pool shared by all the transactions in the system
+POOL = ConnectionPool(pm_config.pool_min_size, pm_config.pool_max_size,
+                      pm_config.pool_idle_timeout,
+                      statement_cache_size=pm_config.statement_cache_size)
+
+# Single entry point for the entire system, that resolves to the transaction
+# of the thread or asyncio task using it
+TRN = LocalTransaction()
@@ -34,6 +34,166 @@ class QiitaBaseTest(TestCase):
         with self.assertRaises(pm.exceptions.UnknownIDError):
             pm.sample.Sample(20)
 
+    def test_from_ids(self):
+        """Instantiates several objects with a single query"""
+        pm.sql.TRN.clear_identity_map()
+        with pm.query_log.QueryCounter() as counter:
+            obs = pm.sample.Sample.from_ids([2, 1, 2])
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(obs, [pm.sample.Sample(2), pm.sample.Sample(1),
+                               pm.sample.Sample(2)])
+        self.assertIs(obs[0], obs[2])
+        self.assertEqual(pm.sample.Sample.from_ids([]), [])
+
+    def test_from_ids_identity_map(self):
+        """Objects already in the identity map are not checked again"""
+        with pm.query_log.QueryCounter() as counter:
+            obs = pm.sample.Sample.from_ids([1])
+        self.assertEqual(counter.count, 0)
+        self.assertIs(obs[0], self.tester)
+        self.assertIs(pm.sample.Sample.from_ids([2])[0], pm.sample.Sample(2))
+
+    def test_from_ids_str(self):
+        """IDs given as strings are converted to the type of the table IDs"""
+        pm.sql.TRN.clear_identity_map()
+        obs = pm.sample.Sample.from_ids(['2', 1])
+        self.assertEqual(obs, [pm.sample.Sample(2), pm.sample.Sample(1)])
+        self.assertEqual([o.id for o in obs], [2, 1])
+        self.assertIs(pm.sample.Sample('2'), obs[0])
+        self.assertIs(pm.sample.Sample.from_ids(['1'])[0], obs[1])
+        self.assertEqual(pm.plate.Plate.from_ids(['000000003'])[0].id,
+                         '000000003')
+
+    def test_from_ids_error_invalid(self):
+        """IDs that can not be converted do not exist"""
+        with self.assertRaises(pm.exceptions.UnknownIDError) as cm:
+            pm.sample.Sample.from_ids([1, 'x'])
+        self.assertEqual(str(cm.exception),
+                         "The objects with IDs 'x' do not exist in table "
+                         "'sample'")
+        with self.assertRaises(pm.exceptions.UnknownIDError):
+            pm.sample.Sample('x')
+
+    def test_from_ids_error_inexistent(self):
+        """Raises an error listing all the ids that do not exist"""
+        with self.assertRaises(pm.exceptions.UnknownIDError) as cm:
+            pm.sample.Sample.from_ids([1, 30, 2, 20])
+        self.assertEqual(str(cm.exception),
+                         "The objects with IDs '20', '30' do not exist in "
+                         "table 'sample'")
+
+    def test_from_ids_errors(self):
+        """Raises an error on bad types or from the base class"""
+        with self.assertRaises(TypeError):
+            pm.sample.Sample.from_ids([1, ['list', 'fail']])
+        with self.assertRaises(pm.exceptions.DeveloperError):
+            pm.base.PMObject.from_ids([1])
+
+    def test_get_property(self):
+        """The row is read once and kept during the transaction"""
+        with pm.query_log.QueryCounter() as counter:
+            self.assertEqual(self.tester._get_property('sample'), 'Sample 1')
+            self.tester._get_property('barcode')
+            self.tester._get_property('sample_type')
+        self.assertEqual(counter.count, 1)
+
+    def test_get_property_cursor_mode(self):
+        """The row is read as a dict whatever the default cursor mode"""
+        pm.sql.TRN.cursor_mode = 'tuple'
+        try:
+            self.tester.refresh()
+            self.assertEqual(self.tester._get_property('sample'), 'Sample 1')
+            self.tester.update(sample_type='stool')
+            self.assertEqual(self.tester._get_property('sample_type'),
+                             'stool')
+        finally:
+            pm.sql.TRN.cursor_mode = 'dict'
+
+    def test_get_property_rollback(self):
+        """The row is read again after a rollback"""
+        self.tester._set_property('sample', 'New name')
+        self.assertEqual(self.tester._get_property('sample'), 'New name')
+        pm.sql.TRN.rollback()
+        self.assertEqual(self.tester._get_property('sample'), 'Sample 1')
+
+    def test_refresh(self):
+        """The row is read again after a refresh"""
+        self.assertEqual(self.tester._get_property('sample'), 'Sample 1')
+        pm.sql.TRN.add("UPDATE barcodes.sample SET sample = 'New name' "
+                       "WHERE sample_id = 1")
+        pm.sql.TRN.execute()
+        self.assertEqual(self.tester._get_property('sample'), 'Sample 1')
+        self.tester.refresh()
+        self.assertEqual(self.tester._get_property('sample'), 'New name')
+
+    def test_prefetch(self):
+        """Relations are loaded with one query per hop and class"""
+        pm.sql.TRN.clear_identity_map()
+        plates = pm.plate.Plate.plates()
+        with pm.query_log.QueryCounter() as counter:
+            obs = pm.prefetch(plates + [None], 'samples',
+                              'samples.sample_set')
+        self.assertEqual(obs, plates)
+        # samples, their rows and their sample sets
+        self.assertEqual(counter.count, 3)
+
+        with pm.query_log.QueryCounter() as counter:
+            samples = plates[0].samples
+            self.assertEqual([s.name for s in samples],
+                             ['Sample 1', 'Sample 2', 'Sample 3'])
+            self.assertEqual([s.sample_set for s in samples],
+                             ['Sample Set 1'] * 3)
+        self.assertEqual(counter.count, 0)
+
+    def test_prefetch_mixed(self):
+        """Objects of several classes and empty relations are loaded"""
+        protocols = [pm.protocol.ExtractionProtocol(1),
+                     pm.protocol.PCRProtocol(3)]
+        pm.prefetch(protocols, 'plate', 'created_by')
+        pool = pm.run.Pool(1)
+        pm.prefetch([pool], 'protocols.plate')
+        with pm.query_log.QueryCounter() as counter:
+            self.assertEqual([p.created_by for p in protocols],
+                             [pm.person.Person(1), pm.person.Person(1)])
+            self.assertEqual([p.plate for p in pool.protocols],
+                             [None, pm.plate.Plate('000000003')])
+        self.assertEqual(counter.count, 0)
+
+    def test_prefetch_str_id(self):
+        """Relations of objects instantiated with string ids are loaded"""
+        pm.sql.TRN.clear_identity_map()
+        self.assertEqual(pm.sample.Sample('1').sample_set, 'Sample Set 1')
+        self.assertEqual(pm.run.Run('1').pools, [pm.run.Pool(1)])
+        samples = pm.sample.Sample.from_ids(['1', '2'])
+        pm.prefetch(samples, 'plates')
+        self.assertEqual([s.plates for s in samples],
+                         [[pm.plate.Plate('000000003')]] * 2)
+
+    def test_prefetch_error(self):
+        """Raises an error for relations not defined"""
+        with self.assertRaises(pm.exceptions.DeveloperError):
+            pm.prefetch([self.tester], 'plates.bad')
+
+    def test_relation_refresh(self):
+        """Relations are read again after changes"""
+        plate = pm.plate.Plate('000000003')
+        self.assertEqual(len(plate.samples), 3)
+        self.assertEqual(len(pm.sample.Sample(4).plates), 0)
+        plate[0, 5] = pm.sample.Sample(4)
+        self.assertEqual(len(plate.samples), 4)
+        self.assertEqual(pm.sample.Sample(4).plates, [plate])
+
+    def test_slots(self):
+        """Objects do not have a __dict__"""
+        objects = [self.tester, pm.person.Person(1), pm.person.User('User1'),
+                   pm.plate.Plate('000000003'), pm.project.Project(1),
+                   pm.protocol.ExtractionProtocol(1),
+                   pm.protocol.PCRProtocol(3), pm.run.Run(1), pm.run.Pool(1)]
+        for obj in objects:
+            self.assertFalse(hasattr(obj, '__dict__'), type(obj))
+        with self.assertRaises(AttributeError):
+            self.tester.bad_attribute = 1
+
     def test_check_subclass(self):
         """Nothing happens if check_subclass called from a subclass"""
         self.tester._check_subclass()
@@ -73,5 +233,21 @@ class QiitaBaseTest(TestCase):
         test_dict[self.tester] = 1
         self.assertEqual(test_dict[self.tester], 1)
 
+    def test_identity_map(self):
+        """The same instance is returned in the transaction without queries"""
+        with pm.query_log.QueryCounter() as counter:
+            new = pm.sample.Sample(1)
+        self.assertIs(new, self.tester)
+        self.assertEqual(counter.count, 0)
+        # Objects of different classes do not collide
+        self.assertIsNot(pm.person.Person(1), self.tester)
+
+    def test_identity_map_rollback(self):
+        """The identity map is cleared on rollback"""
+        pm.sql.TRN.rollback()
+        new = pm.sample.Sample(1)
+        self.assertIsNot(new, self.tester)
+        self.assertEqual(new, self.tester)
+
 if __name__ == '__main__':
     main()
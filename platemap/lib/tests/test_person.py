@@ -92,6 +92,12 @@ class TestPerson(TestCase):
         self.person1.phone = '222-3333'
         self.assertEqual(self.person1.phone, '222-3333')
 
+    def test_update(self):
+        self.person1.update(name='Changed name', phone=None)
+        self.assertEqual(self.person1.name, 'Changed name')
+        self.assertEqual(self.person1.phone, None)
+        self.assertEqual(self.person1.email, 'test@foo.bar')
+
 
 @pm.util.rollback_tests()
 class TestUser(TestCase):
@@ -7,6 +7,9 @@
 # -----------------------------------------------------------------------------
 from unittest import TestCase, main
 
+import numpy as np
+import numpy.testing as npt
+
 import platemap as pm
 
 
@@ -106,6 +109,52 @@ class TestPlate(TestCase):
         with self.assertRaises(pm.exceptions.EditError):
             self.plate[0, 0] = samp
 
+    def test_assign(self):
+        samp1 = pm.sample.Sample(1)
+        samp2 = pm.sample.Sample(2)
+        samp3 = pm.sample.Sample(3)
+        self.plate.shape
+
+        with pm.query_log.QueryCounter() as counter:
+            self.plate.assign({(0, 0): samp3, (0, 11): samp1, (7, 11): samp2,
+                               (1, 1): samp2, (1, 2): None, (2, 3): None,
+                               (5, 5): None})
+            pm.sql.TRN.execute()
+        # One upsert and one delete
+        self.assertEqual(counter.count, 2)
+
+        exp = np.full((8, 12), -1)
+        exp[0, 0] = 3
+        exp[0, 11] = 1
+        exp[1, 1] = 2
+        exp[7, 11] = 2
+        npt.assert_array_equal(self.plate.layout.ids, exp)
+        self.assertEqual(self.plate.samples, [samp3, samp1, samp2, samp2])
+
+    def test_assign_refreshes_removed(self):
+        samp2 = pm.sample.Sample(2)
+        samp3 = pm.sample.Sample(3)
+        self.assertEqual(samp2.plates, [self.plate])
+        self.assertEqual(samp3.plates, [self.plate])
+
+        # Samples overwritten or cleared from their wells are refreshed too
+        self.plate.assign({(1, 2): pm.sample.Sample(4), (2, 3): None})
+        self.assertEqual(samp2.plates, [])
+        self.assertEqual(samp3.plates, [])
+        self.assertEqual(pm.sample.Sample(4).plates, [self.plate])
+
+    def test_assign_outside_plate(self):
+        samp = pm.sample.Sample(1)
+        with self.assertRaises(IndexError):
+            self.plate.assign({(0, 0): samp, (8, 0): samp})
+        # Nothing is assigned if any of the wells is not on the plate
+        self.assertIsNone(self.plate[0, 0])
+
+    def test_assign_finalized(self):
+        self.plate.finalize()
+        with self.assertRaises(pm.exceptions.EditError):
+            self.plate.assign({(0, 0): pm.sample.Sample(1)})
+
     def test_getitem(self):
         samp1 = pm.sample.Sample(1)
         samp3 = pm.sample.Sample(3)
@@ -115,6 +164,82 @@ class TestPlate(TestCase):
         self.assertEqual(self.plate[2, 3], samp3)
         self.assertEqual(self.plate[7, 11], None)
 
+    def test_getitem_query(self):
+        pm.sql.TRN.clear_identity_map()
+        plate = pm.plate.Plate('000000003')
+        with pm.query_log.QueryCounter() as counter:
+            obs = plate[1, 2]
+            self.assertEqual(obs.name, 'Sample 2')
+        self.assertEqual(counter.count, 1)
+
+    def test_getitem_slice(self):
+        samp1 = pm.sample.Sample(1)
+        samp2 = pm.sample.Sample(2)
+        samp3 = pm.sample.Sample(3)
+
+        with pm.query_log.QueryCounter() as counter:
+            obs = self.plate[1, :]
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(obs.shape, (12,))
+        self.assertEqual(obs.tolist(), [None, samp1, samp2] + [None] * 9)
+
+        obs = self.plate[:, 3]
+        self.assertEqual(obs.tolist(), [None, None, samp3] + [None] * 5)
+
+        obs = self.plate[0:4:2, 1:4]
+        self.assertEqual(obs.tolist(), [[None, None, None],
+                                        [None, None, samp3]])
+
+        obs = self.plate[1:3, 1:4]
+        self.assertEqual(obs.tolist(), [[samp1, samp2, None],
+                                        [None, None, samp3]])
+
+    def test_getitem_mask(self):
+        mask = self.plate.layout.ids >= 0
+        obs = self.plate[mask]
+        self.assertEqual(obs.tolist(), [pm.sample.Sample(1),
+                                        pm.sample.Sample(2),
+                                        pm.sample.Sample(3)])
+
+        with self.assertRaises(IndexError):
+            self.plate[np.ones((2, 2), dtype=bool)]
+
+    def test_numpy_integer_positions(self):
+        row, col = np.argwhere(self.plate.layout.ids == 2)[0]
+        self.assertIsInstance(row, np.int64)
+        self.assertEqual(self.plate[row, col], pm.sample.Sample(2))
+
+        self.plate[row, col] = pm.sample.Sample(4)
+        self.assertEqual(self.plate[1, 2], pm.sample.Sample(4))
+        self.plate.assign({(np.int64(0), np.int64(0)): pm.sample.Sample(1),
+                           (row, col): None})
+        self.assertEqual(self.plate[np.int64(0), np.int64(0)],
+                         pm.sample.Sample(1))
+        self.assertIsNone(self.plate[row, col])
+
+    def test_setitem_slice(self):
+        samp1 = pm.sample.Sample(1)
+        samp2 = pm.sample.Sample(2)
+
+        self.plate.shape
+        with pm.query_log.QueryCounter() as counter:
+            self.plate[:, 11] = [samp1, samp2] * 4
+            pm.sql.TRN.execute()
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(self.plate[:, 11].tolist(), [samp1, samp2] * 4)
+
+        self.plate[0, :] = samp2
+        self.assertEqual(self.plate[0, :].tolist(), [samp2] * 12)
+
+        self.plate[self.plate.layout.ids == 2] = None
+        npt.assert_array_equal(self.plate.layout.ids[:, 11],
+                               [-1, -1, 1, -1, 1, -1, 1, -1])
+        self.assertEqual(self.plate.samples, [samp1, pm.sample.Sample(3),
+                                              samp1, samp1, samp1])
+
+        with self.assertRaises(ValueError):
+            self.plate[:, 0] = [samp1, samp2]
+
     def test_getitem_outside_plate(self):
         with self.assertRaises(IndexError):
             self.plate[-1, 0]
@@ -162,6 +287,43 @@ class TestPlate(TestCase):
                 None, None]]
         self.assertEqual(obs, exp)
 
+    def test_platemap_many_cols(self):
+        plate = pm.plate.Plate.create('000000009', 'new test plate',
+                                      pm.person.Person(1), 16, 24)
+        plate[1, 11] = pm.sample.Sample(1)
+        plate[11, 1] = pm.sample.Sample(2)
+        obs = plate.platemap
+        self.assertEqual(obs[1][11], pm.sample.Sample(1))
+        self.assertEqual(obs[11][1], pm.sample.Sample(2))
+        self.assertEqual(sum(s is not None for row in obs for s in row), 2)
+
+    def test_layout(self):
+        with pm.query_log.QueryCounter() as counter:
+            obs = self.plate.layout
+        self.assertEqual(counter.count, 1)
+
+        self.assertEqual(obs.ids.shape, (8, 12))
+        exp = np.full((8, 12), -1)
+        exp[1, 1:3] = [1, 2]
+        exp[2, 3] = 3
+        npt.assert_array_equal(obs.ids, exp)
+
+        exp = np.full((8, 12), None, dtype=object)
+        exp[1, 1:3] = ['Sample 1', 'Sample 2']
+        exp[2, 3] = 'Sample 3'
+        npt.assert_array_equal(obs.names, exp)
+
+        exp = np.full((8, 12), None, dtype=object)
+        exp[1, 1:3] = ['000000001', '000000002']
+        npt.assert_array_equal(obs.barcodes, exp)
+
+    def test_layout_empty(self):
+        plate = pm.plate.Plate.create('000000009', 'new test plate',
+                                      pm.person.Person(1), 2, 3)
+        obs = plate.layout
+        npt.assert_array_equal(obs.ids, np.full((2, 3), -1))
+        self.assertTrue((obs.names == None).all())  # noqa
+
     def test_to_html(self):
         obs = self.plate.to_html()
         exp = ('<table class="plate"><tr><th></th><th>1</th><th>2</th><th>3'
@@ -187,16 +349,47 @@ class TestPlate(TestCase):
                '<td></td></tr></table>')
         self.assertEqual(obs, exp)
 
+    def test_to_html_cached(self):
+        exp = self.plate.to_html()
+        with pm.query_log.QueryCounter() as counter:
+            obs = self.plate.to_html()
+        self.assertEqual(obs, exp)
+        self.assertEqual(counter.count, 0)
+
+        self.plate[0, 0] = pm.sample.Sample(1)
+        self.assertTrue(self.plate.to_html().startswith(
+            '<table class="plate"><tr><th></th><th>1</th><th>2</th><th>3'
+            '</th><th>4</th><th>5</th><th>6</th><th>7</th><th>8</th><th>9'
+            '</th><th>10</th><th>11</th><th>12</th></tr><tr><th>A</th><td>'
+            'Sample 1</td>'))
+
+    def test_version(self):
+        versions = [self.plate.version]
+        self.plate[0, 0] = pm.sample.Sample(1)
+        versions.append(self.plate.version)
+        self.plate[0, 0] = None
+        versions.append(self.plate.version)
+        self.plate.finalize()
+        versions.append(self.plate.version)
+        self.plate.revert(pm.person.User('User1'))
+        versions.append(self.plate.version)
+        self.assertEqual(len(set(versions)), 5)
+        self.assertEqual(versions, sorted(versions))
+
     def test_finalize(self):
         self.assertFalse(self.plate.finalized)
+        version = self.plate.version
         self.plate.finalize()
         self.assertTrue(self.plate.finalized)
+        self.assertNotEqual(self.plate.version, version)
 
     def test_revert(self):
         self.plate.finalize()
         self.assertTrue(self.plate.finalized)
+        version = self.plate.version
         self.plate.revert(pm.person.User('User1'))
         self.assertFalse(self.plate.finalized)
+        self.assertNotEqual(self.plate.version, version)
 
     def test_revert_not_admin(self):
         with self.assertRaises(pm.exceptions.AssignError):
@@ -23,11 +23,20 @@ class TestProject(TestCase):
         self.assertFalse(pm.util.check_barcode_assigned('000000006'))
         self.assertFalse(pm.util.check_barcode_assigned('000000007'))
 
-        pm.project.Project.assign_barcodes('Sample Set 1', 2)
+        obs = pm.project.Project.assign_barcodes('Sample Set 1', 2)
+        self.assertEqual(obs, 2)
 
         self.assertTrue(pm.util.check_barcode_assigned('000000005'))
         self.assertTrue(pm.util.check_barcode_assigned('000000006'))
         self.assertFalse(pm.util.check_barcode_assigned('000000007'))
+        self.assertEqual(
+            pm.util.check_barcodes(['000000005'])['000000005'],
+            pm.util.BarcodeStatus('sample_set', 'Sample Set 1'))
+
+    def test_assign_barcodes_error(self):
+        with self.assertRaises(ValueError):
+            pm.project.Project.assign_barcodes('Sample Set 1', 2000000)
+        self.assertFalse(pm.util.check_barcode_assigned('000000005'))
 
     def test_create(self):
         obs = pm.project.Project.create(
@@ -40,6 +49,8 @@ class TestProject(TestCase):
         self.assertEqual(obs.contact, 'contact')
         self.assertEqual(obs.samples, {})
         self.assertEqual(obs.sample_sets, ['NewSampleSet'])
+        self.assertEqual(pm.util.convert_from_id(obs.id, 'project'),
+                         'NewTestProj')
 
     def test_create_barcodes(self):
         self.assertFalse(pm.util.check_barcode_assigned('000000005'))
@@ -107,6 +118,11 @@ class TestProject(TestCase):
         self.project.contact = 'New Test Contact Person'
         self.assertEqual(self.project.contact, 'New Test Contact Person')
 
+    def test_update(self):
+        self.project.update(pi='New PI', contact='New Contact')
+        self.assertEqual(self.project.pi, 'New PI')
+        self.assertEqual(self.project.contact, 'New Contact')
+
     def test_add_samples(self):
         self.assertEqual(self.project.samples,
                          {'Sample Set 1': [pm.sample.Sample(1),
@@ -138,6 +154,9 @@ class TestProject(TestCase):
         self.project.add_sample_set('New Test Sample Set', pm.person.Person(1))
         self.assertEqual(self.project.sample_sets, ['Sample Set 1',
                                                     'New Test Sample Set'])
+        ss_id = pm.util.convert_to_id('New Test Sample Set', 'sample_set')
+        self.assertEqual(pm.util.convert_from_id(ss_id, 'sample_set'),
+                         'New Test Sample Set')
 
     def test_remove_sample_set(self):
         self.project.add_sample_set('New Test Sample Set', pm.person.Person(1))
@@ -151,8 +170,14 @@ class TestProject(TestCase):
     def test_clear_barcodes(self):
         proj = pm.project.Project(3)
         self.assertTrue(pm.util.check_barcode_assigned('000000004'))
-        proj.clear_barcodes()
+        self.assertEqual(proj.clear_barcodes(), 1)
         self.assertFalse(pm.util.check_barcode_assigned('000000004'))
+        self.assertEqual(proj.clear_barcodes(), 0)
+
+        pm.project.Project.assign_barcodes('Sample Set 3', 2)
+        self.assertEqual(proj.clear_barcodes(), 2)
+        # The barcodes cleared can be allocated again
+        self.assertEqual(pm.util.get_barcodes(2), ['000000004', '000000005'])
 
 
 if __name__ == "__main__":
@@ -71,6 +71,10 @@ class TestExtractionProtocol(TestCase):
         with self.assertRaises(pm.exceptions.UnknownIDError):
             pm.protocol.ExtractionProtocol(4)
 
+    def test_from_ids_wrong_subclass(self):
+        with self.assertRaises(pm.exceptions.UnknownIDError):
+            pm.protocol.ExtractionProtocol.from_ids([1, 4])
+
     def test_protocols(self):
         obs = pm.protocol.ExtractionProtocol.protocols()
         exp = [self.extract_protocol1, self.extract_protocol2]
@@ -163,6 +167,10 @@ class TestPCRProtocol(TestCase):
         with self.assertRaises(pm.exceptions.UnknownIDError):
             pm.protocol.PCRProtocol(1)
 
+    def test_from_ids_wrong_subclass(self):
+        with self.assertRaises(pm.exceptions.UnknownIDError):
+            pm.protocol.PCRProtocol.from_ids([3, 1])
+
     def test_protocols(self):
         obs = pm.protocol.PCRProtocol.protocols()
         exp = [self.pcr_protocol3, self.pcr_protocol4,
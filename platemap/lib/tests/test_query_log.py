@@ -0,0 +1,219 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2016--, The Plate Mapper Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+from unittest import TestCase, main
+import asyncio
+import logging
+
+from platemap.lib.query_log import (
+    QueryLog, QueryRecord, QueryStats, RingBufferSink, LoggerSink,
+    QueryCounter, normalize_sql, redact_args)
+from platemap.lib.sql_connection import Transaction
+from platemap.lib.exceptions import QueryBudgetError
+
+
+class TestQueryLog(TestCase):
+    def setUp(self):
+        self.log = QueryLog()
+        self.sink = RingBufferSink(3)
+        self.log.add_sink(self.sink)
+
+    def test_normalize_sql(self):
+        obs = normalize_sql("""SELECT plate_id, 'a''b'
+                               FROM barcodes.plate
+                               WHERE plate_id IN (1, 2, 3) AND name = %s
+                               AND rows > %(rows)s LIMIT 1.5""")
+        self.assertEqual(obs, "SELECT plate_id, ? FROM barcodes.plate WHERE "
+                              "plate_id IN (?) AND name = ? AND rows > ? "
+                              "LIMIT ?")
+
+    def test_redact_args(self):
+        self.assertEqual(redact_args(None), 'None')
+        self.assertEqual(redact_args(['secret', 1, None]),
+                         '[<str>, <int>, <NoneType>]')
+        self.assertEqual(redact_args({'pass': 'secret', 'id': 1}),
+                         "{'id': <int>, 'pass': <str>}")
+
+    def test_record(self):
+        self.log.record("SELECT %s", [1], 0.5, 1)
+        self.log.record("SELECT  %s", [2], 0.25, 1)
+        self.log.record("INSERT INTO t VALUES (%s)", [1], 1.0, 10, 10)
+
+        obs = self.log.snapshot()
+        self.assertEqual(obs, {
+            'SELECT ?': QueryStats(2, 0.75, 0.5, 2),
+            'INSERT INTO t VALUES (?)': QueryStats(10, 1.0, 1.0, 10)})
+
+        obs = self.sink.records()
+        self.assertEqual([r[:4] for r in obs],
+                         [('SELECT ?', 0.5, 1, 1), ('SELECT ?', 0.25, 1, 1),
+                          ('INSERT INTO t VALUES (?)', 1.0, 10, 10)])
+        self.assertTrue(all(isinstance(r, QueryRecord) for r in obs))
+
+        self.log.reset()
+        self.assertEqual(self.log.snapshot(), {})
+
+    def test_ring_buffer(self):
+        for i in range(5):
+            self.log.record("SELECT %d" % i, None, i, -1)
+        obs = self.sink.records()
+        self.assertEqual([r.duration for r in obs], [2, 3, 4])
+        # Unknown row counts are not aggregated
+        self.assertEqual(self.log.snapshot()['SELECT ?'].rows, 0)
+        self.sink.clear()
+        self.assertEqual(self.sink.records(), [])
+
+    def test_callback_sink(self):
+        obs = []
+        self.log.add_sink(obs.append)
+        self.log.record("SELECT 1", None, 0.1, 1)
+        self.assertEqual(len(obs), 1)
+        self.assertEqual(obs[0].sql, 'SELECT ?')
+
+        self.log.remove_sink(obs.append)
+        self.log.record("SELECT 1", None, 0.1, 1)
+        self.assertEqual(len(obs), 1)
+        self.assertEqual(len(self.sink.records()), 2)
+
+    def test_logger_sink(self):
+        logger = logging.getLogger('platemap.test.sql')
+        self.log.add_sink(LoggerSink(logger, logging.INFO))
+        with self.assertLogs(logger, logging.INFO) as cm:
+            self.log.record("SELECT 1", None, 0.1, 1)
+        self.assertEqual(cm.output, [
+            'INFO:platemap.test.sql:100.00 ms, 1 rows, 1 executions: '
+            'SELECT ?'])
+
+    def test_slow_query(self):
+        logger = logging.getLogger('platemap.test.slow')
+        log = QueryLog(0.5, logger)
+        with self.assertLogs(logger) as cm:
+            log.record("SELECT * FROM person WHERE password = %s",
+                       ['secret'], 0.1, 1)
+            log.record("SELECT * FROM person WHERE password = %s",
+                       ['secret'], 0.75, 1)
+        self.assertEqual(cm.output, [
+            'WARNING:platemap.test.slow:Slow query: 750.00 ms, 1 rows, '
+            '1 executions\nQuery: SELECT * FROM person WHERE password = ?\n'
+            'Arguments: [<str>]'])
+
+    def test_transaction(self):
+        trn = Transaction(query_log=self.log)
+        with trn:
+            trn.add("SELECT generate_series(1, %s)", [3])
+            trn.add("SELECT %s", [[1], [2]], many=True)
+            trn.execute()
+            list(trn.iter_query("SELECT generate_series(1, %s)", [5]))
+
+        obs = self.log.snapshot()
+        self.assertEqual(
+            {sql: (s.executions, s.rows) for sql, s in obs.items()},
+            {'SELECT generate_series(?, ?)': (2, 8), 'SELECT ?': (2, 2)})
+
+
+class TestQueryCounter(TestCase):
+    def setUp(self):
+        self.log = QueryLog()
+
+    def test_count(self):
+        self.log.record("SELECT 1", None, 0.1, 1)
+        with QueryCounter() as outer:
+            self.log.record("SELECT 1", None, 0.1, 1)
+            with QueryCounter() as inner:
+                self.log.record("SELECT 2", None, 0.1, 1)
+                self.log.record("SELECT name FROM t WHERE id = %s", [1], 0.1,
+                                1)
+            self.log.record("SELECT name FROM t WHERE id = %s", [2], 0.1, 1)
+        self.log.record("SELECT 1", None, 0.1, 1)
+
+        self.assertEqual(outer.count, 4)
+        self.assertEqual(outer.statements,
+                         {'SELECT ?': 2,
+                          'SELECT name FROM t WHERE id = ?': 2})
+        self.assertEqual(outer.repeated, outer.statements)
+        self.assertEqual(inner.count, 2)
+        self.assertEqual(inner.repeated, {})
+        self.assertFalse(outer.exceeded())
+
+    def test_budget(self):
+        with self.assertRaises(QueryBudgetError):
+            with QueryCounter(1):
+                self.log.record("SELECT 1", None, 0.1, 1)
+                self.log.record("SELECT 2", None, 0.1, 1)
+
+        with QueryCounter(2):
+            self.log.record("SELECT 1", None, 0.1, 1)
+            self.log.record("SELECT 2", None, 0.1, 1)
+
+    def test_repeat_budget(self):
+        with self.assertRaises(AssertionError):
+            with QueryCounter(repeat_budget=1):
+                self.log.record("SELECT 1", None, 0.1, 1)
+                self.log.record("SELECT 2", None, 0.1, 1)
+
+        with QueryCounter(repeat_budget=2):
+            self.log.record("SELECT 1", None, 0.1, 1)
+            self.log.record("SELECT 2", None, 0.1, 1)
+
+    def test_start_stop(self):
+        counter = QueryCounter(1)
+        counter.start()
+        self.log.record("SELECT 1", None, 0.1, 1)
+        self.log.record("SELECT 2", None, 0.1, 1)
+        counter.stop()
+        self.log.record("SELECT 3", None, 0.1, 1)
+        self.assertEqual(counter.count, 2)
+        self.assertTrue(counter.exceeded())
+        with self.assertRaises(QueryBudgetError):
+            counter.check()
+
+    def test_tasks(self):
+        async def request(value, event, other):
+            with QueryCounter() as counter:
+                self.log.record("SELECT %d" % value, None, 0.1, 1)
+                event.set()
+                # Wait for the other task to record its query too
+                await other.wait()
+                self.log.record("SELECT %d" % value, None, 0.1, 1)
+            return counter.count
+
+        async def run():
+            ev1, ev2 = asyncio.Event(), asyncio.Event()
+            with QueryCounter() as outer:
+                obs = await asyncio.gather(request(1, ev1, ev2),
+                                           request(2, ev2, ev1))
+            return outer.count, obs
+
+        loop = asyncio.new_event_loop()
+        try:
+            with QueryCounter(process_wide=True) as process:
+                outer, obs = loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+        # Each request only counts its own queries, the tasks spawned are
+        # counted by the counters of their parents
+        self.assertEqual(obs, [2, 2])
+        self.assertEqual(outer, 4)
+        self.assertEqual(process.count, 4)
+
+    def test_report(self):
+        counter = QueryCounter(5, 2)
+        counter.start()
+        for i in range(3):
+            self.log.record("SELECT %d FROM t" % i, None, 0.1, 1)
+            self.log.record("SELECT %s", [i], 0.1, 1)
+        self.log.record("SELECT 1", None, 0.1, 1)
+        counter.stop()
+        self.assertEqual(counter.report(),
+                         '7 queries (budget 5), 2 distinct (repeat budget 2)\n'
+                         '     4x SELECT ?\n'
+                         '     3x SELECT ? FROM t')
+
+
+if __name__ == '__main__':
+    main()
@@ -53,6 +53,41 @@ class TestSample(TestCase):
         self.assertEqual(len(pm.sample.Sample.search(barcode='000000008')), 1)
         self.assertEqual(len(pm.sample.Sample.search(barcode='000000009')), 1)
 
+    def test_from_file_error(self):
+        file = StringIO('sample_name\tbarcode\ntest1\t000000008\n'
+                        'Sample 1\t000000001\ntest2\t000000009\n')
+        with self.assertRaises(pm.exceptions.DuplicateError):
+            pm.sample.Sample.from_file(file, 'test', 'freezer',
+                                       'Sample Set 1', pm.person.Person(1))
+        # Nothing is created if a sample fails
+        self.assertEqual(len(pm.sample.Sample.search(sample_type='test')), 0)
+
+    def test_from_file_errors(self):
+        file = StringIO('sample_name\tbarcode\ntest1\t000000008\n'
+                        'Sample 1\t000000001\ntest2\t000000003\n'
+                        'test3\t000000009\n')
+        errors = []
+        obs = pm.sample.Sample.from_file(file, 'test', 'freezer',
+                                         'Sample Set 1', pm.person.Person(1),
+                                         errors=errors)
+        self.assertEqual(obs, 2)
+        self.assertEqual(errors, [
+            (3, 'Sample 1', "The object with name 'Sample 1' already exists "
+                            "in table 'sample'"),
+            (4, 'test2', 'Barcode 000000003 already assigned!')])
+        obs = pm.sample.Sample.search(sample_type='test')
+        self.assertEqual(sorted(s.name for s in obs), ['test1', 'test3'])
+        self.assertEqual(len(pm.sample.Sample.search(barcode='000000008')), 1)
+        self.assertEqual(len(pm.sample.Sample.search(barcode='000000009')), 1)
+
+    def test_from_names(self):
+        obs = pm.sample.Sample.from_names(['Sample 1', 'Sample 3', 'Sample 3',
+                                           'UNKNOWN'])
+        self.assertEqual(obs, {
+            'Sample 1': [pm.sample.Sample(1)],
+            'Sample 3': [pm.sample.Sample(3), pm.sample.Sample(5)]})
+        self.assertEqual(pm.sample.Sample.from_names([]), {})
+
     def test_search(self):
         obs = pm.sample.Sample.search(name='Sample 1')
         exp = [pm.sample.Sample(1)]
@@ -240,6 +275,23 @@ class TestSample(TestCase):
         self.sample1.biomass_remaining = False
         self.assertFalse(self.sample1.biomass_remaining)
 
+    def test_update(self):
+        with pm.query_log.QueryCounter() as counter:
+            self.sample1.update(sample_type='test type',
+                                location='NEW TEST PLACE!',
+                                biomass_remaining=False)
+            self.assertEqual(self.sample1.sample_type, 'test type')
+            self.assertEqual(self.sample1.location, 'NEW TEST PLACE!')
+            self.assertFalse(self.sample1.biomass_remaining)
+        self.assertEqual(counter.count, 1)
+        self.sample1.refresh()
+        self.assertEqual(self.sample1.location, 'NEW TEST PLACE!')
+
+    def test_update_error(self):
+        with self.assertRaises(pm.exceptions.DeveloperError):
+            self.sample1.update(location='NEW TEST PLACE!', barcode='1')
+        self.assertEqual(self.sample1.location, 'the freezer')
+
     def test_created_on(self):
         self.assertEqual(self.sample1.created_on, datetime(2016, 2, 22, 8, 52))
 
@@ -6,15 +6,21 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 from unittest import TestCase, main
+from decimal import Decimal
 from os import remove, close
 from os.path import exists
 from tempfile import mkstemp
+from threading import Thread, Barrier
+import asyncio
 
 from psycopg2._psycopg import connection
 from psycopg2 import connect
 from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 
-from platemap.lib.sql_connection import Transaction, TRN
+from platemap.lib.sql_connection import (Transaction, TRN, POOL,
+                                         ConnectionPool, LocalTransaction,
+                                         StatementCache, _split_values,
+                                         _param_type)
 from platemap.lib.config_manager import pm_config
 
 
@@ -24,6 +30,12 @@ DB_TEST_TABLE = """CREATE TABLE barcodes.test_table (
     int_column      bigint NOT NULL);"""
 
 
+class IdentityObject(object):
+    """Object identified by an id, stored in the identity maps"""
+    def __init__(self, id_):
+        self.id = id_
+
+
 class TestBase(TestCase):
     def setUp(self):
         # Add the test table to the database, so we can use it in the tests
@@ -70,6 +82,334 @@ class TestBase(TestCase):
 
         self.assertEqual(obs, exp)
 
+    def _assert_connection_released(self):
+        """Aux function to check TRN gave its connection back to the pool"""
+        self.assertEqual(TRN._connection, None)
+        self.assertEqual(POOL.stats()['in_use'], 0)
+        conn = POOL.getconn()
+        try:
+            self.assertEqual(conn.get_transaction_status(),
+                             TRANSACTION_STATUS_IDLE)
+        finally:
+            POOL.putconn(conn)
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(0, 2, 300, checkout_timeout=0.1)
+
+    def tearDown(self):
+        self.pool.closeall()
+
+    def test_init_error(self):
+        with self.assertRaises(ValueError):
+            ConnectionPool(0, 0, 300)
+
+        with self.assertRaises(ValueError):
+            ConnectionPool(3, 2, 300)
+
+    def test_getconn_putconn(self):
+        conn = self.pool.getconn()
+        self.assertTrue(isinstance(conn, connection))
+        obs = self.pool.stats()
+        self.assertEqual(obs['size'], 1)
+        self.assertEqual(obs['in_use'], 1)
+        self.assertEqual(obs['idle'], 0)
+        self.assertEqual(obs['checkouts'], 1)
+
+        self.pool.putconn(conn)
+        obs = self.pool.stats()
+        self.assertEqual(obs['size'], 1)
+        self.assertEqual(obs['in_use'], 0)
+        self.assertEqual(obs['idle'], 1)
+
+        # The idle connection is reused
+        self.assertTrue(self.pool.getconn() is conn)
+        self.assertEqual(self.pool.stats()['size'], 1)
+        self.pool.putconn(conn)
+
+    def test_getconn_timeout(self):
+        conns = [self.pool.getconn(), self.pool.getconn()]
+        with self.assertRaises(RuntimeError):
+            self.pool.getconn()
+        obs = self.pool.stats()
+        self.assertEqual(obs['in_use'], 2)
+        self.assertEqual(obs['checkouts'], 2)
+        for conn in conns:
+            self.pool.putconn(conn)
+
+    def test_putconn_rollback(self):
+        conn = self.pool.getconn()
+        with conn.cursor() as cur:
+            cur.execute("SELECT 42")
+        self.pool.putconn(conn)
+        self.assertEqual(conn.get_transaction_status(),
+                         TRANSACTION_STATUS_IDLE)
+
+    def test_putconn_closed(self):
+        conn = self.pool.getconn()
+        conn.close()
+        self.pool.putconn(conn)
+        obs = self.pool.stats()
+        self.assertEqual(obs['size'], 0)
+        self.assertEqual(obs['idle'], 0)
+        self.assertFalse(self.pool.getconn() is conn)
+
+    def test_putconn_close(self):
+        conn = self.pool.getconn()
+        self.pool.putconn(conn, close=True)
+        self.assertNotEqual(conn.closed, 0)
+        self.assertEqual(self.pool.stats()['size'], 0)
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(1, 2, 0)
+        conns = [pool.getconn(), pool.getconn()]
+        for conn in conns:
+            pool.putconn(conn)
+        # Only min_size connections survive the timeout
+        obs = pool.stats()
+        self.assertEqual(obs['size'], 1)
+        self.assertEqual(obs['idle'], 1)
+        self.assertNotEqual(conns[0].closed, 0)
+        pool.closeall()
+        self.assertEqual(pool.stats()['size'], 0)
+
+
+class TestStatementCache(TestBase):
+    def setUp(self):
+        super(TestStatementCache, self).setUp()
+        self.pool = ConnectionPool(0, 1, 300, statement_cache_size=2)
+
+    def tearDown(self):
+        self.pool.closeall()
+        super(TestStatementCache, self).tearDown()
+
+    def _prepared(self, trn):
+        trn.add("SELECT name FROM pg_prepared_statements ORDER BY name")
+        return [row[0] for row in trn.execute_fetchindex()]
+
+    def test_param_type(self):
+        self.assertEqual(_param_type('foo'), 'unknown')
+        self.assertEqual(_param_type(None), 'unknown')
+        self.assertEqual(_param_type(True), 'boolean')
+        self.assertEqual(_param_type(42), 'integer')
+        self.assertEqual(_param_type(2 ** 40), 'bigint')
+        self.assertIsNone(_param_type(2 ** 70))
+        self.assertIsNone(_param_type(4.2))
+        self.assertIsNone(_param_type([1, 2]))
+
+    def test_disabled(self):
+        cache = StatementCache(0)
+        self.assertEqual(cache.statement(None, "SELECT 42", None),
+                         "SELECT 42")
+        self.assertEqual(cache.statement(None, "SELECT 42", None),
+                         "SELECT 42")
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.misses, 2)
+
+    def test_statement(self):
+        trn = Transaction(self.pool)
+        sql = "SELECT %s, %s + 1, %s"
+        with trn:
+            for _ in range(3):
+                trn.add(sql, ['foo', 41, True])
+                self.assertEqual(trn.execute_fetchindex(),
+                                 [['foo', 42, True]])
+            trn.add(sql, ['bar', 1, False])
+            self.assertEqual(trn.execute_fetchindex(), [['bar', 2, False]])
+            # Arguments of different types use a different statement
+            trn.add(sql, ['foo', 2 ** 40, None])
+            self.assertEqual(trn.execute_fetchindex(),
+                             [['foo', 2 ** 40 + 1, None]])
+            self.assertEqual(self._prepared(trn), ['pm_stmt_0'])
+
+        obs = self.pool.stats()
+        self.assertEqual(obs['prepared_statements'], 1)
+        self.assertEqual(obs['statement_hits'], 2)
+        self.assertEqual(obs['statement_misses'], 4)
+
+    def test_statement_dict(self):
+        trn = Transaction(self.pool)
+        sql = "SELECT %(a)s || %(b)s, %(a)s LIKE '%%o'"
+        with trn:
+            for _ in range(3):
+                trn.add(sql, {'a': 'foo', 'b': 'bar'})
+                self.assertEqual(trn.execute_fetchindex(),
+                                 [['foobar', True]])
+            self.assertEqual(self._prepared(trn), ['pm_stmt_0'])
+
+    def test_statement_evicted(self):
+        trn = Transaction(self.pool)
+        with trn:
+            for i in range(3):
+                sql = "SELECT %s + " + str(i)
+                for _ in range(2):
+                    trn.add(sql, [1])
+                    self.assertEqual(trn.execute_fetchlast(), i + 1)
+            # The statements for the first query were deallocated
+            self.assertEqual(self._prepared(trn), ['pm_stmt_1', 'pm_stmt_2'])
+
+    def test_statement_evicted_error(self):
+        trn = Transaction(self.pool)
+        with trn:
+            trn.add("INSERT INTO barcodes.test_table (int_column) VALUES (1)")
+            for i in range(2):
+                sql = "SELECT %s + " + str(i)
+                for _ in range(2):
+                    trn.add(sql, [1])
+                    self.assertEqual(trn.execute_fetchlast(), i + 1)
+            # Deallocating the evicted statement fails
+            trn.add("DEALLOCATE pm_stmt_0")
+            trn.execute()
+            for _ in range(3):
+                trn.add("SELECT %s + 2", [1])
+                self.assertEqual(trn.execute_fetchlast(), 3)
+            # The transaction is still usable
+            trn.add("SELECT COUNT(*) FROM barcodes.test_table")
+            self.assertEqual(trn.execute_fetchlast(), 1)
+            # The new statement was prepared anyway
+            self.assertEqual(self._prepared(trn), ['pm_stmt_1', 'pm_stmt_2'])
+
+    def test_statement_not_prepared(self):
+        trn = Transaction(self.pool)
+        with trn:
+            trn.add("INSERT INTO barcodes.test_table (int_column) VALUES (1)")
+            for _ in range(3):
+                # postgres can not find out the type of the argument
+                trn.add("SELECT %s IS NULL", [None])
+                # Multiple statements
+                trn.add("SELECT 1; SELECT 2")
+                # Statements other than SELECT, INSERT, UPDATE or DELETE
+                trn.add("SHOW search_path")
+                # Arguments whose type is not known
+                trn.add("SELECT %s", [4.2])
+            obs = trn.execute()
+            self.assertEqual(obs[1:5], [[[True]], [[2]], [['"$user", public']],
+                                        [[Decimal('4.2')]]])
+            self.assertEqual(self._prepared(trn), [])
+            # The transaction is still usable after the failed PREPARE
+            trn.add("SELECT COUNT(*) FROM barcodes.test_table")
+            self.assertEqual(trn.execute_fetchlast(), 1)
+
+        obs = self.pool.stats()
+        self.assertEqual(obs['statement_hits'], 0)
+        self.assertEqual(obs['statement_misses'], 15)
+
+
+class TestLocalTransaction(TestBase):
+    def test_forwarding(self):
+        trn = TRN._current()
+        self.assertTrue(isinstance(trn, Transaction))
+        self.assertTrue(TRN._current() is trn)
+        with TRN:
+            self.assertEqual(trn._contexts_entered, 1)
+            TRN._queries = [("SELECT 42", None)]
+            self.assertEqual(trn._queries, [("SELECT 42", None)])
+            self.assertEqual(TRN.index, 1)
+        self.assertEqual(trn._contexts_entered, 0)
+        self.assertEqual(trn._queries, [])
+
+    def test_threads(self):
+        trn = LocalTransaction()
+        barrier = Barrier(2, timeout=10)
+        obs = {}
+
+        def worker(value):
+            with trn:
+                trn.add("SELECT %s", [value])
+                # Wait for the other thread to queue its query too
+                barrier.wait()
+                obs[value] = (trn._current(), trn.execute_fetchlast())
+
+        threads = [Thread(target=worker, args=(i,)) for i in (1, 2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(obs[1][1], 1)
+        self.assertEqual(obs[2][1], 2)
+        self.assertFalse(obs[1][0] is obs[2][0])
+
+    def test_tasks(self):
+        trn = LocalTransaction()
+
+        async def worker(value, event, other):
+            with trn:
+                trn.add("SELECT %s", [value])
+                event.set()
+                # Wait for the other task to queue its query too
+                await other.wait()
+                return trn._current(), trn.execute_fetchlast()
+
+        async def run():
+            ev1, ev2 = asyncio.Event(), asyncio.Event()
+            return await asyncio.gather(worker(1, ev1, ev2),
+                                        worker(2, ev2, ev1))
+
+        loop = asyncio.new_event_loop()
+        try:
+            obs = loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+        self.assertEqual(obs[0][1], 1)
+        self.assertEqual(obs[1][1], 2)
+        self.assertFalse(obs[0][0] is obs[1][0])
+
+    def test_tasks_inside_transaction(self):
+        trn = LocalTransaction()
+
+        async def worker(value):
+            with trn:
+                trn.add("SELECT %s", [value])
+                # Let the other task queue its query too
+                await asyncio.sleep(0)
+                trn.add("SELECT %s", [value * 10])
+                return trn._current(), [row[0] for res in trn.execute()
+                                        for row in res]
+
+        async def run():
+            with trn:
+                obs = await asyncio.gather(worker(1), worker(2))
+                return trn._current(), trn._contexts_entered, obs
+
+        loop = asyncio.new_event_loop()
+        try:
+            outer, contexts, obs = loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+        # Each task spawned inside an open transaction gets its own
+        self.assertEqual([o[1] for o in obs], [[1, 10], [2, 20]])
+        self.assertFalse(obs[0][0] is obs[1][0])
+        self.assertFalse(outer is obs[0][0] or outer is obs[1][0])
+        self.assertEqual(contexts, 1)
+
+    def test_shared(self):
+        trn = LocalTransaction()
+
+        async def worker():
+            with trn:
+                return trn._current(), trn._contexts_entered
+
+        async def run():
+            with trn, trn.shared():
+                obs = await asyncio.gather(worker())
+                return trn._current(), obs[0]
+
+        loop = asyncio.new_event_loop()
+        try:
+            outer, (inner, contexts) = loop.run_until_complete(run())
+            # The transaction is only shared inside the context
+            other, _ = loop.run_until_complete(worker())
+        finally:
+            loop.close()
+
+        self.assertTrue(outer is inner)
+        self.assertEqual(contexts, 2)
+        self.assertFalse(other is outer)
+
 
 class TestTransaction(TestBase):
     def test_init(self):
@@ -78,9 +418,75 @@ class TestTransaction(TestBase):
         self.assertEqual(obs._results, [])
         self.assertEqual(obs._connection, None)
         self.assertEqual(obs._contexts_entered, 0)
+        self.assertEqual(obs._pool, POOL)
         with obs:
-            pass
-        self.assertTrue(isinstance(obs._connection, connection))
+            self.assertTrue(isinstance(obs._connection, connection))
+        # The connection goes back to the pool when leaving the context
+        self.assertEqual(obs._connection, None)
+
+    def test_init_pool(self):
+        pool = ConnectionPool(0, 1, 300)
+        obs = Transaction(pool)
+        self.assertEqual(obs._pool, pool)
+        with obs:
+            self.assertEqual(pool.stats()['in_use'], 1)
+        self.assertEqual(pool.stats()['in_use'], 0)
+        self.assertEqual(pool.stats()['idle'], 1)
+        pool.closeall()
+
+    def test_cursor_mode(self):
+        self.assertEqual(TRN.cursor_mode, 'dict')
+        with self.assertRaises(ValueError):
+            Transaction(cursor_mode='list')
+
+        trn = Transaction(cursor_mode='namedtuple')
+        sql = "SELECT 1 AS a, 2 AS b"
+        with trn:
+            trn.add(sql)
+            obs = trn.execute_fetchindex()
+            self.assertEqual(obs[0].b, 2)
+
+            trn.cursor_mode = 'tuple'
+            trn.add(sql)
+            self.assertEqual(trn.execute_fetchindex(), [(1, 2)])
+
+            trn.add(sql)
+            obs = trn.execute_fetchindex(cursor_mode='dict')
+            self.assertEqual(obs[0]['b'], 2)
+
+            trn.add(sql)
+            obs = trn.execute(cursor_mode='namedtuple')
+            self.assertEqual(obs[-1][0].a, 1)
+
+            obs = list(trn.iter_query(sql, cursor_mode='dict'))
+            self.assertEqual(obs[0]['a'], 1)
+
+            with self.assertRaises(ValueError):
+                trn.execute(cursor_mode='list')
+            with self.assertRaises(ValueError):
+                trn.cursor_mode = 'list'
+
+    def test_cursor_mode_fetch_helpers(self):
+        sql = "SELECT 1 AS a, 2 AS b"
+        with TRN:
+            TRN.add(sql)
+            self.assertEqual(TRN.execute_fetchlast(), 1)
+            self.assertEqual(TRN.execute()[-1], [(1, 2)])
+
+            TRN.add(sql)
+            self.assertEqual(TRN.execute_fetchflatten(), [1, 2])
+            self.assertEqual(TRN.execute()[-1], [(1, 2)])
+
+            TRN.add(sql)
+            self.assertEqual(TRN.execute_fetchflatten(cursor_mode='dict'),
+                             [1, 2])
+            self.assertEqual(TRN.execute()[-1][0]['a'], 1)
+
+            # The mode is set in the transaction of the current thread
+            TRN.cursor_mode = 'tuple'
+            TRN.add(sql)
+            self.assertEqual(TRN.execute_fetchindex(), [(1, 2)])
+            TRN.cursor_mode = 'dict'
 
     def test_add(self):
         with TRN:
@@ -192,6 +598,57 @@ class TestTransaction(TestBase):
                     ['insert2', False, 2]]]  # Third result select
             self.assertEqual(obs, exp)
 
+    def test_execute_many_batch(self):
+        with TRN:
+            sql = """INSERT INTO barcodes.test_table (str_column, int_column)
+                     VALUES (%s, %s)"""
+            args = [['insert%d' % i, i] for i in range(2500)]
+            TRN.add(sql, args, many=True)
+            sql = """UPDATE barcodes.test_table SET bool_column = %s
+                     WHERE int_column = %s"""
+            TRN.add(sql, [[False, i] for i in range(0, 2500, 2)], many=True)
+            sql = """SELECT bool_column FROM barcodes.test_table
+                     WHERE int_column = %s"""
+            TRN.add(sql, [[0], [1], [5000]], many=True)
+            obs = TRN.execute()
+            self.assertEqual(obs[:3750], [None] * 3750)
+            self.assertEqual(obs[3750:], [[[False]], [[True]], []])
+            self.assertEqual(TRN.index, 3753)
+
+    def test_execute_many_batch_error(self):
+        with TRN:
+            sql = """INSERT INTO barcodes.test_table (str_column, int_column)
+                     VALUES (%s, %s)"""
+            TRN.add(sql, [['insert1', 1], ['insert2', None]], many=True)
+            with self.assertRaises(ValueError):
+                TRN.execute()
+
+            sql = """INSERT INTO barcodes.test_table (int_column)
+                     VALUES (%s)"""
+            TRN.add(sql, [1])
+            sql = """UPDATE barcodes.test_table SET int_column = %s
+                     WHERE str_column = %s"""
+            TRN.add(sql, [[2, 'foo'], [None, 'foo']], many=True)
+            with self.assertRaises(ValueError):
+                TRN.execute()
+
+        self._assert_sql_equal([])
+
+    def test_split_values(self):
+        obs = _split_values("INSERT INTO t (a, b) VALUES (%s, lower(%s))")
+        self.assertEqual(obs, ("INSERT INTO t (a, b) VALUES ",
+                               "(%s, lower(%s))", ""))
+        obs = _split_values("""insert into t (a) values (%s, ')')
+                               returning a""")
+        self.assertEqual(obs, ("insert into t (a) values ", "(%s, ')')",
+                               "\n                               returning a"))
+        self.assertIsNone(_split_values("UPDATE t SET a = %s"))
+        self.assertIsNone(_split_values("INSERT INTO t VALUES (1), (%s)"))
+        self.assertIsNone(_split_values(
+            "INSERT INTO t VALUES (%s) RETURNING a + %s"))
+        self.assertIsNone(_split_values(
+            "INSERT INTO t VALUES (%s) ON CONFLICT DO NOTHING"))
+
     def test_execute_huge_transaction(self):
         with TRN:
             # Add a lot of inserts to the transaction
@@ -324,6 +781,73 @@ class TestTransaction(TestBase):
             obs = TRN.execute_fetchflatten(idx=3)
             self.assertEqual(obs, ['insert1', 1, 'insert2', 2, 'insert3', 3])
 
+    def test_execute_rowcounts(self):
+        with TRN:
+            sql = """INSERT INTO barcodes.test_table (str_column, int_column)
+                     VALUES (%s, %s)"""
+            args = [['insert1', 1], ['insert2', 2], ['insert3', 3]]
+            TRN.add(sql, args, many=True)
+            sql = """UPDATE barcodes.test_table SET bool_column = False
+                     WHERE int_column > %s"""
+            TRN.add(sql, [1])
+            sql = "DELETE FROM barcodes.test_table WHERE int_column = %s"
+            TRN.add(sql, [[1], [5]], many=True)
+            sql = "SELECT * FROM barcodes.test_table"
+            TRN.add(sql)
+            obs = TRN.execute_rowcounts()
+            self.assertEqual(obs, [1, 1, 1, 2, 1, 0, 2])
+
+            TRN.add("DELETE FROM barcodes.test_table")
+            obs = TRN.execute_rowcounts()
+            self.assertEqual(obs, [1, 1, 1, 2, 1, 0, 2, 2])
+            TRN.commit()
+
+            TRN.add("SELECT 42")
+            self.assertEqual(TRN.execute_rowcounts(), [1])
+
+    def test_execute_rowcounts_batched(self):
+        self._populate_test_table()
+        with TRN:
+            sql = "UPDATE barcodes.test_table SET bool_column = False " \
+                  "WHERE int_column = %s"
+            TRN.add(sql, [[1], [2], [5]], many=True)
+            # Queries already executed as a batch have unknown row counts
+            TRN.execute()
+            self.assertEqual(TRN.execute_rowcounts(), [1, -1, -1])
+
+            TRN.add(sql, [[1], [2], [5]], many=True)
+            self.assertEqual(TRN.execute_rowcounts(), [1, -1, -1, 1, 1, 0])
+
+    def test_iter_query(self):
+        self._populate_test_table()
+        with TRN:
+            sql = """SELECT str_column, int_column FROM barcodes.test_table
+                     WHERE int_column > %s ORDER BY int_column"""
+            obs = TRN.iter_query(sql, [1], chunk_size=2)
+            self.assertEqual(list(obs), [['test2', 2], ['test3', 3],
+                                         ['test4', 4]])
+            self.assertEqual(TRN._results, [])
+
+    def test_iter_query_pending_queries(self):
+        with TRN:
+            sql = "INSERT INTO barcodes.test_table (int_column) VALUES (%s)"
+            TRN.add(sql, [[1], [2], [3]], many=True)
+            obs = TRN.iter_query(
+                "SELECT int_column FROM barcodes.test_table ORDER BY 1")
+            self.assertEqual([r['int_column'] for r in obs], [1, 2, 3])
+            self.assertEqual(TRN._queries, [])
+
+    def test_iter_query_error(self):
+        with self.assertRaises(RuntimeError):
+            list(TRN.iter_query("SELECT 42"))
+
+        with TRN:
+            with self.assertRaises(TypeError):
+                list(TRN.iter_query("SELECT 42", 1))
+
+            with self.assertRaises(ValueError):
+                list(TRN.iter_query("SELECT * FROM barcodes.not_a_table"))
+
     def test_context_manager_rollback(self):
         try:
             with TRN:
@@ -337,9 +861,7 @@ class TestTransaction(TestBase):
         except ValueError:
             pass
         self._assert_sql_equal([])
-        self.assertEqual(
-            TRN._connection.get_transaction_status(),
-            TRANSACTION_STATUS_IDLE)
+        self._assert_connection_released()
 
     def test_context_manager_execute(self):
         with TRN:
@@ -351,9 +873,7 @@ class TestTransaction(TestBase):
 
         self._assert_sql_equal([('insert1', True, 1), ('insert2', True, 2),
                                 ('insert3', True, 3)])
-        self.assertEqual(
-            TRN._connection.get_transaction_status(),
-            TRANSACTION_STATUS_IDLE)
+        self._assert_connection_released()
 
     def test_context_manager_no_commit(self):
         with TRN:
@@ -367,9 +887,7 @@ class TestTransaction(TestBase):
 
         self._assert_sql_equal([('insert1', True, 1), ('insert2', True, 2),
                                 ('insert3', True, 3)])
-        self.assertEqual(
-            TRN._connection.get_transaction_status(),
-            TRANSACTION_STATUS_IDLE)
+        self._assert_connection_released()
 
     def test_context_manager_multiple(self):
         self.assertEqual(TRN._contexts_entered, 0)
@@ -397,9 +915,7 @@ class TestTransaction(TestBase):
         self.assertEqual(TRN._contexts_entered, 0)
         self._assert_sql_equal([('insert1', True, 1), ('insert2', True, 2),
                                 ('insert3', True, 3)])
-        self.assertEqual(
-            TRN._connection.get_transaction_status(),
-            TRANSACTION_STATUS_IDLE)
+        self._assert_connection_released()
 
     def test_context_manager_multiple_2(self):
         self.assertEqual(TRN._contexts_entered, 0)
@@ -428,9 +944,7 @@ class TestTransaction(TestBase):
         self.assertEqual(TRN._contexts_entered, 0)
         self._assert_sql_equal([('insert1', True, 1), ('insert2', True, 2),
                                 ('insert3', True, 3)])
-        self.assertEqual(
-            TRN._connection.get_transaction_status(),
-            TRANSACTION_STATUS_IDLE)
+        self._assert_connection_released()
 
     def test_post_commit_funcs(self):
         fd, fp = mkstemp()
@@ -482,6 +996,142 @@ class TestTransaction(TestBase):
                 TRN.add_post_rollback_func(func)
                 TRN.rollback()
 
+    def test_savepoint(self):
+        sql = "INSERT INTO barcodes.test_table (int_column) VALUES (%s)"
+        with TRN:
+            TRN.add(sql, [1])
+            with self.assertRaises(ValueError):
+                with TRN.savepoint():
+                    TRN.add(sql, [2])
+                    TRN.add(sql, [None])
+            TRN.add(sql, [3])
+            with TRN.savepoint():
+                TRN.add(sql, [4])
+
+        self._assert_sql_equal([('foo', True, 1), ('foo', True, 3),
+                                ('foo', True, 4)])
+        self._assert_connection_released()
+
+    def test_savepoint_nested(self):
+        sql = "INSERT INTO barcodes.test_table (int_column) VALUES (%s)"
+        with TRN:
+            with TRN.savepoint():
+                TRN.add(sql, [1])
+                with self.assertRaises(KeyError):
+                    with TRN.savepoint():
+                        TRN.add(sql, [2])
+                        TRN.execute()
+                        raise KeyError()
+                TRN.add(sql, [3])
+            with self.assertRaises(KeyError):
+                with TRN.savepoint():
+                    TRN.add(sql, [4])
+                    with TRN.savepoint():
+                        TRN.add(sql, [5])
+                    raise KeyError()
+
+        self._assert_sql_equal([('foo', True, 1), ('foo', True, 3)])
+        self._assert_connection_released()
+
+    def test_atomic(self):
+        sql = "INSERT INTO barcodes.test_table (int_column) VALUES (%s)"
+        with TRN.atomic():
+            TRN.add(sql, [1])
+        with TRN:
+            with self.assertRaises(KeyError):
+                with TRN.atomic():
+                    TRN.add(sql, [2])
+                    TRN.execute()
+                    raise KeyError()
+            TRN.add(sql, [3])
+
+        self._assert_sql_equal([('foo', True, 1), ('foo', True, 3)])
+        self._assert_connection_released()
+
+    def test_savepoint_results(self):
+        with TRN:
+            TRN.add("SELECT 42")
+            with self.assertRaises(KeyError):
+                with TRN.savepoint():
+                    TRN.add("SELECT 43")
+                    self.assertEqual(TRN.execute_fetchlast(), 43)
+                    self.assertEqual(TRN.index, 2)
+                    raise KeyError()
+            self.assertEqual(TRN.index, 1)
+            self.assertEqual(TRN.execute_fetchflatten(), [42])
+
+    def test_savepoint_funcs(self):
+        called = []
+        with TRN:
+            TRN.add_post_commit_func(called.append, 'commit1')
+            with self.assertRaises(KeyError):
+                with TRN.savepoint():
+                    TRN.add_post_commit_func(called.append, 'commit2')
+                    TRN.add_post_rollback_func(called.append, 'rollback')
+                    raise KeyError()
+            # The rollback functions of the savepoint run when it is rolled
+            # back, and its commit functions are discarded
+            self.assertEqual(called, ['rollback'])
+        self.assertEqual(called, ['rollback', 'commit1'])
+
+    def test_savepoint_commit(self):
+        sql = "INSERT INTO barcodes.test_table (int_column) VALUES (%s)"
+        with TRN:
+            with self.assertRaises(KeyError):
+                with TRN.savepoint():
+                    TRN.add(sql, [1])
+                    TRN.execute()
+                    TRN.commit()
+                    TRN.add(sql, [2])
+                    raise KeyError()
+            TRN.add(sql, [3])
+
+        self._assert_sql_equal([('foo', True, 1), ('foo', True, 3)])
+        self._assert_connection_released()
+
+    def test_identity_map(self):
+        obj = IdentityObject(1)
+        self.assertIsNone(TRN.get_object(IdentityObject, 1))
+        TRN.add_object(obj)
+        self.assertIsNone(TRN.get_object(IdentityObject, 1))
+
+        with TRN:
+            TRN.add_object(obj)
+            self.assertIs(TRN.get_object(IdentityObject, 1), obj)
+            self.assertIsNone(TRN.get_object(IdentityObject, 2))
+            self.assertIsNone(TRN.get_object(TestBase, 1))
+            TRN.clear_identity_map()
+            self.assertIsNone(TRN.get_object(IdentityObject, 1))
+
+            TRN.add_object(obj)
+            with self.assertRaises(KeyError):
+                with TRN.savepoint():
+                    raise KeyError()
+            self.assertIsNone(TRN.get_object(IdentityObject, 1))
+
+            TRN.add_object(obj)
+            TRN.commit()
+            self.assertIsNone(TRN.get_object(IdentityObject, 1))
+
+    def test_identity_scope(self):
+        obj = IdentityObject(1)
+        with TRN.identity_scope():
+            with TRN:
+                TRN.add_object(obj)
+            self.assertIs(TRN.get_object(IdentityObject, 1), obj)
+            with TRN.identity_scope():
+                with TRN:
+                    TRN.add("SELECT 42")
+                self.assertIs(TRN.get_object(IdentityObject, 1), obj)
+            self.assertIs(TRN.get_object(IdentityObject, 1), obj)
+
+            with TRN:
+                TRN.rollback()
+            self.assertIsNone(TRN.get_object(IdentityObject, 1))
+            TRN.add_object(obj)
+        self.assertIsNone(TRN.get_object(IdentityObject, 1))
+        self.assertEqual(TRN._identity_map, {})
+
     def test_context_manager_checker(self):
         with self.assertRaises(RuntimeError):
             TRN.add("SELECT 42")
@@ -495,6 +1145,10 @@ class TestTransaction(TestBase):
         with self.assertRaises(RuntimeError):
             TRN.rollback()
 
+        with self.assertRaises(RuntimeError):
+            with TRN.savepoint():
+                pass
+
         with TRN:
             TRN.add("SELECT 42")
 
@@ -6,9 +6,13 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 from unittest import TestCase, main
+from threading import Thread
 from platemap.lib.util import (
-    check_barcode_assigned, convert_from_id, convert_to_id, get_count,
-    rollback_tests, get_barcodes)
+    check_barcode_assigned, check_barcodes, convert_from_id, convert_to_id,
+    get_count, rollback_tests, get_barcodes, allocate_barcodes,
+    invalidate_lookup, LookupCache, LOOKUP_CACHE, BarcodeStatus)
+from platemap.lib.query_log import QueryCounter
+from platemap.lib.sql_connection import TRN
 
 
 @rollback_tests()
@@ -35,6 +39,56 @@ class TestUtil(TestCase):
         with self.assertRaises(ValueError):
             convert_from_id(2, 'BADTABLE')
 
+    def test_convert_cached(self):
+        LOOKUP_CACHE.invalidate()
+        with QueryCounter() as counter:
+            for i in range(3):
+                self.assertEqual(convert_to_id('Project 2', 'project'), 2)
+                self.assertEqual(convert_from_id(2, 'project'), 'Project 2')
+        self.assertEqual(counter.count, 2)
+
+        # Values not cached are looked up in the database
+        TRN.add("""INSERT INTO barcodes.project
+                   (project, pi, description, contact_person)
+                   VALUES ('Uncached', 'PI', 'desc', 'contact')""")
+        TRN.execute()
+        with QueryCounter() as counter:
+            self.assertTrue(convert_to_id('Uncached', 'project') > 3)
+        self.assertEqual(counter.count, 1)
+
+    def test_invalidate_lookup(self):
+        self.assertEqual(convert_from_id(2, 'project'), 'Project 2')
+        TRN.add("""UPDATE barcodes.project SET project = 'Renamed'
+                   WHERE project_id = 2""")
+        TRN.execute()
+        self.assertEqual(convert_from_id(2, 'project'), 'Project 2')
+
+        invalidate_lookup('project')
+        self.assertEqual(convert_from_id(2, 'project'), 'Renamed')
+        self.assertEqual(convert_to_id('Renamed', 'project'), 2)
+
+        # The rows read after the change are discarded on rollback
+        TRN.rollback()
+        TRN._contexts_entered = 1
+        self.assertEqual(convert_from_id(2, 'project'), 'Project 2')
+
+    def test_lookup_cache_ttl(self):
+        cache = LookupCache(['project'], 0.5)
+        self.assertEqual(cache.get('project', 'project', 'project_id',
+                                   'Project 2'), 2)
+        self.assertIsNone(cache.get('project', 'project', 'project_id',
+                                    'NOTREALPROJECT'))
+        self.assertIsNone(cache.get('plate', 'plate', 'plate_id', 'Plate 1'))
+
+        cache._entries[('project', 'project', 'project_id')] = (0, {})
+        # Expired tables are read again
+        self.assertEqual(cache.get('project', 'project', 'project_id',
+                                   'Project 2'), 2)
+
+        cache = LookupCache(['project'], 0)
+        self.assertIsNone(cache.get('project', 'project', 'project_id',
+                                    'Project 2'))
+
     def test_get_count(self):
         obs = get_count('project')
         self.assertEqual(obs, 3)
@@ -50,6 +104,25 @@ class TestUtil(TestCase):
         obs = check_barcode_assigned('000000010')
         self.assertFalse(obs)
 
+    def test_check_barcodes(self):
+        TRN.add("""UPDATE barcodes.barcode SET assigned_on = NOW()
+                   WHERE barcode = '000000008'""")
+        TRN.execute()
+        barcodes = ['000000001', '000000003', '000000004', '000000005',
+                    '000000008', '100000001', '000000005']
+        with QueryCounter() as counter:
+            obs = check_barcodes(barcodes)
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(obs, {
+            '000000001': BarcodeStatus('sample', None),
+            '000000003': BarcodeStatus('plate', None),
+            '000000004': BarcodeStatus('sample_set', 'Sample Set 3'),
+            '000000005': BarcodeStatus('free', None),
+            '000000008': BarcodeStatus('assigned', None),
+            '100000001': BarcodeStatus('unknown', None)})
+
+        self.assertEqual(check_barcodes([]), {})
+
     def test_check_barcode_assigned_no_exist(self):
         with self.assertRaises(ValueError):
             check_barcode_assigned('100000001')
@@ -65,6 +138,37 @@ class TestUtil(TestCase):
         with self.assertRaises(ValueError):
             get_barcodes(2000000)
 
+    def test_allocate_barcodes(self):
+        obs = allocate_barcodes(2)
+        self.assertEqual(obs, ['000000005', '000000006'])
+        self.assertTrue(check_barcode_assigned('000000005'))
+
+        obs = allocate_barcodes(3)
+        self.assertEqual(obs, ['000000007', '000000008', '000000009'])
+        self.assertEqual(get_barcodes(1), ['000000010'])
+
+    def test_allocate_barcodes_error(self):
+        with self.assertRaises(ValueError):
+            allocate_barcodes(2000000)
+        # Nothing is claimed if there are not enough barcodes
+        self.assertEqual(get_barcodes(1), ['000000005'])
+
+    def test_allocate_barcodes_concurrent(self):
+        self.assertEqual(allocate_barcodes(2), ['000000005', '000000006'])
+
+        # The barcodes claimed by an open transaction are skipped
+        obs = []
+
+        def allocate():
+            with TRN:
+                obs.extend(allocate_barcodes(2))
+                TRN.rollback()
+
+        thread = Thread(target=allocate)
+        thread.start()
+        thread.join()
+        self.assertEqual(obs, ['000000007', '000000008'])
+
     def test_rollback_tests(self):
         @rollback_tests()
         class TestClass(TestCase):
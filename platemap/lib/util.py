@@ -5,9 +5,137 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
+from collections import namedtuple
+from threading import Lock
+from time import monotonic
+
+from .config_manager import pm_config
 from .sql_connection import TRN
 
 
+class LookupCache(object):
+    """Caches the rows of small lookup tables in memory
+
+    Parameters
+    ----------
+    tables : iterable of str
+        The tables whose rows are cached
+    ttl : float
+        Seconds a table is kept in memory before reading it again, 0 to
+        disable the cache
+
+    Notes
+    -----
+    The first lookup of a pair of columns reads them from the whole table in
+    a single query. Code inserting, updating or deleting rows of a cached
+    table must call `invalidate` so the change is seen before the cache
+    expires.
+    """
+    def __init__(self, tables, ttl):
+        self.tables = frozenset(tables)
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = Lock()
+
+    def _load(self, table, key_col, value_col):
+        sql = "SELECT {0}, {1} FROM barcodes.{2}".format(
+            key_col, value_col, table)
+        with TRN:
+            TRN.add(sql)
+            return {k: v for k, v in TRN.execute_fetchindex(
+                cursor_mode='tuple')}
+
+    def get(self, table, key_col, value_col, key):
+        """Returns the value of a column for the row holding a key
+
+        Parameters
+        ----------
+        table : str
+            The table to look up
+        key_col : str
+            The column holding the key
+        value_col : str
+            The column holding the value
+        key : object
+            The key to look up
+
+        Returns
+        -------
+        object
+            The value, or None if the table is not cached or no row holds
+            the key
+        """
+        if table not in self.tables or self.ttl <= 0:
+            return None
+        entry_key = (table, key_col, value_col)
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.get(entry_key)
+        if entry is None or entry[0] <= now:
+            entry = (now + self.ttl, self._load(table, key_col, value_col))
+            with self._lock:
+                self._entries[entry_key] = entry
+        return entry[1].get(key)
+
+    def invalidate(self, table=None):
+        """Discards the rows kept of a table
+
+        Parameters
+        ----------
+        table : str, optional
+            The table to discard. Defaults to all the tables
+        """
+        with self._lock:
+            if table is None:
+                self._entries = {}
+            else:
+                self._entries = {k: v for k, v in self._entries.items()
+                                 if k[0] != table}
+
+
+BarcodeStatus = namedtuple('BarcodeStatus', ['status', 'sample_set'])
+BarcodeStatus.__doc__ = """The state of a barcode
+
+Attributes
+----------
+status : str
+    One of 'unknown' if the barcode does not exist, 'plate' or 'sample' if it
+    is attached to a plate or a sample, 'sample_set' if it is pre-assigned to
+    a sample set, 'assigned' if it has been assigned otherwise, or 'free'
+sample_set : str or None
+    The sample set the barcode is pre-assigned to
+"""
+
+
+# Lookups of the tables keyed by {table}_id, for convert_to_id and
+# convert_from_id. Projects and sample sets are invalidated when created, while
+# instrument and primer_set rows are assumed static, so changes to them are
+# only seen once the cache expires
+LOOKUP_CACHE = LookupCache(
+    ['sample_set', 'project', 'instrument', 'primer_set'],
+    pm_config.lookup_cache_ttl)
+
+
+def invalidate_lookup(table):
+    """Discards the cached rows of a table changed by the current transaction
+
+    Parameters
+    ----------
+    table : str
+        The table changed
+
+    Notes
+    -----
+    The rows are discarded right away, so the transaction sees its changes,
+    and again once it is committed or rolled back, as they may have been read
+    in the meantime.
+    """
+    with TRN:
+        LOOKUP_CACHE.invalidate(table)
+        TRN.add_post_commit_func(LOOKUP_CACHE.invalidate, table)
+        TRN.add_post_rollback_func(LOOKUP_CACHE.invalidate, table)
+
+
 def convert_to_id(value, table, text_col=None):
     """Converts a string value to its corresponding table identifier
 
@@ -29,8 +157,16 @@ def convert_to_id(value, table, text_col=None):
     ------
     LookupError
         The passed string has no associated id
+
+    Notes
+    -----
+    Lookups on the tables in `LOOKUP_CACHE` are served from memory, values
+    not found there are looked up in the database.
     """
     text_col = table if text_col is None else text_col
+    _id = LOOKUP_CACHE.get(table, text_col, table + '_id', value)
+    if _id is not None:
+        return _id
     with TRN:
         sql = "SELECT {0}_id FROM barcodes.{0} WHERE {1} = %s".format(
             table, text_col)
@@ -65,8 +201,16 @@ def convert_from_id(value, table, id_col=None):
     ------
     LookupError
         The passed id has no associated string
+
+    Notes
+    -----
+    Lookups on the tables in `LOOKUP_CACHE` are served from memory, values
+    not found there are looked up in the database.
     """
     id_col = table + '_id' if id_col is None else id_col
+    string = LOOKUP_CACHE.get(table, id_col, table, value)
+    if string is not None:
+        return string
     with TRN:
         sql = "SELECT {0} FROM barcodes.{0} WHERE {1} = %s".format(
             table, id_col)
@@ -98,6 +242,55 @@ def get_count(table):
         return TRN.execute_fetchlast()
 
 
+def check_barcodes(barcodes):
+    """Checks the state of many barcodes at once
+
+    Parameters
+    ----------
+    barcodes : iterable of str
+        Barcodes to check
+
+    Returns
+    -------
+    dict of {str: BarcodeStatus}
+        The state of each of the barcodes
+    """
+    sql = """SELECT barcode, b.barcode IS NOT NULL AS known, b.assigned_on,
+                 EXISTS(SELECT 1 FROM barcodes.plate p
+                        WHERE p.plate_id = q.barcode) AS plate,
+                 EXISTS(SELECT 1 FROM barcodes.sample s
+                        WHERE s.barcode = q.barcode) AS sample,
+                 (SELECT min(sample_set)
+                  FROM barcodes.sample_set_barcodes
+                  JOIN barcodes.sample_set USING (sample_set_id)
+                  WHERE barcode = q.barcode) AS sample_set
+             FROM unnest(%s::varchar[]) AS q (barcode)
+             LEFT JOIN barcodes.barcode b USING (barcode)
+          """
+    barcodes = list(set(barcodes))
+    if not barcodes:
+        return {}
+    statuses = {}
+    with TRN:
+        TRN.add(sql, [barcodes])
+        for row in TRN.execute_fetchindex():
+            if not row['known']:
+                status = 'unknown'
+            elif row['plate']:
+                status = 'plate'
+            elif row['sample']:
+                status = 'sample'
+            elif row['sample_set'] is not None:
+                status = 'sample_set'
+            elif row['assigned_on'] is not None:
+                status = 'assigned'
+            else:
+                status = 'free'
+            statuses[row['barcode']] = BarcodeStatus(status,
+                                                     row['sample_set'])
+    return statuses
+
+
 def check_barcode_assigned(barcode):
     """Checks if barcode is already assigned to sample or project
 
@@ -116,21 +309,10 @@ def check_barcode_assigned(barcode):
     ValueError
         Barcode does not exist in database
     """
-    sql = """SELECT barcode, assigned_on, sample_set_id
-        FROM barcodes.barcode
-        LEFT JOIN barcodes.sample_set_barcodes USING (barcode)
-        WHERE barcode = %s
-        """
-    with TRN:
-        TRN.add(sql, [barcode])
-        barcode_info = TRN.execute_fetchindex()
-        if not barcode_info:
-            raise ValueError('Barcode %s does not exist in the DB' % barcode)
-        # Check if barcode retrieved has set assigned on date or not
-        if barcode_info[0]['assigned_on'] is None and \
-                barcode_info[0]['sample_set_id'] is None:
-            return False
-        return True
+    status = check_barcodes([barcode])[barcode].status
+    if status == 'unknown':
+        raise ValueError('Barcode %s does not exist in the DB' % barcode)
+    return status != 'free'
 
 
 def get_barcodes(num_barcodes):
@@ -166,6 +348,78 @@ def get_barcodes(num_barcodes):
         return barcodes
 
 
+# Common table expressions claiming up to %s unassigned barcodes, to start a
+# WITH query. The barcodes claimed are marked as assigned and returned by the
+# `claimed` expression. Barcodes locked by concurrent transactions are skipped.
+_CLAIM_BARCODES_SQL = """free AS (
+                            SELECT barcode
+                            FROM barcodes.barcode b
+                            WHERE assigned_on IS NULL AND NOT EXISTS (
+                                SELECT 1 FROM barcodes.sample_set_barcodes ssb
+                                WHERE ssb.barcode = b.barcode)
+                            ORDER BY barcode LIMIT %s
+                            FOR UPDATE SKIP LOCKED),
+                        claimed AS (
+                            UPDATE barcodes.barcode b
+                            SET assigned_on = NOW()
+                            FROM free
+                            WHERE b.barcode = free.barcode
+                            RETURNING b.barcode)
+                     """
+
+
+def allocate_barcodes(num_barcodes, sample_set_id=None):
+    """Claims unassigned barcodes for the current transaction
+
+    Parameters
+    ----------
+    num_barcodes : int
+        Number of barcodes to claim
+    sample_set_id : int, optional
+        The id of the sample set to assign the barcodes to. Default is to
+        only claim them.
+
+    Returns
+    -------
+    list of str
+        Barcodes claimed, in order
+
+    Raises
+    ------
+    ValueError
+        Number of barcodes requested excededs number of unassigned barcodes
+
+    Notes
+    -----
+    The barcodes are claimed in a single statement, which marks them as
+    assigned, adds them to the sample set if given and locks them until the
+    transaction finishes. Barcodes locked by concurrent transactions are
+    skipped, so the same barcode is never handed out twice. If there are not
+    enough barcodes nothing is claimed, even if the caller goes on with the
+    transaction.
+    """
+    if sample_set_id is None:
+        sql = "WITH %s SELECT barcode FROM claimed" % _CLAIM_BARCODES_SQL
+        sql_args = [num_barcodes]
+    else:
+        sql = """WITH %s,
+                 assigned AS (
+                     INSERT INTO barcodes.sample_set_barcodes
+                     (sample_set_id, barcode)
+                     SELECT %%s, barcode FROM claimed
+                     RETURNING barcode)
+                 SELECT barcode FROM assigned
+              """ % _CLAIM_BARCODES_SQL
+        sql_args = [num_barcodes, sample_set_id]
+    with TRN.atomic():
+        TRN.add(sql, sql_args)
+        barcodes = sorted(TRN.execute_fetchflatten())
+        if len(barcodes) != num_barcodes:
+            raise ValueError('%d barcodes requested, only %d available' %
+                             (num_barcodes, len(barcodes)))
+        return barcodes
+
+
 def rollback_tests():
     """Decorator for rolling back tests as they finish"""
     def class_modifier(cls):
@@ -183,10 +437,14 @@ def rollback_tests():
             def setUp(self):
                 # Add one extra context so we can rollback in tearDown
                 TRN._contexts_entered = 1
+                # Handlers called by the test run in its transaction
+                self._shared_trn = TRN.shared()
+                self._shared_trn.__enter__()
                 super(DecoratedClass, self).setUp()
 
             def tearDown(self):
                 super(DecoratedClass, self).tearDown()
+                self._shared_trn.__exit__(None, None, None)
                 TRN.rollback()
                 TRN.__exit__(None, None, None)
         return DecoratedClass
@@ -167,6 +167,12 @@ def revert_plate(user, plate_id):
     if not user.check_access('Admin'):
         raise ValueError('User %s is not admin!' % user.id)
 
-    sql = "UPDATE barcodes.plate SET finalized = 'F' WHERE plate_id = %s"
+    sql = """UPDATE barcodes.plate
+             SET finalized = 'F',
+                 version = nextval('barcodes.plate_version_seq')
+             WHERE plate_id = %s"""
     with pm.sql.TRN:
         pm.sql.TRN.add(sql, [plate_id])
+        plate = pm.sql.TRN.get_object(pm.plate.Plate, plate_id)
+        if plate is not None:
+            plate.refresh()
@@ -8,6 +8,7 @@
 from unittest import main
 
 from platemap.tests_website.tornado_test_base import TestHandlerBase
+from platemap.handlers.project import ViewProjectHandler
 from platemap.lib.util import rollback_tests
 
 
@@ -19,6 +20,18 @@ class TestBaseHandler(TestHandlerBase):
         self.assertIn('HTTP 400: Bad Request (Missing argument username)',
                       obs.body.decode('utf-8'))
 
+    def test_query_budget(self):
+        with self.assertLogs(level='WARNING') as cm:
+            ViewProjectHandler.query_budget = 1
+            try:
+                obs = self.get('/project/view/')
+            finally:
+                ViewProjectHandler.query_budget = None
+        self.assertEqual(obs.code, 200)
+        self.assertEqual(len(cm.output), 1)
+        self.assertIn('GET /project/view/', cm.output[0])
+        self.assertIn('queries (budget 1)', cm.output[0])
+
 
 @rollback_tests()
 class TestMainHandler(TestHandlerBase):
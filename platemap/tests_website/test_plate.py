@@ -6,7 +6,7 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 from unittest import main
-from json import loads
+from json import loads, dumps
 
 from platemap.tests_website.tornado_test_base import TestHandlerBase
 from platemap.lib.util import rollback_tests
@@ -51,6 +51,12 @@ class TestPlateRenderHandler(TestHandlerBase):
             self.assertEqual(obs.code, 200)
             self.assertIn('<h3>Plate 000000003 - Test plate 1</h3>',
                           obs.body.decode('utf-8'))
+            self.assertIn('id="1-2" value="Sample 2"',
+                          obs.body.decode('utf-8'))
+
+    def test_get_query_budget(self):
+        with self.assertQueryBudget(7, 1):
+            self.get('/plate/render/000000003')
 
     def test_get_blank(self):
         obs = self.get('/plate/render/')
@@ -86,6 +92,32 @@ class TestPlateStaticRenderHandler(TestHandlerBase):
         self.assertEqual(obs.code, 200)
         self.assertEqual(obs.body.decode('utf-8'), exp)
 
+    def test_get_query_budget(self):
+        with self.assertQueryBudget(2, 1):
+            self.get('/plate/html/000000003')
+
+    def test_get_finalized_etag(self):
+        plate = pm.plate.Plate('000000003')
+        plate.finalize()
+        obs = self.get('/plate/html/000000003')
+        self.assertEqual(obs.code, 200)
+        etag = obs.headers['Etag']
+        self.assertEqual(etag, '"000000003-%d"' % plate.version)
+
+        with self.assertQueryBudget(2, 1):
+            obs = self.get('/plate/html/000000003',
+                           headers={'If-None-Match': etag})
+        self.assertEqual(obs.code, 304)
+        self.assertEqual(obs.body, b'')
+
+        # Reverting the plate makes the tag stale
+        plate.revert(pm.person.User('User1'))
+        plate.finalize()
+        obs = self.get('/plate/html/000000003',
+                       headers={'If-None-Match': etag})
+        self.assertEqual(obs.code, 200)
+        self.assertNotEqual(obs.headers['Etag'], etag)
+
     def test_get_blank(self):
         obs = self.get('/plate/html/')
         self.assertEqual(obs.code, 200)
@@ -159,6 +191,8 @@ class TestPlateUpdateHandler(TestHandlerBase):
                                            'action': 'finalize'})
         self.assertEqual(obs.code, 200)
         self.assertEqual(obs.body.decode('utf-8'), '')
+        # The plate was finalized by the request, not through this object
+        self.plate.refresh()
         self.assertEqual(self.plate.finalized, True)
 
     def test_post_unknown(self):
@@ -167,6 +201,66 @@ class TestPlateUpdateHandler(TestHandlerBase):
         self.assertEqual(obs.code, 400)
 
 
+@rollback_tests()
+class TestPlateBatchUpdateHandler(TestHandlerBase):
+    plate = pm.plate.Plate('000000003')
+
+    def post_wells(self, wells, plate_id='000000003'):
+        return self.post('/plate/update/batch/',
+                         dumps({'plate_id': plate_id, 'wells': wells}),
+                         headers={'Content-Type': 'application/json'})
+
+    def test_post(self):
+        # The upsert and the delete run in the request as their results are
+        # needed to refresh the samples taken out of the wells
+        with self.assertQueryBudget(7, 1):
+            obs = self.post_wells([
+                {'rowcol': '6-10', 'sample': 'Sample 2'},
+                {'rowcol': '6-11', 'sample': 'Sample 3'},
+                {'rowcol': '7-0', 'sample': 'Sample 3',
+                 'sample_set': 'Sample Set 2'},
+                {'rowcol': '7-1', 'sample': 'UNKNOWN'},
+                {'rowcol': '25-100', 'sample': 'Sample 2'},
+                {'rowcol': 'A1', 'sample': 'Sample 2'},
+                {'rowcol': '1-1', 'sample': ''}])
+        self.assertEqual(obs.code, 200)
+        self.assertEqual(loads(obs.body.decode('utf-8')), {'wells': [
+            {'rowcol': '6-10', 'msg': ''},
+            {'rowcol': '6-11',
+             'msg': 'Multiple samples with that name. Please select which '
+                    'you want to add.',
+             'sample_sets': ['Sample Set 1', 'Sample Set 2']},
+            {'rowcol': '7-0', 'msg': ''},
+            {'rowcol': '7-1', 'msg': 'Could not find sample "UNKNOWN"'},
+            {'rowcol': '25-100', 'msg': 'Position 25, 100 not on plate'},
+            {'rowcol': 'A1', 'msg': 'Unknown well "A1"'},
+            {'rowcol': '1-1', 'msg': ''}]})
+
+        self.plate.refresh()
+        self.assertEqual(self.plate[6, 10], pm.sample.Sample(2))
+        self.assertEqual(self.plate[6, 11], None)
+        self.assertEqual(self.plate[7, 0], pm.sample.Sample(5))
+        self.assertEqual(self.plate[1, 1], None)
+
+    def test_post_finalized(self):
+        self.plate.finalize()
+        obs = self.post_wells([{'rowcol': '6-10', 'sample': 'Sample 2'},
+                               {'rowcol': '7-1', 'sample': 'UNKNOWN'}])
+        self.assertEqual(obs.code, 200)
+        self.assertEqual(loads(obs.body.decode('utf-8')), {'wells': [
+            {'rowcol': '6-10',
+             'msg': "The object with ID '000000003' is finalized and can "
+                    "not be edited"},
+            {'rowcol': '7-1', 'msg': 'Could not find sample "UNKNOWN"'}]})
+
+    def test_post_malformed(self):
+        obs = self.post('/plate/update/batch/', 'not json')
+        self.assertEqual(obs.code, 400)
+
+        obs = self.post('/plate/update/batch/', dumps({'wells': []}))
+        self.assertEqual(obs.code, 400)
+
+
 @rollback_tests()
 class TestRevertHandler(TestHandlerBase):
     def test_get(self):
@@ -71,6 +71,10 @@ class TestViewProjectHandler(TestHandlerBase):
         self.assertIn('<h4>Sample Set 2</h4>',
                       obs.body.decode('utf-8'))
 
+    def test_post_query_budget(self):
+        with self.assertQueryBudget(9, 3):
+            self.post('/project/view/', {'project-id': 2})
+
     def test_post_unknown(self):
         obs = self.post('/project/view/', {'project-id': 12321312})
         self.assertEqual(obs.code, 200)
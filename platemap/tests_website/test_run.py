@@ -220,5 +220,9 @@ class TestPoolHandler(TestHandlerBase):
         self.assertIn('<input type="submit" value="Finalize Pool">',
                       obs.body.decode('utf-8'))
 
+    def test_get_query_budget(self):
+        with self.assertQueryBudget(repeat_budget=2):
+            self.get('/pool/render/2')
+
 if __name__ == '__main__':
     main()
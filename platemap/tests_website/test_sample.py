@@ -82,6 +82,24 @@ class TestSampleCreateHandler(TestHandlerBase):
                       obs.body.decode('utf-8'))
         self.assertEqual(len(pm.sample.Sample.search(sample_type='test')), 2)
 
+    def test_post_file_partial(self):
+        file = StringIO('sample_name\tbarcode\ntest1\t000000008\n'
+                        'Sample 1\t000000001\ntest2\t000000009\n')
+        m = MultipartEncoder(
+            fields={
+                'sample-set': 'Sample Set 1',
+                'type': 'test',
+                'location': 'the freezer',
+                'file': ('test_bc.txt', file, 'text/plain')}
+        )
+
+        obs = self.post('/sample/add/', m.to_string(),
+                        headers={'Content-Type': m.content_type})
+        self.assertEqual(obs.code, 200)
+        self.assertIn('Created 2 samples from test_bc.txt<br/>Line 3, sample '
+                      'Sample 1:', obs.body.decode('utf-8'))
+        self.assertEqual(len(pm.sample.Sample.search(sample_type='test')), 2)
+
     def test_post_file_error(self):
         file = StringIO('sample_name\tbarcode\nSample 1\t000000001\n')
         m = MultipartEncoder(
@@ -96,8 +114,10 @@ class TestSampleCreateHandler(TestHandlerBase):
         obs = self.post('/sample/add/', m.to_string(),
                         headers={'Content-Type': m.content_type})
         self.assertEqual(obs.code, 200)
-        self.assertIn('The object with name \'Sample 1\' already exists in '
-                      'table \'sample\'', obs.body.decode('utf-8'))
+        self.assertIn('Created 0 samples from test_bc.txt<br/>Line 2, sample '
+                      'Sample 1: The object with name &#39;Sample 1&#39; '
+                      'already exists in table &#39;sample&#39;',
+                      obs.body.decode('utf-8'))
         self.assertEqual(len(pm.sample.Sample.search(sample_type='test')), 0)
 
 
@@ -164,6 +184,10 @@ class TestSampleEditHandler(TestHandlerBase):
         self.assertEqual(obs.code, 200)
         self.assertIn('ERROR: Barcode 000000001 already assigned',
                       obs.body.decode('utf-8'))
+        # The whole edit is rolled back
+        sample = pm.sample.Sample(1)
+        sample.refresh()
+        self.assertEqual(sample.location, 'the freezer')
 
 
 if __name__ == '__main__':
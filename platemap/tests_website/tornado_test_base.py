@@ -17,6 +17,13 @@ class TestHandlerBase(AsyncHTTPTestCase):
             return_value=pm.person.User('User1'))
         return self.app
 
+    def assertQueryBudget(self, budget=None, repeat_budget=None):
+        """Fails the test if the requests made in the context run more
+        queries than budgeted, in total or for a single statement"""
+        # The requests are handled in the context of the server
+        return pm.query_log.QueryCounter(budget, repeat_budget,
+                                         process_wide=True)
+
     # helpers from http://www.peterbe.com/plog/tricks-asynchttpclient-tornado
     def get(self, url, data=None, headers=None, doseq=True, mocked=True):
         if data is not None:
@@ -20,7 +20,7 @@ classes = """
     Topic :: Scientific/Engineering
     Topic :: Scientific/Engineering :: Bio-Informatics
     Programming Language :: Python
-    Programming Language :: Python :: 3.5
+    Programming Language :: Python :: 3.7
     Operating System :: Unix
     Operating System :: POSIX
     Operating System :: MacOS :: MacOS X
@@ -42,11 +42,11 @@ setup(name='plate-mapper',
       url='https://github.com/squirrelo/plate-tracker',
       packages=find_packages(),
       package_data={
-          'platemap': ['db/*.sql']
+          'platemap': ['db/*.sql', 'db/patches/*.sql']
       },
       scripts=glob('scripts/*'),
       extras_require={'test': ['nose >= 0.10.1', 'flake8', 'mock',
                                'requests_toolbelt']},
       install_requires=['tornado', 'psycopg2', 'passlib', 'bcrypt', 'wtforms',
-                        'click'],
+                        'click', 'numpy'],
       classifiers=classifiers)